@@ -0,0 +1,461 @@
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import platform
+import argparse
+import resource
+import textwrap
+import traceback
+import subprocess
+from io import StringIO
+import numpy as np
+import localgb
+
+# hide gb file warnings, as query.py does
+import warnings
+warnings.filterwarnings("ignore")
+
+# what the synthetic records are made of
+PRODUCTS = [
+    'enolase',
+    'cytochrome oxidase subunit I',
+    'cytochrome c oxidase subunit 1',
+    '16S ribosomal RNA',
+    'NADH dehydrogenase subunit 4',
+    'hypothetical protein',
+    'putative uncharacterized protein with a long name that wraps over several lines',
+]
+FEATURE_TYPES = ['CDS', 'CDS', 'gene', 'rRNA', 'misc_feature', 'exon']
+TAXIDS = [6447, 6448, 7227, 9606, 562, 3702, 10090, 7955]
+AMINO_ACIDS = np.frombuffer(b'ACDEFGHIKLMNPQRSTVWY', dtype=np.uint8)
+BASES = np.frombuffer(b'acgt', dtype=np.uint8)
+
+CORPUS_FILENAME = 'bench.seq'
+PARAMETERS_FILENAME = 'parameters.json'
+
+# the query that the prefilter, extract and search stages run
+QUERY = dict(type='CDS', qualifier='product', terms=['enolase'])
+
+
+def qualifier_lines(key, value, quote=True):
+    """
+    Format a qualifier the way genbank does: wrapped at spaces if there are
+    any, otherwise anywhere, to fit in 79 columns.
+    """
+    text = '/{}="{}"'.format(key, value) if quote else '/{}={}'.format(key, value)
+    if ' ' in value:
+        lines = textwrap.wrap(text, 58, break_long_words=True, break_on_hyphens=False)
+    else:
+        lines = [text[i:i + 58] for i in range(0, len(text), 58)]
+    return ''.join(' ' * 21 + line + '\n' for line in lines)
+
+
+def random_location(rng, length):
+    feature_length = min(rng.randint(30, 3000), length)
+    start = rng.randint(1, length - feature_length + 1)
+    end = start + feature_length - 1
+    if feature_length > 100 and rng.random() < 0.3:
+        split = rng.randint(start + 20, end - 40)
+        location = 'join({}..{},{}..{})'.format(start, split, split + 20, end)
+    else:
+        location = '{}..{}'.format(start, end)
+    if rng.random() < 0.5:
+        location = 'complement({})'.format(location)
+    return location, feature_length
+
+
+def generate_record(rng, np_rng, number, length, feature_density):
+    """
+    Return the text of a synthetic genbank record (including the trailing //)
+    with a random sequence of the given length and about feature_density
+    features per kb.
+    """
+    accession = 'BM{:06d}'.format(number)
+    taxid = rng.choice(TAXIDS)
+    lines = [
+        'LOCUS       {:<16} {:>11} bp    DNA     linear   INV 01-JAN-2000\n'.format(accession, length),
+        'DEFINITION  synthetic benchmark record {}.\n'.format(number),
+        'ACCESSION   {}\n'.format(accession),
+        'VERSION     {}.{}\n'.format(accession, 1 + number % 3),
+        'KEYWORDS    .\n',
+        'SOURCE      Foo bar\n',
+        '  ORGANISM  Foo bar\n',
+        '            Eukaryota.\n',
+        'FEATURES             Location/Qualifiers\n',
+        '     source          1..{}\n'.format(length),
+        qualifier_lines('organism', 'Foo bar'),
+        qualifier_lines('mol_type', 'genomic DNA'),
+        qualifier_lines('db_xref', 'taxon:{}'.format(taxid)),
+    ]
+
+    for i in range(max(1, int(round(length / 1000 * feature_density)))):
+        feature_type = rng.choice(FEATURE_TYPES)
+        location, feature_length = random_location(rng, length)
+        lines.append('     {:<16}{}\n'.format(feature_type, location))
+        if feature_type in ('CDS', 'gene', 'rRNA'):
+            lines.append(qualifier_lines('product', rng.choice(PRODUCTS)))
+        if feature_type == 'CDS':
+            lines.append(qualifier_lines('codon_start', '1', quote=False))
+            translation = AMINO_ACIDS[np_rng.integers(0, len(AMINO_ACIDS), max(feature_length // 3, 1))]
+            lines.append(qualifier_lines('translation', translation.tobytes().decode('ascii')))
+
+    lines.append('ORIGIN\n')
+    sequence = BASES[np_rng.integers(0, 4, length)].tobytes().decode('ascii')
+    # a run of Ns now and then, like real records
+    if length > 200 and rng.random() < 0.2:
+        n_start = rng.randint(0, length - 100)
+        sequence = sequence[:n_start] + 'n' * 50 + sequence[n_start + 50:]
+    for start in range(0, length, 60):
+        line = sequence[start:start + 60]
+        lines.append('{:>9} {}\n'.format(
+            start + 1, ' '.join(line[i:i + 10] for i in range(0, len(line), 10))
+        ))
+    lines.append('//\n')
+    return ''.join(lines)
+
+
+def generate_corpus(directory, records, record_size, feature_density, big_records, big_record_size, seed):
+    """
+    Write a deterministic synthetic corpus (bench.seq and bench.seq.gz) to
+    directory, unless it's already there with the same parameters. Record
+    lengths vary randomly around record_size, and big_records records of
+    big_record_size are spread through the file.
+    """
+    parameters = dict(
+        records=records, record_size=record_size, feature_density=feature_density,
+        big_records=big_records, big_record_size=big_record_size, seed=seed
+    )
+    parameters_filename = os.path.join(directory, PARAMETERS_FILENAME)
+    plain_filename = os.path.join(directory, CORPUS_FILENAME)
+    if os.path.exists(parameters_filename) and os.path.exists(plain_filename + '.gz'):
+        with open(parameters_filename) as parameters_file:
+            if json.load(parameters_file) == parameters:
+                return parameters
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    print('generating {} records in {}'.format(records + big_records, directory))
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    big_positions = set(rng.sample(range(records + big_records), big_records))
+    with open(plain_filename, 'w') as plain_file:
+        for number in range(records + big_records):
+            if number in big_positions:
+                length = big_record_size
+            else:
+                length = max(100, int(rng.lognormvariate(0, 0.5) * record_size))
+            plain_file.write(generate_record(rng, np_rng, number, length, feature_density))
+    with open(plain_filename, 'rb') as plain_file, gzip.open(plain_filename + '.gz', 'wb') as gz_file:
+        while True:
+            data = plain_file.read(2 ** 20)
+            if not data:
+                break
+            gz_file.write(data)
+
+    with open(parameters_filename, 'w') as parameters_file:
+        json.dump(parameters, parameters_file)
+    return parameters
+
+
+def peak_rss():
+    # ru_maxrss is in KB on Linux but bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / 2 ** 20
+    return maxrss / 2 ** 10
+
+
+def load_records(filename, text=False):
+    """
+    Read the records of the corpus into memory, as bytes, or as strings if
+    text is True.
+    """
+    return [
+        str(record, 'latin-1') if text else bytes(record)
+        for offset, record in localgb.iter_records(filename) if len(record) > 0
+    ]
+
+
+def stage_split(corpus, filename):
+    count = 0
+    size = 0
+    for offset, record in localgb.iter_records(filename):
+        if len(record) == 0:
+            continue
+        count += 1
+        size += len(record)
+    return count, size
+
+
+def stage_prefilter(corpus):
+    prefilter = localgb.build_prefilter(localgb.Query(output=None, action='count-features', **QUERY))
+    size = 0
+    for record in corpus['records']:
+        prefilter.search(record)
+        size += len(record)
+    return len(corpus['records']), size
+
+
+def stage_parse(corpus):
+    size = 0
+    for text in corpus['records']:
+        localgb.LazyRecord(text).features
+        size += len(text)
+    return len(corpus['records']), size
+
+
+def stage_parse_biopython(corpus):
+    size = 0
+    for text in corpus['records']:
+        localgb.BiopythonRecord(text).features
+        size += len(text)
+    return len(corpus['records']), size
+
+
+def stage_extract(corpus):
+    # parse the feature tables first, so that only extraction is timed
+    records = []
+    for text in corpus['records']:
+        record = localgb.LazyRecord(text)
+        records.append((record, [f for f in record.features if f.type == 'CDS']))
+    size = 0
+    start = time.perf_counter()
+    for record, features in records:
+        for feature in features:
+            size += len(record.extract(feature))
+    return len(records), size, time.perf_counter() - start
+
+
+def stage_protein_fasta(corpus):
+    query = localgb.Query(
+        'CDS', None, 'fasta-protein-features', qualifier='product', terms=['enolase']
+    )
+    size = 0
+    for text in corpus['records']:
+        output, feature_count = localgb.process_features(localgb.LazyRecord(text), query)
+        size += len(text)
+    return len(corpus['records']), size
+
+
+def stage_taxid_filter(corpus):
+    # none of the records are from this taxid, so this times just the check
+    query = localgb.Query('CDS', None, 'count-features')
+    query.taxid_set = set(['1'])
+    output = StringIO()
+    size = 0
+    for text in corpus['records']:
+        localgb.process_record(text, [query], [output])
+        size += len(text)
+    return len(corpus['records']), size
+
+
+def stage_search(corpus, filename):
+    query = localgb.Query(output=os.devnull, action='fasta-features', **QUERY)
+    localgb.search_queries([query], argparse.Namespace(files=[filename], workers=1))
+    return query.prefilter_checked_count, os.path.getsize(filename)
+
+
+# (name, what the stage needs in corpus['records']: nothing, the records as
+# bytes or the records as strings, function)
+STAGES = [
+    ('split', None, lambda corpus: stage_split(corpus, corpus['plain'])),
+    ('split_gz', None, lambda corpus: stage_split(corpus, corpus['gz'])),
+    ('prefilter', 'bytes', stage_prefilter),
+    ('parse', 'text', stage_parse),
+    ('parse_biopython', 'text', stage_parse_biopython),
+    ('extract', 'text', stage_extract),
+    ('protein_fasta', 'text', stage_protein_fasta),
+    ('taxid_filter', 'text', stage_taxid_filter),
+    ('search', None, lambda corpus: stage_search(corpus, corpus['plain'])),
+    ('search_gz', None, lambda corpus: stage_search(corpus, corpus['gz'])),
+]
+
+
+def run_stage(function, records, corpus, repeat):
+    """
+    Run a stage in a process of its own, so that its peak memory use is
+    measured on its own rather than on top of every stage before it, and
+    return its results (see time_stage).
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            if records is not None:
+                corpus = dict(corpus, records=load_records(corpus['plain'], text=records == 'text'))
+            result = time_stage(function, corpus, repeat)
+            result['peak_rss_mb'] = peak_rss()
+            with os.fdopen(write_fd, 'w') as result_file:
+                json.dump(result, result_file)
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as result_file:
+        result = result_file.read()
+    os.waitpid(pid, 0)
+    if not result:
+        raise RuntimeError('stage failed')
+    return json.loads(result)
+
+
+def time_stage(function, corpus, repeat):
+    """
+    Run a stage repeat times and return the result of the quickest run.
+    Stages return (records, bytes) and are timed as a whole, or (records,
+    bytes, seconds) if they only want part of what they do timed.
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function(corpus)
+        seconds = time.perf_counter() - start
+        if len(result) == 3:
+            records, size, seconds = result
+        else:
+            records, size = result
+        if best is None or seconds < best[2]:
+            best = (records, size, seconds)
+    records, size, seconds = best
+    return {
+        'seconds': seconds,
+        'records': records,
+        'bytes': size,
+        'records_per_second': records / max(seconds, 1e-9),
+        'mb_per_second': size / 2 ** 20 / max(seconds, 1e-9),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None, threshold=0.1):
+    """
+    Print a table of the stage results, and if previous results are given,
+    how much quicker or slower each stage is now. Returns the names of the
+    stages that got slower by more than threshold.
+    """
+    slower = []
+    header = '{:<16} {:>9} {:>12} {:>9} {:>10}'.format('stage', 'seconds', 'records/s', 'MB/s', 'peak RSS')
+    if previous is not None:
+        header += ' {:>10}'.format('change')
+    print(header)
+    for stage, result in results['stages'].items():
+        line = '{:<16} {:>9.3f} {:>12.0f} {:>9.1f} {:>7.0f} MB'.format(
+            stage, result['seconds'], result['records_per_second'],
+            result['mb_per_second'], result['peak_rss_mb']
+        )
+        if previous is not None and stage in previous['stages']:
+            before = previous['stages'][stage]['records_per_second']
+            change = result['records_per_second'] / max(before, 1e-9) - 1
+            line += ' {:>+9.1%}'.format(change)
+            if change < -threshold:
+                line += '  SLOWER'
+                slower.append(stage)
+        print(line)
+    return slower
+
+
+parser = argparse.ArgumentParser(
+    description='Time the hot paths of a search (splitting files into records, the prefilter, parsing, extracting features, writing protein FASTA, taxid filtering and a whole search) on a synthetic genbank corpus, and compare the results with an earlier run.'
+    )
+
+parser.add_argument(
+    '--corpus-dir',
+    default='benchmark_corpus',
+    help='where to keep the synthetic genbank files; they are only generated again if the corpus options change (default: %(default)s)'
+    )
+
+parser.add_argument('--records', type=int, default=5000, help='number of normal sized records (default: %(default)d)')
+parser.add_argument('--record-size', type=int, default=2000, help='typical record length in bp (default: %(default)d)')
+parser.add_argument('--feature-density', type=float, default=2, help='features per kb of sequence (default: %(default)s)')
+parser.add_argument('--big-records', type=int, default=2, help='number of very long records to include (default: %(default)d)')
+parser.add_argument('--big-record-size', type=int, default=5000000, help='length of the very long records in bp (default: %(default)d)')
+parser.add_argument('--seed', type=int, default=1, help='random seed for the corpus (default: %(default)d)')
+
+parser.add_argument(
+    '--stages',
+    nargs='+',
+    choices=[name for name, records, function in STAGES],
+    help='only run these stages (default: all of them)'
+    )
+
+parser.add_argument('--repeat', type=int, default=3, help='run each stage this many times and keep the quickest (default: %(default)d)')
+
+parser.add_argument('--save', help='write the results to this JSON file')
+
+parser.add_argument(
+    '--compare',
+    help='JSON file saved by an earlier run to compare against; exits with status 1 if any stage got slower by more than --threshold'
+    )
+
+parser.add_argument(
+    '--threshold',
+    type=float,
+    default=0.1,
+    help='how much slower (as a fraction) a stage has to be to count as a regression (default: %(default)s)'
+    )
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    parameters = generate_corpus(
+        args.corpus_dir, args.records, args.record_size, args.feature_density,
+        args.big_records, args.big_record_size, args.seed
+    )
+    plain_filename = os.path.join(args.corpus_dir, CORPUS_FILENAME)
+    # each stage loads the records itself, if it needs them
+    corpus = {
+        'plain': plain_filename,
+        'gz': plain_filename + '.gz',
+    }
+
+    results = {
+        'corpus': parameters,
+        'corpus_mb': os.path.getsize(plain_filename) / 2 ** 20,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'stages': {},
+    }
+    for name, records, function in STAGES:
+        if args.stages is not None and name not in args.stages:
+            continue
+        results['stages'][name] = run_stage(function, records, corpus, args.repeat)
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)
+        if previous['corpus'] != parameters:
+            print('warning: {} was run on a different corpus'.format(args.compare))
+
+    print('{} records, {:.1f} MB'.format(
+        parameters['records'] + parameters['big_records'], results['corpus_mb']
+    ))
+    slower = print_results(results, previous, args.threshold)
+
+    if args.save is not None:
+        with open(args.save, 'w') as save_file:
+            json.dump(results, save_file, indent=2)
+
+    if slower:
+        print('slower than {}: {}'.format(args.compare, ', '.join(slower)))
+        sys.exit(1)
@@ -0,0 +1,239 @@
+"""
+Reading and writing BGZF files, the block compressed gzip format used by
+samtools/htslib. A BGZF file is a normal gzip file (so gunzip, zcat and the
+gzip module can all read it) made of many small, independently compressed
+blocks. Along with a .gzi index of where each block starts, this means we can
+seek to any position in the uncompressed data by only decompressing one block,
+and different processes can decompress different parts of the same file.
+
+The .gzi index is in the same format as the one written by bgzip -i.
+"""
+import gzip
+import os
+import struct
+import zlib
+import bisect
+
+# the amount of uncompressed data in each block; the same as htslib
+BLOCK_SIZE = 65280
+MAX_BLOCK_SIZE = 65536
+
+# an empty block that marks the end of the file
+EOF_BLOCK = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000'
+)
+
+HEADER_SIZE = 18
+FOOTER_SIZE = 8
+
+
+def index_filename(filename):
+    return filename + '.gzi'
+
+
+def is_bgzf(filename):
+    """
+    Whether the file starts with a BGZF block (a gzip header with a BC extra
+    field giving the block size) and has an index. We only treat a file as
+    BGZF if it has both, since without an index we can't do anything clever
+    with it, and an index next to a file that isn't BGZF is stale.
+    """
+    if not os.path.exists(index_filename(filename)):
+        return False
+    with open(filename, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'\x1f\x8b\x08\x04':
+            return False
+        extra_length, = struct.unpack_from('<H', header, 10)
+        extra = f.read(extra_length)
+    # the extra field is a list of subfields, each an id, a length and data
+    position = 0
+    while position + 4 <= len(extra):
+        subfield_length, = struct.unpack_from('<H', extra, position + 2)
+        if extra[position:position + 2] == b'BC' and subfield_length == 2:
+            return True
+        position += 4 + subfield_length
+    return False
+
+
+def compress_block(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) + HEADER_SIZE + FOOTER_SIZE > MAX_BLOCK_SIZE:
+        # incompressible data can get bigger, so just store it
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    block_size = len(compressed) + HEADER_SIZE + FOOTER_SIZE
+    header = struct.pack(
+        '<4BI2BH2BHH',
+        0x1f, 0x8b, 8, 4,  # gzip magic, deflate, FEXTRA flag
+        0,                 # modification time
+        0, 0xff,           # extra flags, unknown OS
+        6,                 # length of the extra field
+        ord('B'), ord('C'), 2, block_size - 1
+    )
+    footer = struct.pack('<II', zlib.crc32(data), len(data))
+    return header + compressed + footer
+
+
+def write_bgzf(source, destination, level=6):
+    """
+    Compress the contents of the binary file object source into a new BGZF
+    file called destination, and write its .gzi index. Returns the number of
+    uncompressed bytes written.
+    """
+    # (compressed offset, uncompressed offset) for each block but the first
+    blocks = []
+    compressed_offset = 0
+    uncompressed_offset = 0
+    with open(destination, 'wb') as output:
+        while True:
+            data = source.read(BLOCK_SIZE)
+            if not data:
+                break
+            if uncompressed_offset > 0:
+                blocks.append((compressed_offset, uncompressed_offset))
+            block = compress_block(data, level)
+            output.write(block)
+            compressed_offset += len(block)
+            uncompressed_offset += len(data)
+        output.write(EOF_BLOCK)
+
+    with open(index_filename(destination), 'wb') as index_file:
+        index_file.write(struct.pack('<Q', len(blocks)))
+        for block in blocks:
+            index_file.write(struct.pack('<QQ', *block))
+
+    return uncompressed_offset
+
+
+def convert(filename, level=6):
+    """
+    Recompress a gzip (or uncompressed) file as BGZF in place. The new file is
+    written next to the old one and then renamed over it, so the original is
+    never left half written.
+    """
+    temporary_filename = filename + '.bgzf.tmp'
+    if filename.endswith('.gz'):
+        source = gzip.open(filename, 'rb')
+    else:
+        source = open(filename, 'rb')
+    with source:
+        write_bgzf(source, temporary_filename, level)
+    # the file goes in place before its index, so that we never see the old
+    # file with the new index, and any old index goes first, so that we never
+    # see the new file with the old one either; until the index is in place
+    # the file is just read as gzip
+    if os.path.exists(index_filename(filename)):
+        os.remove(index_filename(filename))
+    os.replace(temporary_filename, filename)
+    os.replace(index_filename(temporary_filename), index_filename(filename))
+
+
+def read_index(filename):
+    """
+    Return a list of compressed offsets and a list of uncompressed offsets for
+    every block in a BGZF file (including the first one at 0, 0).
+    """
+    with open(index_filename(filename), 'rb') as index_file:
+        data = index_file.read()
+    count, = struct.unpack_from('<Q', data)
+    compressed_offsets = [0]
+    uncompressed_offsets = [0]
+    for i in range(count):
+        compressed_offset, uncompressed_offset = struct.unpack_from('<QQ', data, 8 + 16 * i)
+        compressed_offsets.append(compressed_offset)
+        uncompressed_offsets.append(uncompressed_offset)
+    return compressed_offsets, uncompressed_offsets
+
+
+class BgzfReader(object):
+    """
+    A read-only binary file object for a BGZF file that can seek to any
+    position in the uncompressed data. If end is given, reads stop there as
+    though it was the end of the file.
+    """
+
+    def __init__(self, filename, end=None):
+        self.file = open(filename, 'rb')
+        self.compressed_offsets, self.uncompressed_offsets = read_index(filename)
+        self.end = end
+        self.block_index = -1
+        self.block = b''
+        # position in the current block
+        self.position = 0
+        self.load_block(0)
+
+    def load_block(self, block_index):
+        if block_index >= len(self.compressed_offsets):
+            self.block_index = block_index
+            self.block = b''
+            self.position = 0
+            return
+        self.file.seek(self.compressed_offsets[block_index])
+        header = self.file.read(HEADER_SIZE)
+        block_size, = struct.unpack_from('<H', header, 16)
+        compressed = self.file.read(block_size + 1 - HEADER_SIZE)
+        self.block = zlib.decompress(compressed[:-FOOTER_SIZE], -15)
+        self.block_index = block_index
+        self.position = 0
+
+    @property
+    def size(self):
+        """
+        The size of the uncompressed data.
+        """
+        last_block = len(self.uncompressed_offsets) - 1
+        if self.block_index != last_block:
+            current = self.tell()
+            self.load_block(last_block)
+            size = self.uncompressed_offsets[last_block] + len(self.block)
+            self.seek(current)
+            return size
+        return self.uncompressed_offsets[last_block] + len(self.block)
+
+    def tell(self):
+        if self.block_index >= len(self.uncompressed_offsets):
+            return self.uncompressed_offsets[-1] + len(self.block)
+        return self.uncompressed_offsets[self.block_index] + self.position
+
+    def seek(self, offset):
+        block_index = bisect.bisect_right(self.uncompressed_offsets, offset) - 1
+        if block_index != self.block_index:
+            self.load_block(block_index)
+        self.position = offset - self.uncompressed_offsets[block_index]
+
+    def read(self, size=-1):
+        chunks = []
+        remaining = size
+        if self.end is not None:
+            available = self.end - self.tell()
+            remaining = available if remaining < 0 else min(remaining, available)
+        while remaining != 0:
+            if self.position >= len(self.block):
+                if self.block_index >= len(self.compressed_offsets) - 1:
+                    break
+                self.load_block(self.block_index + 1)
+                continue
+            if remaining < 0:
+                chunk = self.block[self.position:]
+            else:
+                chunk = self.block[self.position:self.position + remaining]
+                remaining -= len(chunk)
+            self.position += len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
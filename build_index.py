@@ -0,0 +1,43 @@
+import logging
+import argparse
+import localgb
+
+
+parser = argparse.ArgumentParser(
+    description='Build or update an index of the records in your genbank files, so that they can be fetched by accession with fetch.py'
+    )
+
+parser.add_argument(
+    "-v", "--verbosity", action="count", help="show lots of debugging output", default=0
+)
+
+parser.add_argument(
+    '--index',
+    default=localgb.INDEX_FILENAME,
+    help='index file to create or update (default: {})'.format(localgb.INDEX_FILENAME)
+    )
+
+parser.add_argument(
+    '--features',
+    action='store_true',
+    help='also index the feature types, qualifiers and qualifier values of each record, so that query.py --index can skip records that cannot match. This makes the index much bigger.'
+    )
+
+parser.add_argument(
+    '--sequences',
+    action='store_true',
+    help='also pack the sequence of each record into a compact store next to the index, so that query.py --index can extract features without parsing the record sequence. Needs numpy.'
+    )
+
+parser.add_argument(
+    '--files', nargs='+', help='genbank files to index', required=True
+    )
+args = parser.parse_args()
+
+if args.verbosity > 0:
+    logging.basicConfig(level=logging.DEBUG)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+
+localgb.build_index(args.files, args.index, features=args.features, sequences=args.sequences)
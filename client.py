@@ -0,0 +1,64 @@
+import os
+import sys
+import json
+import socket
+import argparse
+
+# this only imports what it needs to talk to serve.py, so that it starts
+# quickly; see serve.py for the protocol
+
+SOCKET_FILENAME = 'localgb.sock'
+
+parser = argparse.ArgumentParser(
+    description='Run query.py or get_taxids.py (with the same options) through a running serve.py, or stream the matches for a query with "matches" (see python client.py matches --help).',
+    usage='%(prog)s [--socket SOCKET | --port PORT] {query,get_taxids,matches} ...'
+    )
+parser.add_argument(
+    '--socket',
+    default=SOCKET_FILENAME,
+    help='Unix socket that the server is listening on (default: %(default)s)'
+    )
+parser.add_argument(
+    '--port',
+    type=int,
+    help='connect to the server on this TCP port on localhost instead'
+    )
+parser.add_argument('command', choices=['query', 'get_taxids', 'matches'])
+parser.add_argument('args', nargs=argparse.REMAINDER, help='the options for the command')
+args = parser.parse_args()
+
+try:
+    if args.port is not None:
+        connection = socket.create_connection(('127.0.0.1', args.port))
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(args.socket)
+except (ConnectionRefusedError, FileNotFoundError):
+    sys.exit('no server is running at {} (start one with serve.py)'.format(
+        'port {}'.format(args.port) if args.port is not None else args.socket
+    ))
+
+connection.sendall((json.dumps({
+    'command': args.command,
+    'args': args.args,
+    'cwd': os.getcwd(),
+}) + '\n').encode('utf-8'))
+
+status = 1
+with connection.makefile('rb') as responses:
+    for line in responses:
+        message = json.loads(line)
+        if 'stdout' in message:
+            sys.stdout.write(message['stdout'])
+        elif 'stderr' in message:
+            sys.stdout.flush()
+            sys.stderr.write(message['stderr'])
+            sys.stderr.flush()
+        elif 'exit' in message:
+            status = message['exit']
+            break
+    else:
+        print('the server closed the connection before the command finished', file=sys.stderr)
+connection.close()
+sys.stdout.flush()
+sys.exit(status)
@@ -0,0 +1,132 @@
+import os
+import gzip
+import random
+import textwrap
+import pytest
+
+# what the synthetic records are made of
+PRODUCTS = [
+    'enolase',
+    'Enolase',
+    'cytochrome oxidase subunit I',
+    '16S ribosomal RNA',
+    'hypothetical protein',
+    'putative uncharacterized protein with a long name that wraps over several lines',
+]
+FEATURE_TYPES = ['CDS', 'CDS', 'gene', 'rRNA', 'misc_feature']
+TAXIDS = [6447, 6448, 7227, 9606, 562]
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def qualifier_lines(key, value, quote=True):
+    """
+    Format a qualifier the way genbank does: wrapped at spaces if there are
+    any, otherwise anywhere, to fit in 79 columns.
+    """
+    text = '/{}="{}"'.format(key, value) if quote else '/{}={}'.format(key, value)
+    if ' ' in value:
+        lines = textwrap.wrap(text, 58, break_long_words=True, break_on_hyphens=False)
+    else:
+        lines = [text[i:i + 58] for i in range(0, len(text), 58)]
+    return ''.join(' ' * 21 + line + '\n' for line in lines)
+
+
+def genbank_record(rng, accession, version=1, length=None, taxid=None, sequence=None):
+    """
+    Return the text of a random genbank record (including the trailing //)
+    that both LazyRecord and Biopython can read.
+    """
+    if sequence is None:
+        length = length or rng.randint(200, 3000)
+        sequence = ''.join(rng.choice('acgt') for i in range(length))
+        if rng.random() < 0.3:
+            n_start = rng.randint(0, length - 60)
+            sequence = sequence[:n_start] + 'n' * 40 + sequence[n_start + 40:]
+    length = len(sequence)
+    taxid = taxid or rng.choice(TAXIDS)
+    lines = [
+        'LOCUS       {:<16} {:>11} bp    DNA     linear   INV 01-JAN-2000\n'.format(accession, length),
+        'DEFINITION  synthetic test record.\n',
+        'ACCESSION   {}\n'.format(accession),
+        'VERSION     {}.{}\n'.format(accession, version),
+        'KEYWORDS    .\n',
+        'SOURCE      Foo bar\n',
+        '  ORGANISM  Foo bar\n',
+        '            Eukaryota.\n',
+        'FEATURES             Location/Qualifiers\n',
+        '     source          1..{}\n'.format(length),
+        qualifier_lines('organism', 'Foo bar'),
+        qualifier_lines('db_xref', 'taxon:{}'.format(taxid)),
+    ]
+    for i in range(rng.randint(1, 6)):
+        feature_type = rng.choice(FEATURE_TYPES)
+        feature_length = rng.randint(10, min(length, 600))
+        start = rng.randint(1, length - feature_length + 1)
+        end = start + feature_length - 1
+        if feature_length > 60 and rng.random() < 0.3:
+            split = rng.randint(start + 10, end - 30)
+            location = 'join({}..{},{}..{})'.format(start, split, split + 20, end)
+        else:
+            location = '{}..{}'.format(start, end)
+        if rng.random() < 0.5:
+            location = 'complement({})'.format(location)
+        lines.append('     {:<16}{}\n'.format(feature_type, location))
+        if feature_type in ('CDS', 'gene', 'rRNA'):
+            lines.append(qualifier_lines('product', rng.choice(PRODUCTS)))
+        if feature_type == 'CDS':
+            lines.append(qualifier_lines('codon_start', '1', quote=False))
+            translation = ''.join(rng.choice(AMINO_ACIDS) for i in range(max(feature_length // 3, 1)))
+            lines.append(qualifier_lines('translation', translation))
+    lines.append('ORIGIN\n')
+    for start in range(0, length, 60):
+        line = sequence[start:start + 60]
+        lines.append('{:>9} {}\n'.format(
+            start + 1, ' '.join(line[i:i + 10] for i in range(0, len(line), 10))
+        ))
+    lines.append('//\n')
+    return ''.join(lines)
+
+
+def write_genbank(filename, records):
+    text = ''.join(records).encode('latin-1')
+    if str(filename).endswith('.gz'):
+        with gzip.open(str(filename), 'wb') as genbank_file:
+            genbank_file.write(text)
+    else:
+        with open(str(filename), 'wb') as genbank_file:
+            genbank_file.write(text)
+
+
+def run_query(*args):
+    """
+    Run query.py with the given arguments and return what it wrote.
+    """
+    import query
+    output = 'output-{}'.format(len(os.listdir('.')))
+    query.main(query.parser.parse_args(['--output', output] + list(args)))
+    with open(output, 'rb') as output_file:
+        return output_file.read()
+
+
+@pytest.fixture
+def mirror(tmp_path, monkeypatch):
+    """
+    A directory of small genbank files, which is also made the current
+    directory: a plain and a gzipped release file, and a daily update file
+    with newer versions of some of their records. Returns a dict of filename
+    to the text of each record in it.
+    """
+    rng = random.Random(1)
+    files = {
+        'gbinv1.seq': [genbank_record(rng, 'BM{:06d}'.format(i)) for i in range(40)],
+        'gbinv2.seq.gz': [genbank_record(rng, 'BM{:06d}'.format(i)) for i in range(40, 80)],
+        'nc0101.flat.gz': [
+            genbank_record(rng, 'BM000005', version=2),
+            genbank_record(rng, 'BM000045', version=2),
+            genbank_record(rng, 'BM000100'),
+        ],
+    }
+    for filename, records in files.items():
+        write_genbank(tmp_path / filename, records)
+    monkeypatch.chdir(tmp_path)
+    return files
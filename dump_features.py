@@ -1,39 +1,294 @@
+import os
 import sys
+import math
+import zlib
+import json
+import random
+import argparse
 import collections
+import multiprocessing
 import re
-import gzip
 import tqdm
+import bgzf
+import localgb
 
-numbers = set('0123456789 ')
+numbers = set(b'0123456789 ')
 
 
-feature_re = re.compile('^     ([a-zA-Z]+)\s+')
-qualifier_re = re.compile('^                     /(.+)=.+')
+feature_re = re.compile(rb'^     ([a-zA-Z]+)\s+')
+qualifier_re = re.compile(rb'^                     /(.+)=.+')
 
-types = collections.Counter()
-qualifiers = collections.defaultdict(collections.Counter)
+# the counts for each file are cached next to it in a file with this suffix
+CACHE_SUFFIX = '.features.json'
+
+# when sampling, records are read in runs of about this many bytes from
+# random places in the file
+SAMPLE_RUN_SIZE = 2 ** 20
 
-last_type = None
-filenames = tqdm.tqdm(sys.argv[1:], unit='files')
-for filename in filenames:
-    if filename.endswith('.gz'):
-        genbank_file = gzip.open(filename, mode="rt", encoding='latin-1')
-    else:
-        genbank_file = open(filename, encoding='latin-1')
 
-    for line in genbank_file:
-        if line.startswith('     ') and line[5] not in numbers: # hacky way to avoid running regex on all lines
-            #print('checking ~~~' + line + '~~~')
-            type_match =re.search(feature_re, line)
+def count_record(record, types, qualifiers):
+    last_type = None
+    for line in bytes(record).split(b'\n'):
+        if line.startswith(b'     ') and len(line) > 5 and line[5] not in numbers: # hacky way to avoid running regex on all lines
+            type_match = feature_re.search(line)
             if type_match:
-                types[type_match.group(1)] += 1
-                last_type = type_match.group(1)
-        if line.startswith('                     '):
-            qualifier_match = re.search(qualifier_re, line)
+                last_type = type_match.group(1).decode('latin-1')
+                types[last_type] += 1
+        if line.startswith(b'                     '):
+            qualifier_match = qualifier_re.search(line)
             if qualifier_match:
-                qualifiers[last_type][qualifier_match.group(1)] += 1
+                qualifiers[last_type][qualifier_match.group(1).decode('latin-1')] += 1
+
+
+def count_sample(filename, sample, types, qualifiers):
+    """
+    Count runs of records from random places (the same ones every time) in an
+    uncompressed or BGZF file, adding up to about sample of the file, and
+    return the fraction of the file that was counted.
+    """
+    if bgzf.is_bgzf(filename):
+        with bgzf.BgzfReader(filename) as genbank_file:
+            size = genbank_file.size
+    else:
+        size = os.path.getsize(filename)
+    if size == 0:
+        return 0
+
+    # one run from a random place in each of a number of equal parts of the
+    # file, so the runs never overlap
+    runs = max(1, int(math.ceil(size * sample / SAMPLE_RUN_SIZE)))
+    part_size = size / runs
+    run_size = min(size * sample / runs, part_size)
+    sampler = random.Random(os.path.basename(filename))
+
+    counted = 0
+    for run in range(runs):
+        start = int(run * part_size + sampler.random() * (part_size - run_size))
+        for offset, record in localgb.iter_records(filename, start=start):
+            if offset >= start + run_size:
+                break
+            # unless we started at the beginning of the file, the first
+            # record is the end of one that started before the run
+            if (offset == start and start > 0) or len(record) == 0:
+                continue
+            count_record(record, types, qualifiers)
+            counted += len(record) + len(localgb.RECORD_DELIMITER)
+    return min(counted / size, 1)
+
+
+class GzipSampleReader(object):
+    """
+    A binary file object that decompresses a gzip file, like gzip.open, but
+    keeps track of how much of the compressed file it has decompressed
+    (compressed_position) and how much data that made (position).
+    """
+
+    def __init__(self, compressed_file):
+        self.compressed_file = compressed_file
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # compressed data that has been read but not decompressed yet
+        self.pending = b''
+        self.position = 0
+
+    @property
+    def compressed_position(self):
+        return self.compressed_file.tell() - len(self.pending)
+
+    def readinto(self, buffer):
+        while True:
+            if not self.pending:
+                self.pending = self.compressed_file.read(2 ** 16)
+                if not self.pending:
+                    return 0
+            if self.decompressor.eof:
+                # the next member of a multi-member gzip file
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = self.decompressor.decompress(self.pending, len(buffer))
+            self.pending = self.decompressor.unconsumed_tail or self.decompressor.unused_data
+            if data:
+                buffer[:len(data)] = data
+                self.position += len(data)
+                return len(data)
+
+
+def count_gzip_sample(filename, sample, types, qualifiers):
+    """
+    Gzip files (that aren't BGZF) can only be read from the start, so count
+    the records in about the first sample of the file, and return the
+    fraction of the file that was counted.
+    """
+    size = os.path.getsize(filename)
+    if size == 0:
+        return 0
+    with open(filename, 'rb') as compressed_file:
+        genbank_file = GzipSampleReader(compressed_file)
+        counted = 0
+        for offset, record in localgb.buffered_records(genbank_file):
+            count_record(record, types, qualifiers)
+            counted = offset + len(record) + len(localgb.RECORD_DELIMITER)
+            # we've decompressed compressed_position bytes of the file, which
+            # made position bytes, so the whole file is about
+            # position * size / compressed_position bytes uncompressed
+            fraction = counted * genbank_file.compressed_position / (genbank_file.position * size)
+            if fraction >= sample:
+                return fraction
+        return 1
+
+
+def count_features(filename, sample=None):
+    """
+    Count the feature types in a file, and the qualifiers of each type.
+    Returns (types, qualifiers), where qualifiers is a dict of type to Counter.
+
+    If sample is given, only about that fraction of the file is read, and the
+    counts are scaled up to the whole file (so they aren't whole numbers).
+    Uncompressed and BGZF files are sampled from all over the file, but other
+    gzip files can only be sampled from the start.
+    """
+    types = collections.Counter()
+    qualifiers = collections.defaultdict(collections.Counter)
+
+    if sample is None or sample >= 1:
+        for offset, record in localgb.iter_records(filename):
+            count_record(record, types, qualifiers)
+        return types, qualifiers
+
+    if filename.endswith('.gz') and not bgzf.is_bgzf(filename):
+        fraction = count_gzip_sample(filename, sample, types, qualifiers)
+    else:
+        fraction = count_sample(filename, sample, types, qualifiers)
+    if fraction > 0:
+        for counter in [types] + list(qualifiers.values()):
+            for key in counter:
+                counter[key] /= fraction
+    return types, qualifiers
+
 
-for type, count in types.most_common(100):
-    print('{} : {}'.format(type, count))
-    for qualifier, count in qualifiers[type].most_common(100):
-        print('\t{} : {}'.format(qualifier, count))
+def cache_filename(filename):
+    return filename + CACHE_SUFFIX
+
+
+def read_cache(filename):
+    """
+    Return the cached (types, qualifiers) for a file, or None if there isn't
+    a cache or the file has changed since it was made.
+    """
+    try:
+        with open(cache_filename(filename)) as cache_file:
+            cached = json.load(cache_file)
+    except (IOError, ValueError):
+        return None
+    stat = os.stat(filename)
+    if cached.get('size') != stat.st_size or cached.get('mtime') != stat.st_mtime:
+        return None
+    return (
+        collections.Counter(cached['types']),
+        dict((t, collections.Counter(q)) for t, q in cached['qualifiers'].items())
+    )
+
+
+def write_cache(filename, stat, types, qualifiers):
+    temporary_filename = cache_filename(filename) + '.tmp'
+    try:
+        with open(temporary_filename, 'w') as cache_file:
+            json.dump({
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'types': types,
+                'qualifiers': qualifiers,
+            }, cache_file)
+        os.replace(temporary_filename, cache_filename(filename))
+    except IOError as e:
+        # e.g. a read-only mirror; we just have to count it again next time
+        print('could not cache counts for {}: {}'.format(filename, e), file=sys.stderr)
+
+
+def count_file(task):
+    filename, sample = task
+    # if the file changes while we're counting it, the cache will be out of
+    # date straight away, which is what we want
+    stat = os.stat(filename)
+    types, qualifiers = count_features(filename, sample)
+    if sample is None:
+        write_cache(filename, stat, types, qualifiers)
+    return filename, types, qualifiers
+
+
+parser = argparse.ArgumentParser(
+    description='Count the feature types in genbank files, and the qualifiers of each type. Counts for whole files are cached next to them (in .features.json files), so running it again only has to count new or changed files.'
+    )
+
+parser.add_argument(
+    'files', nargs='+', help='genbank files to count'
+    )
+
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=os.cpu_count(),
+    help='number of files to count at once (default: the number of CPUs)'
+    )
+
+parser.add_argument(
+    '--sample',
+    type=float,
+    help='only read about this fraction of each file (e.g. 0.01) and scale the counts up, for a quick estimate. Records are taken from all over uncompressed and BGZF files, but only from the start of other gzip files. Sampled counts are not cached.'
+    )
+
+parser.add_argument(
+    '--json',
+    action='store_true',
+    help='write all the counts as JSON instead of the top 100 as text'
+    )
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    types = collections.Counter()
+    qualifiers = collections.defaultdict(collections.Counter)
+
+    def add_counts(file_types, file_qualifiers):
+        types.update(file_types)
+        for feature_type, counts in file_qualifiers.items():
+            qualifiers[feature_type].update(counts)
+
+    to_count = []
+    for filename in args.files:
+        cached = read_cache(filename) if args.sample is None else None
+        if cached is None:
+            to_count.append((filename, args.sample))
+        else:
+            add_counts(*cached)
+
+    pool = multiprocessing.Pool(args.workers)
+    for filename, file_types, file_qualifiers in tqdm.tqdm(
+        pool.imap_unordered(count_file, to_count),
+        total=len(to_count),
+        unit='files',
+        desc='counting {} of {} files'.format(len(to_count), len(args.files))
+    ):
+        add_counts(file_types, file_qualifiers)
+    pool.close()
+    pool.join()
+
+    if args.sample is not None:
+        for counter in [types] + list(qualifiers.values()):
+            for key in counter:
+                counter[key] = int(round(counter[key]))
+
+    if args.json:
+        json.dump({
+            'sample': args.sample,
+            'types': dict(types.most_common()),
+            'qualifiers': dict(
+                (feature_type, dict(qualifiers[feature_type].most_common()))
+                for feature_type, count in types.most_common()
+            ),
+        }, sys.stdout, indent=2)
+        print()
+    else:
+        for type, count in types.most_common(100):
+            print('{} : {}'.format(type, count))
+            for qualifier, count in qualifiers[type].most_common(100):
+                print('\t{} : {}'.format(qualifier, count))
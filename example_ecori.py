@@ -1,19 +1,27 @@
 import localgb
 import sys
-import re
-from Bio import SeqIO
-from io import StringIO
+import os
 
 
+# GAATTC is its own reverse complement, so this finds sites on either strand
+ecori = localgb.MotifScanner({'EcoRI': 'GAATTC'})
 
 
 #@profile
 def process_record(record):
 
-    if 'gaattc' in record.lower(): # quick check, might be false positive
-        real_record = SeqIO.read(StringIO(record), format='gb')
-        if 'gaattc' in str(real_record.seq).lower():
-            output_file.write(record)
+    # the sequence comes straight from the ORIGIN section of the record, so
+    # line breaks and position numbers can't hide a site or fake one, and
+    # there's no need to parse the record with SeqIO
+    if ecori.scan(localgb.record_sequence(record)):
+        return record + b'\n//\n'
 
-with open('ecori.gb', 'wt') as output_file:
-    localgb.do_search_generic(process_record, filenames=sys.argv[1:])
+if __name__ == '__main__':
+    with open('ecori.gb', 'wb') as output_file:
+        localgb.do_search_generic(
+            process_record,
+            filenames=sys.argv[1:],
+            workers=os.cpu_count(),
+            result_function=output_file.write,
+            raw=True  # records as bytes, which is all record_sequence needs
+        )
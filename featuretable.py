@@ -0,0 +1,215 @@
+"""
+Writing the features that a query finds as a table with one row per feature,
+in a columnar format that pandas (or anything else) can load without parsing
+text: Parquet if pyarrow is installed, otherwise a chunked .npz file of NumPy
+arrays.
+
+Rows come in as lines of JSON (which is what localgb writes for the
+feature-table action, so that they can go through part files and the result
+cache like any other output) and are written out ROW_GROUP_SIZE rows at a
+time, so memory use doesn't grow with the size of the table.
+
+In an .npz file, each row group is stored as a set of arrays named
+chunkNNNNN/column: integer columns as int64 arrays (with -1 for missing
+values) and text columns as the UTF-8 bytes of all the values joined
+together (column.data) plus where each one starts (column.offsets). Missing
+text values are stored as empty strings. read_feature_table() puts it all
+back together.
+"""
+import json
+import zipfile
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# the columns every table has, then a column for each qualifier and
+# optionally the sequence
+FIXED_COLUMNS = [
+    ('accession', 'text'),
+    ('version', 'int'),
+    ('taxid', 'int'),
+    ('type', 'text'),
+    ('start', 'int'),
+    ('end', 'int'),
+    ('strand', 'int'),
+]
+
+ROW_GROUP_SIZE = 100000
+# row groups are also written when they get this big, which matters when
+# the table has sequences in it
+ROW_GROUP_BYTES = 64 * 2 ** 20
+
+COLUMNS_NAME = '__columns__'
+
+
+def table_columns(qualifiers, sequences=False):
+    columns = FIXED_COLUMNS + [(name, 'text') for name in qualifiers]
+    if sequences:
+        columns.append(('sequence', 'text'))
+    return columns
+
+
+def table_format(filename):
+    """
+    Work out which format to write a table in from its filename: npz for .npz
+    files, otherwise Parquet, unless we don't have pyarrow.
+    """
+    if filename.endswith('.npz') or pyarrow is None:
+        return 'npz'
+    return 'parquet'
+
+
+class FeatureTableWriter(object):
+    """
+    A file-like object that takes rows of a feature table as lines of JSON
+    (in any size pieces) and writes them to filename as Parquet or npz (see
+    table_format).
+    """
+
+    def __init__(self, filename, qualifiers, sequences=False):
+        self.filename = filename
+        self.columns = table_columns(qualifiers, sequences)
+        self.format = table_format(filename)
+        self.pending = ''
+        self.row_count = 0
+        self.chunk_count = 0
+        self.clear()
+
+        if self.format == 'parquet':
+            self.schema = pyarrow.schema([
+                (name, pyarrow.string() if kind == 'text' else pyarrow.int64())
+                for name, kind in self.columns
+            ])
+            self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        else:
+            self.writer = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+            self.write_array(COLUMNS_NAME, np.array(
+                ['{}:{}'.format(name, kind) for name, kind in self.columns]
+            ))
+
+    def clear(self):
+        self.values = [[] for column in self.columns]
+        self.buffered_rows = 0
+        self.buffered_bytes = 0
+
+    def write(self, text):
+        lines = (self.pending + text).split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            if line:
+                self.add_row(json.loads(line))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def add_row(self, row):
+        if len(row) != len(self.columns):
+            raise ValueError('expected {} columns in feature table row, got {}'.format(
+                len(self.columns), len(row)
+            ))
+        for values, value in zip(self.values, row):
+            values.append(value)
+            if isinstance(value, str):
+                self.buffered_bytes += len(value)
+        self.buffered_rows += 1
+        self.row_count += 1
+        if self.buffered_rows >= ROW_GROUP_SIZE or self.buffered_bytes >= ROW_GROUP_BYTES:
+            self.flush()
+
+    def flush(self):
+        if self.buffered_rows == 0:
+            return
+        if self.format == 'parquet':
+            self.writer.write_table(pyarrow.Table.from_arrays(
+                [
+                    pyarrow.array(values, type=field.type)
+                    for values, field in zip(self.values, self.schema)
+                ],
+                schema=self.schema
+            ))
+        else:
+            prefix = 'chunk{:05d}/'.format(self.chunk_count)
+            for (name, kind), values in zip(self.columns, self.values):
+                if kind == 'int':
+                    self.write_array(prefix + name, np.array(
+                        [-1 if value is None else value for value in values], dtype=np.int64
+                    ))
+                else:
+                    encoded = [value.encode('utf-8') if value is not None else b'' for value in values]
+                    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+                    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+                    self.write_array(prefix + name + '.data', np.frombuffer(b''.join(encoded), dtype=np.uint8))
+                    self.write_array(prefix + name + '.offsets', offsets)
+        self.chunk_count += 1
+        self.clear()
+
+    def write_array(self, name, array):
+        with self.writer.open(name + '.npy', 'w', force_zip64=True) as array_file:
+            np.lib.format.write_array(array_file, array, allow_pickle=False)
+
+    def close(self):
+        if self.pending:
+            self.add_row(json.loads(self.pending))
+            self.pending = ''
+        self.flush()
+        self.writer.close()
+
+
+def read_npz_table(filename):
+    """
+    Read an .npz feature table into a dict of column name to array (int64
+    for integer columns, object arrays of str for text).
+    """
+    with np.load(filename, allow_pickle=False) as data:
+        columns = [entry.split(':') for entry in data[COLUMNS_NAME]]
+        chunk_names = sorted(set(
+            key.split('/')[0] for key in data.files if key.startswith('chunk')
+        ))
+        table = {}
+        for name, kind in columns:
+            chunks = []
+            for chunk in chunk_names:
+                if kind == 'int':
+                    chunks.append(data[chunk + '/' + name])
+                else:
+                    raw = data[chunk + '/' + name + '.data'].tobytes()
+                    offsets = data[chunk + '/' + name + '.offsets']
+                    chunks.append(np.array(
+                        [raw[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])],
+                        dtype=object
+                    ))
+            if chunks:
+                table[name] = np.concatenate(chunks)
+            else:
+                table[name] = np.array([], dtype=np.int64 if kind == 'int' else object)
+    return table
+
+
+def read_feature_table(filename):
+    """
+    Read a feature table written by FeatureTableWriter, in either format, as
+    a pandas DataFrame if pandas is installed, or else a dict of column name
+    to NumPy array.
+    """
+    with open(filename, 'rb') as table_file:
+        is_parquet = table_file.read(4) == b'PAR1'
+    if is_parquet:
+        if pyarrow is None:
+            raise ImportError('reading Parquet files needs pyarrow')
+        table = pyarrow.parquet.read_table(filename)
+        try:
+            return table.to_pandas()
+        except ImportError:
+            return dict((name, table.column(name).to_numpy()) for name in table.column_names)
+
+    table = read_npz_table(filename)
+    try:
+        import pandas
+    except ImportError:
+        return table
+    return pandas.DataFrame(table)
@@ -0,0 +1,49 @@
+import logging
+import argparse
+import localgb
+
+
+parser = argparse.ArgumentParser(
+    description='Fetch genbank records by accession using the index built by build_index.py'
+    )
+parser.add_argument('--output',  help='output file', required=True)
+
+parser.add_argument(
+    "-v", "--verbosity", action="count", help="show lots of debugging output", default=0
+)
+
+parser.add_argument(
+    '--index',
+    default=localgb.INDEX_FILENAME,
+    help='index file to use (default: {})'.format(localgb.INDEX_FILENAME)
+    )
+
+parser.add_argument(
+    '--accessions',
+    nargs='+',
+    default=[],
+    help='space-separated list of accessions (e.g. AB000001) or accession.versions (e.g. AB000001.2) to fetch'
+    )
+
+parser.add_argument(
+    '--accession-file',
+    help='file with one accession or accession.version per line'
+    )
+args = parser.parse_args()
+
+if args.verbosity > 0:
+    logging.basicConfig(level=logging.DEBUG)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+accessions = list(args.accessions)
+if args.accession_file is not None:
+    accessions.extend(line.strip() for line in open(args.accession_file) if line.strip())
+
+record_count = 0
+with open(args.output, 'w') as output_file:
+    for record in localgb.fetch(accessions, args.index):
+        output_file.write(record + '\n//\n')
+        record_count += 1
+
+print('fetched {} records for {} accessions'.format(record_count, len(accessions)))
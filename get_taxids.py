@@ -1,104 +1,95 @@
-import pickle
 import argparse
+import sys
+import taxonomy
 
 
+def get_all_parents(species, directory=taxonomy.TAXONOMY_DIRECTORY):
+    return taxonomy.load(directory).lineage(species)[::-1]
 
 
+def find_lca(species1, species2, directory=taxonomy.TAXONOMY_DIRECTORY):
+    return int(taxonomy.load(directory).lca([species1], [species2])[0])
 
-def get_children(taxon):
-	# print('taxon is ~~' + taxon + '~~')
-	taxon_taxid = name2taxid.get(taxon, 'none')
-	# print(' taxon taxid is ' + str(taxon_taxid))
-	children = parent2child.get(taxon_taxid, [])
-	return [taxid2name[x] for x in children]
-
-def get_children_multiple(taxon, count):
-	current_list = [taxon]
-	while count > 0:
-		new_list = []
-		for current_taxon in current_list:
-			new_list.extend(get_children(current_taxon))
-		current_list = new_list
-		count += -1
-	return new_list
-
-
-def get_parent(taxon):
-	taxon_taxid = name2taxid.get(taxon, 'none')
-	taxon_parent_taxid = taxid2parent.get(taxon_taxid, 'none')
-	return taxid2name.get(taxon_parent_taxid, 'none')
-
-def get_parent_multiple(taxon, count):
-	current_taxon = taxon
-	while count > 0:
-		current_taxon = get_parent(current_taxon)
-		count += -1
-	return current_taxon
-
-def get_siblings(taxon):
-	return filter( lambda x : x != taxon, get_children(get_parent(taxon)))
-
-def get_siblings_multiple(taxon, count):
-	parent = get_parent_multiple(taxon, count)
-	return filter( lambda x : x != taxon, get_children_multiple(parent, count))
-
-# recursive function to get all the children of a given taxid
-def get_children_recursive(taxid):
-    result = []
-    # for all children of this taxid...
-    for child in parent2child[taxid]:
-        # first add the child itself
-        result.append(child)
-        # then if the child has children...
-        if child in parent2child:
-            # add the children of the child
-            # note that we use extend() here rather than append()
-            # extend() is the equivalent of concatenating two lists
-            # if we use append() here then we get a set of nested list which is not what we want!
-            result.extend(get_children_recursive(child))
-    return result
-
-def get_named_children(taxon, rank):
-	print('getting all ' + rank)
-	all_children = get_children_recursive(name2taxid[taxon])
-	return list([taxid2name[child] for child in all_children if taxid2rank[child] == rank])
-
-def get_all_parents(species):
-    result = []
-    current_taxid = species
-    found = False
-    while current_taxid != 1:
-        result.append(current_taxid)
-        parent_taxid = taxid2parent[current_taxid]
-        current_taxid = parent_taxid
-    result.append(1)
-    return result
-
-
-def find_lca(species1, species2):
-    species1_parents = get_all_parents(species1)
-    species2_parents = get_all_parents(species2)
-    for parent in species1_parents:
-        if parent in species2_parents:
-            return parent
-
-
-def find_lca_multiple(list_of_species):
-    # the lca of a single species is itself
-    # so we will set the lca to be the first species
-    current_lca = name2taxid[list_of_species[0]]
-    # now go through the list of species
+
+def taxid_name(names, taxid):
+    """
+    The scientific name of a taxid (or its first name if it hasn't got one).
+    The name index is sorted by name, so this has to scan all of it.
+    """
+    positions = (names.name_taxids == taxid).nonzero()[0]
+    matches = [names.match(i) for i in positions]
+    for match in matches:
+        if match.name_class == 'scientific name':
+            return match.name
+    return matches[0].name if matches else None
+
+
+def find_lca_multiple(list_of_species, directory=taxonomy.TAXONOMY_DIRECTORY):
+    names = taxonomy.load_names(directory)
+    taxids = []
     for species in list_of_species:
-        #set the new lca to the the lca of the current species and the old lca
-        current_lca = find_lca(name2taxid[species], current_lca)
-    return taxid2name[current_lca]
+        matches = names.exact(species)
+        if not matches:
+            raise KeyError(species)
+        scientific = [m for m in matches if m.name_class == 'scientific name']
+        taxids.append((scientific or matches)[0].taxid)
+    return taxid_name(names, int(taxonomy.load(directory).lca_of_sets([taxids])[0]))
+
+
+def lookup_name(names, name, args):
+    if args.fuzzy is not None:
+        return names.fuzzy(name, args.fuzzy)
+    if args.prefix:
+        return names.prefix(name)
+    return names.exact(name)
+
+
+def read_taxid_sets(filename):
+    """
+    Read a file with a set of taxids on each line, separated by spaces, tabs
+    or commas.
+    """
+    with open(filename) as taxid_file:
+        for line in taxid_file:
+            yield [int(taxid) for taxid in line.replace(',', ' ').split()]
+
+
+def known_taxids(tree, taxids):
+    """
+    Leave out (and warn about) taxids that aren't in the taxonomy, e.g. ones
+    that have been merged or deleted since the hits were made.
+    """
+    known = [taxid for taxid in taxids if taxid in tree]
+    if len(known) < len(taxids):
+        print('ignoring taxids not in the taxonomy: {}'.format(
+            ' '.join(str(taxid) for taxid in taxids if taxid not in tree)
+        ), file=sys.stderr)
+    return known
+
+
+def write_lcas(tree, taxid_sets, output_file):
+    taxid_sets = [known_taxids(tree, taxids) for taxids in taxid_sets]
+    non_empty = [taxids for taxids in taxid_sets if taxids]
+    lcas = iter(tree.lca_of_sets(non_empty))
+    for taxids in taxid_sets:
+        # blank lines (or lines with no known taxids) get an LCA of 0 so
+        # that the output lines up with the input
+        lca = next(lcas) if taxids else 0
+        output_file.write('{}\n'.format(lca))
+
+
+def write_lineages(tree, taxids, ranks, output_file):
+    taxids = known_taxids(tree, taxids)
+    output_file.write('taxid\t' + '\t'.join(ranks) + '\n')
+    for taxid, row in zip(taxids, tree.ranked_lineages(taxids, ranks)):
+        output_file.write('{}\t{}\n'.format(taxid, '\t'.join(str(x) for x in row)))
 
 
 parser = argparse.ArgumentParser(
     description='Get lists of taxids from the NCBI taxonomy'
     )
 
-parser.add_argument('--output',  help='output file to write taxids to')
+parser.add_argument('--output',  help='output file to write taxids to (for --lca and --lineage, the default is to print them)')
 
 parser.add_argument(
     '--include',
@@ -117,50 +108,147 @@ parser.add_argument(
 
 parser.add_argument(
     '--lookup',
-    help="a taxon name who's taxid you want to look up. If this option is used the program will just output the taxid(s)"
+    help="a taxon name who's taxid you want to look up (ignoring case). If this option is used the program will just output the taxid(s)"
+    )
+
+parser.add_argument(
+    '--lookup-file',
+    help="file of taxon names (one per line) to look up. Writes the name, taxid and matching name for each match, tab-separated"
+    )
+
+parser.add_argument(
+    '--prefix',
+    action='store_true',
+    help="with --lookup or --lookup-file, find names that start with the given name"
+    )
+
+parser.add_argument(
+    '--fuzzy',
+    type=int,
+    metavar='EDITS',
+    help="with --lookup or --lookup-file, find names within this many typos (inserted, deleted or changed letters) of the given name, closest first"
+    )
+
+parser.add_argument(
+    '--lca',
+    nargs='+',
+    type=int,
+    help="space-separated list of taxids to find the lowest common ancestor of"
+    )
+
+parser.add_argument(
+    '--lca-file',
+    help="file with a set of taxids on each line (separated by spaces or commas). Writes the lowest common ancestor of each line, one per line"
+    )
+
+parser.add_argument(
+    '--lineage',
+    nargs='+',
+    type=int,
+    help="space-separated list of taxids to show the lineage of, as a table with the taxid at each of --ranks (0 if there isn't one)"
+    )
+
+parser.add_argument(
+    '--lineage-file',
+    help="file of taxids (one per line) to show the lineage of, like --lineage"
+    )
+
+parser.add_argument(
+    '--ranks',
+    nargs='+',
+    default=taxonomy.MAIN_RANKS,
+    help="ranks to show with --lineage (default: {})".format(' '.join(taxonomy.MAIN_RANKS))
     )
 
-args = parser.parse_args()
+parser.add_argument(
+    '--taxonomy',
+    default=taxonomy.TAXONOMY_DIRECTORY,
+    help="the directory that update.py built the taxonomy in (default: %(default)s)"
+    )
 
 
-if args.lookup is not None:
-    print('reading names....', end='\r')
-    name2taxid = pickle.load( open( "name2taxid.p", "rb" ) )
-    print('loading taxonomy....done!')
-    taxids = name2taxid.get(args.lookup)
-    if taxids is None:
-        print("Couldn't find a taxid for {}".format(args.lookup))
-    elif len(taxids) > 1:
-        print("Found multiple taxids for that name:")
-        print('\n'.join(taxids))
+
+def main(args):
+    """
+    Do whatever the parsed arguments ask for. This is also what serve.py runs
+    for each get_taxids request it gets.
+    """
+    if args.lookup is not None:
+        names = taxonomy.load_names(args.taxonomy)
+        matches = lookup_name(names, args.lookup, args)
+        if not matches:
+            print("Couldn't find a taxid for {}".format(args.lookup))
+            if args.fuzzy is None:
+                suggestions = names.fuzzy(args.lookup, 2, limit=5)
+                if suggestions:
+                    suggested_names = []
+                    for match in suggestions:
+                        if match.name not in suggested_names:
+                            suggested_names.append(match.name)
+                    print('Did you mean: {}?'.format(', '.join(suggested_names)))
+        elif args.prefix or args.fuzzy is not None:
+            for match in matches:
+                print('{}\t{}\t{}'.format(match.taxid, match.name, match.name_class))
+        elif len(matches) > 1:
+            print("Found multiple taxids for that name:")
+            print('\n'.join(str(match.taxid) for match in matches))
+        else:
+            print(matches[0].taxid)
+
+    elif args.lookup_file is not None:
+        names = taxonomy.load_names(args.taxonomy)
+        output_file = open(args.output, 'wt') if args.output else sys.stdout
+        with open(args.lookup_file) as lookup_file:
+            for line in lookup_file:
+                name = line.strip()
+                if not name:
+                    continue
+                matches = lookup_name(names, name, args)
+                if not matches:
+                    print("Couldn't find a taxid for {}".format(name), file=sys.stderr)
+                for match in matches:
+                    output_file.write('{}\t{}\t{}\n'.format(name, match.taxid, match.name))
+        if args.output:
+            output_file.close()
+
+    elif args.lca or args.lca_file or args.lineage or args.lineage_file:
+        tree = taxonomy.load(args.taxonomy)
+        output_file = open(args.output, 'wt') if args.output else sys.stdout
+        if args.lca:
+            write_lcas(tree, [args.lca], output_file)
+        if args.lca_file:
+            write_lcas(tree, list(read_taxid_sets(args.lca_file)), output_file)
+        if args.lineage:
+            write_lineages(tree, args.lineage, args.ranks, output_file)
+        if args.lineage_file:
+            taxids = [taxid for taxids in read_taxid_sets(args.lineage_file) for taxid in taxids]
+            write_lineages(tree, taxids, args.ranks, output_file)
+        if args.output:
+            output_file.close()
+
     else:
-        print(taxids[0])
-
-else:
-    selected_taxids = set()
-    print('reading nodes....', end='\r')
-    parent2child = pickle.load( open( "parent2child.p", "rb" ) )
-    print('reading nodes....done')
-
-    for include_taxid in args.include:
-        selected_taxids = selected_taxids.union(get_children_recursive(include_taxid))
-        print('after adding children of {} we have {} taxids'.format(
-            include_taxid, len(selected_taxids)
+        print('reading nodes....', end='\r')
+        tree = taxonomy.load(args.taxonomy)
+        print('reading nodes....done')
+        selected_taxids = tree.selection()
+
+        for include_taxid in args.include:
+            selected_taxids.include(include_taxid)
+            print('after adding children of {} we have {} taxids'.format(
+                include_taxid, len(selected_taxids)
+            ))
+
+        for exclude_taxid in args.exclude:
+            selected_taxids.exclude(exclude_taxid)
+            print('after removing children of {} we have {} taxids'.format(
+                exclude_taxid, len(selected_taxids)
+            ))
+        with open(args.output, 'wt') as output_file:
+            output_file.write(''.join('{}\n'.format(taxid) for taxid in selected_taxids.taxids()))
+        print('wrote {} taxids to {}'.format(
+            len(selected_taxids), args.output
         ))
 
-    for exclude_taxid in args.exclude:
-        selected_taxids = selected_taxids.difference(get_children_recursive(exclude_taxid))
-        print('after removing children of {} we have {} taxids'.format(
-            exclude_taxid, len(selected_taxids)
-        ))
-    with open(args.output, 'wt') as output_file:
-        for taxid in selected_taxids:
-            output_file.write('{}\n'.format(taxid))
-    print('wrote {} taxids to {}'.format(
-        len(selected_taxids), args.output
-    ))
-
-# taxid2name = pickle.load( open( "taxid2name.p", "rb" ) )
-# taxid2rank = pickle.load( open( "taxid2rank.p", "rb" ) )
-# taxid2parent = pickle.load( open( "taxid2parent.p", "rb" ) )
-# parent2child = pickle.load( open( "parent2child.p", "rb" ) )
+
+if __name__ == '__main__':
+    main(parser.parse_args())
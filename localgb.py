@@ -1,21 +1,70 @@
 from ftplib import FTP
+import ftplib
 from io import StringIO
 from tqdm import tqdm
 import os
 import logging
-import tarfile
-import pickle
-import collections
 import time
 from Bio import SeqIO
 import re
 import gzip
+import multiprocessing
+import tempfile
+import shutil
+import sqlite3
+import itertools
+import mmap
+import threading
+import argparse
+import hashlib
+import json
+import queue
+import signal
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import bgzf
+import resultcache
 
+# where to download from; update.py can point these at a mirror or a local
+# test server
+FTP_HOST = 'ftp.ncbi.nlm.nih.gov'
+FTP_PORT = 21
+FTP_TIMEOUT = 120
 
-def need_to_update_release():
-    ftp = FTP('ftp.ncbi.nlm.nih.gov')
+# how many times to reconnect and carry on with a file before giving up
+DOWNLOAD_RETRIES = 3
+
+PARTIAL_SUFFIX = '.part'
+RELEASE_NUMBER_FILENAME = 'GB_Release_Number'
+
+
+def connect(directory):
+    ftp = FTP()
+    ftp.connect(FTP_HOST, FTP_PORT, timeout=FTP_TIMEOUT)
     ftp.login()
-    ftp.cwd('genbank')
+    ftp.cwd(directory)
+    return ftp
+
+
+def confirm(message, assume_yes=False):
+    """
+    Give the user a chance to cancel, unless we're running unattended.
+    """
+    if assume_yes:
+        logging.info(message)
+        return
+    logging.info(message + ', hit enter to continue or Ctrl+C to cancel...')
+    input()
+
+
+def get_release_number(ftp):
+    latest_release_file = StringIO()
+    ftp.retrlines('RETR ' + RELEASE_NUMBER_FILENAME, latest_release_file.write)
+    return int(latest_release_file.getvalue())
+
+
+def need_to_update_release():
+    ftp = connect('genbank')
 
     """
     Check whether the user currently has the latest GB release (in which case
@@ -23,7 +72,7 @@ def need_to_update_release():
     release or no release, in which case we need to download everything)
     """
     try:
-        current_release_number = int(open('GB_Release_Number').read())
+        current_release_number = int(open(RELEASE_NUMBER_FILENAME).read())
         logging.info(
             'You currently have GB release number {}'
             .format(current_release_number)
@@ -33,9 +82,8 @@ def need_to_update_release():
         logging.info('No current release, downloading the files')
         return True
 
-    latest_release_file = StringIO()
-    ftp.retrlines('RETR GB_Release_Number', latest_release_file.write)
-    latest_release_number = int(latest_release_file.getvalue())
+    latest_release_number = get_release_number(ftp)
+    ftp.quit()
     logging.info('Latest release number is {}'.format(latest_release_number))
 
     if current_release_number == latest_release_number:
@@ -46,134 +94,253 @@ def need_to_update_release():
         return True
 
 
-def get_daily_updates():
-    ftp = FTP('ftp.ncbi.nlm.nih.gov')
-    ftp.login()
-    ftp.cwd('genbank')
+def release_download_in_progress():
+    """
+    Check whether a previous run started downloading the latest release and
+    didn't finish, in which case the files it already got can be kept.
+    """
+    try:
+        started_release_number = int(open(RELEASE_NUMBER_FILENAME + PARTIAL_SUFFIX).read())
+    except (IOError, ValueError):
+        return False
+    ftp = connect('genbank')
+    latest_release_number = get_release_number(ftp)
+    ftp.quit()
+    return started_release_number == latest_release_number
 
-    ftp.cwd('daily-nc')
+
+def get_daily_updates(connections=1, assume_yes=False):
+    ftp = connect('genbank/daily-nc')
 
     files_to_download = []
     for filename, file_info in ftp.mlsd():
         if filename.startswith('nc') and filename.endswith('.flat.gz'):
             logging.debug('checking ' + filename)
-            if os.path.exists(filename):
+            if already_downloaded(filename, file_info):
                 logging.debug("already got {}".format(filename))
             else:
                 files_to_download.append((filename, file_info))
-    total_size = sum([int(f[1]['size']) for f in files_to_download])
-    if total_size > 0:
-        logging.info(
-            'about to download {} MB, hit enter to continue or Ctrl+C to cancel...'
-            .format(round(total_size / 10 ** 6))
-            )
-        input()
-        with tqdm(
-            files_to_download,
-            unit='files',
-            desc='Downloading {} files'.format(len(files_to_download))
-        ) as file_pbar:
-            for f in file_pbar:
-                download(f, ftp)
-
-def build_ncbi_names_dicts():
-    names = open("names.dmp")
-    name2taxid = collections.defaultdict(list)
-    taxid2name = {}
-
-    for line in names:
-        taxid, name, other_name, type = line.rstrip('\t|\n').split("\t|\t")
-        name2taxid[name].append(taxid)
-        if type == 'scientific name':
-            taxid2name[int(taxid)] = name
-
-    pickle.dump( name2taxid, open( "name2taxid.p", "wb" ) )
-    pickle.dump( taxid2name, open( "taxid2name.p", "wb" ) )
-
-def build_ncbi_nodes_dicts():
-    taxid2rank = {}
-    taxid2parent = {}
-
-    #store parent to child relationships
-    parent2child = {}
-
-    processed = 0
-    nodes = open("nodes.dmp")
-    for line in nodes:
-        taxid, parent, rank = line.rstrip('\t|\n').split("\t|\t")[0:3]
-        taxid = int(taxid)
-        parent = int(parent)
-        taxid2rank[int(taxid)] = rank
-        taxid2parent[int(taxid)] = int(parent)
-        if parent not in parent2child:
-            parent2child[parent] = []
-        parent2child[parent].append(taxid)
-
-    pickle.dump( taxid2rank, open( "taxid2rank.p", "wb" ) )
-    pickle.dump( taxid2parent, open( "taxid2parent.p", "wb" ) )
-    pickle.dump( parent2child, open( "parent2child.p", "wb" ) )
-
-
-def get_taxdump():
-    logging.debug('starting download taxdump')
-    logging.info('downloading taxonomy dump...')
-    ftp = FTP('ftp.ncbi.nlm.nih.gov')
-    ftp.login()
-    ftp.cwd('/pub/taxonomy')
+    ftp.quit()
+    total_size = sum([remaining_size(f) for f in files_to_download])
+    if files_to_download:
+        confirm(
+            'about to download {} MB'.format(round(total_size / 10 ** 6)),
+            assume_yes
+        )
+        download_files(files_to_download, 'genbank/daily-nc', connections)
 
-    for filename, file_info in ftp.mlsd():
-        if filename == 'taxdump.tar.gz':
-            download((filename, file_info), ftp)
+TAXDUMP_FILENAME = 'taxdump.tar.gz'
+# the size and modification time on the server of the taxonomy dump that the
+# taxonomy directory was built from
+TAXDUMP_INFO_FILENAME = TAXDUMP_FILENAME + '.info'
 
-    with tqdm(total=3, desc='extracting files from taxdump') as pbar:
-        logging.debug('extracting files from taxdump')
-        tar = tarfile.open('taxdump.tar.gz', 'r:gz')
-        tar.extractall()
-        tar.close()
-        pbar.set_description('reading names from taxonomy')
-        pbar.update(1)
-        logging.debug('finishing download taxdump')
-        logging.debug('building NCBI dicts')
 
+def build_taxonomy():
+    """
+    Build the memory-mapped taxonomy (see taxonomy.py) that get_taxids.py
+    uses from the taxonomy dump, if we have numpy.
+    """
+    try:
+        import taxonomy
+    except ImportError:
+        logging.warning('numpy is not installed, so get_taxids.py will not work')
+        return False
+    taxonomy.build_from_taxdump(TAXDUMP_FILENAME)
+    return True
 
-        build_ncbi_names_dicts()
-        pbar.set_description('reading nodes from taxonomy')
-        pbar.update(1)
 
+def taxdump_signature(file_info):
+    return '{} {}\n'.format(file_info.get('size'), file_info.get('modify'))
 
-        build_ncbi_nodes_dicts()
 
-        pbar.update(1)
+def taxdump_unchanged(file_info):
+    """
+    Check whether the taxonomy dump on the server is the one we built the
+    taxonomy from last time. Without numpy we never have a taxonomy, so the
+    dump always counts as changed.
+    """
+    try:
+        import taxonomy
+    except ImportError:
+        return False
+    try:
+        built_from = open(TAXDUMP_INFO_FILENAME).read()
+    except IOError:
+        return False
+    return (
+        built_from == taxdump_signature(file_info)
+        and already_downloaded(TAXDUMP_FILENAME, file_info)
+        and os.path.exists(taxonomy.TAXONOMY_DIRECTORY)
+    )
 
 
+def get_taxdump(force=False):
+    """
+    Download the taxonomy dump and build the taxonomy from it, unless the
+    dump on the server hasn't changed since last time.
+    """
+    ftp = connect('/pub/taxonomy')
+    file_info = dict(ftp.mlsd()).get(TAXDUMP_FILENAME)
+    if file_info is None:
+        ftp.quit()
+        raise IOError("couldn't find {} on the server".format(TAXDUMP_FILENAME))
 
+    if not force and taxdump_unchanged(file_info):
+        ftp.quit()
+        logging.info('taxonomy dump has not changed')
+        return
+
+    logging.info('downloading taxonomy dump...')
+    if os.path.exists(TAXDUMP_INFO_FILENAME):
+        os.remove(TAXDUMP_INFO_FILENAME)
+    # the old copy would look complete if the new one is the same size
+    if os.path.exists(TAXDUMP_FILENAME):
+        os.remove(TAXDUMP_FILENAME)
+    download((TAXDUMP_FILENAME, file_info), ftp)
+    ftp.quit()
 
+    logging.info('building taxonomy...')
+    if build_taxonomy():
+        with open(TAXDUMP_INFO_FILENAME, 'w') as info_file:
+            info_file.write(taxdump_signature(file_info))
 
-def download(myfile, ftp):
+
+def already_downloaded(filename, file_info):
+    """
+    Check whether we have all of a file. A file that has been converted to
+    BGZF is a different size to the one on the server, but we only ever
+    convert complete files.
+    """
+    if not os.path.exists(filename):
+        return False
+    if bgzf.is_bgzf(filename) or 'size' not in file_info:
+        return True
+    return os.path.getsize(filename) == int(file_info['size'])
+
+
+def remaining_size(myfile):
+    filename, file_info = myfile
+    partial_filename = filename + PARTIAL_SUFFIX
+    if os.path.exists(partial_filename):
+        return max(int(file_info['size']) - os.path.getsize(partial_filename), 0)
+    return int(file_info['size'])
+
+
+def download(myfile, ftp, pbar=None):
     """
     Download myfile from the given ftp connection and draw a progress bar while
     doing it. myfile is a tuple of (filename, file_info) as returned by
     ftp.mlsd().
+
+    The data goes into filename.part, which is only renamed to filename once
+    it is the size that the server says it should be. If filename.part is
+    already there from an interrupted download, we carry on from the end of
+    it. If pbar is given, progress is added to it instead of drawing a new
+    bar.
     """
     filename, file_info = myfile
-    with tqdm(
-                total=int(file_info['size']),
-                desc=filename,
-                unit='bytes',
-                unit_scale=True,
-                leave=False
-              ) as pbar:
-        with open(filename, 'wb') as output:
-            def handle_block(block):
-                pbar.update(len(block))
-                output.write(block)
-            ftp.retrbinary('RETR ' + filename, handle_block)
-
-
-def do_update_release(divisions):
-    ftp = FTP('ftp.ncbi.nlm.nih.gov')
-    ftp.login()
-    ftp.cwd('genbank')
+    partial_filename = filename + PARTIAL_SUFFIX
+    expected_size = int(file_info['size']) if 'size' in file_info else None
+
+    offset = 0
+    if os.path.exists(partial_filename):
+        offset = os.path.getsize(partial_filename)
+        if expected_size is None or offset > expected_size:
+            # can't trust it, so start again
+            offset = 0
+        elif offset > 0:
+            logging.debug('resuming {} from byte {}'.format(filename, offset))
+
+    own_pbar = pbar is None
+    if own_pbar:
+        pbar = tqdm(
+            total=expected_size,
+            initial=offset,
+            desc=filename,
+            unit='bytes',
+            unit_scale=True,
+            leave=False
+        )
+    try:
+        with open(partial_filename, 'r+b' if offset else 'wb') as output:
+            output.seek(offset)
+            output.truncate()
+            if expected_size is None or offset < expected_size:
+                def handle_block(block):
+                    pbar.update(len(block))
+                    output.write(block)
+                ftp.retrbinary('RETR ' + filename, handle_block, rest=offset or None)
+    finally:
+        if own_pbar:
+            pbar.close()
+
+    size = os.path.getsize(partial_filename)
+    if expected_size is not None and size != expected_size:
+        raise IOError(
+            'downloaded {} bytes of {} but expected {}'.format(size, filename, expected_size)
+        )
+    os.replace(partial_filename, filename)
+
+
+def download_files(files_to_download, directory, connections=1):
+    """
+    Download a list of (filename, file_info) tuples from directory on the
+    server, using up to connections connections at once. If a connection
+    drops, we reconnect and carry on from where the file got to.
+    """
+    local = threading.local()
+    open_connections = []
+    lock = threading.Lock()
+
+    def get_connection():
+        if getattr(local, 'ftp', None) is None:
+            local.ftp = connect(directory)
+            with lock:
+                open_connections.append(local.ftp)
+        return local.ftp
+
+    def drop_connection():
+        with lock:
+            open_connections.remove(local.ftp)
+        try:
+            local.ftp.close()
+        except ftplib.all_errors:
+            pass
+        local.ftp = None
+
+    def download_with_retries(myfile):
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                download(myfile, get_connection(), bytes_pbar)
+                return myfile
+            except ftplib.all_errors as e:
+                if attempt == DOWNLOAD_RETRIES:
+                    raise
+                logging.warning('error downloading {}: {}, retrying'.format(myfile[0], e))
+                drop_connection()
+
+    total_size = sum(remaining_size(f) for f in files_to_download)
+    try:
+        with tqdm(
+            total=total_size,
+            desc='Downloading {} files'.format(len(files_to_download)),
+            unit='bytes',
+            unit_scale=True
+        ) as bytes_pbar:
+            with ThreadPoolExecutor(max(connections, 1)) as executor:
+                for filename, file_info in executor.map(download_with_retries, files_to_download):
+                    logging.debug('downloaded {}'.format(filename))
+    finally:
+        # including when a file couldn't be downloaded
+        for ftp in open_connections:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+
+def do_update_release(divisions, connections=1, assume_yes=False):
+    ftp = connect('genbank')
 
     logging.debug('looking for divisions: {}'.format(divisions))
     files_to_download = []
@@ -183,34 +350,67 @@ def do_update_release(divisions):
             filename.startswith('gb')
             and file_division.upper() in divisions
         ):
-            files_to_download.append((filename, file_info))
+            if already_downloaded(filename, file_info):
+                logging.debug("already got {}".format(filename))
+            else:
+                files_to_download.append((filename, file_info))
 
-    total_size = sum([int(f[1]['size']) for f in files_to_download])
-    logging.info(
-        'about to download {} MB, hit enter to continue or Ctrl+C to cancel...'
-        .format(round(total_size / 10 ** 6))
-        )
-    input()
-    with tqdm(
-        files_to_download,
-        unit='files',
-        desc='Downloading {} files'.format(len(files_to_download))
-    ) as file_pbar:
-        for f in file_pbar:
-            download(f, ftp)
+    # remember which release we're getting, so that if we're interrupted the
+    # next run can carry on instead of starting again
+    release_number = get_release_number(ftp)
+    ftp.quit()
+    with open(RELEASE_NUMBER_FILENAME + PARTIAL_SUFFIX, 'w') as output:
+        output.write('{}\n'.format(release_number))
 
-    with open('GB_Release_Number', 'wb') as output:
-        ftp.retrbinary('RETR GB_Release_Number', output.write)
+    total_size = sum([remaining_size(f) for f in files_to_download])
+    confirm(
+        'about to download {} MB'.format(round(total_size / 10 ** 6)),
+        assume_yes
+    )
+    download_files(files_to_download, 'genbank', connections)
 
+    os.replace(RELEASE_NUMBER_FILENAME + PARTIAL_SUFFIX, RELEASE_NUMBER_FILENAME)
 
-def delete_old_files():
-    logging.info('Warning, about to delete files from your old release')
-    logging.info('Hit enter to continue or Ctrl+C to cancel...')
-    input()
+
+def delete_old_files(assume_yes=False):
+    confirm('Warning, about to delete files from your old release', assume_yes)
     for filename in os.listdir('.'):
-        if filename.endswith('.gz'):
+        if (
+            filename.endswith('.gz') or filename.endswith('.gz.gzi')
+            or filename.endswith('.gz' + PARTIAL_SUFFIX)
+            # cached counts from dump_features.py
+            or filename.endswith('.gz.features.json')
+            or filename == RELEASE_NUMBER_FILENAME + PARTIAL_SUFFIX
+        ):
             os.remove(filename)
 
+
+def convert_to_bgzf(filenames, workers=None):
+    """
+    Recompress downloaded files as BGZF (see bgzf.py) so that they can be read
+    from any position and split between workers. Files that have already been
+    converted are skipped.
+    """
+    filenames = [f for f in filenames if not bgzf.is_bgzf(f)]
+    if not filenames:
+        return
+    pool = multiprocessing.Pool(workers)
+    with tqdm(
+        total=len(filenames),
+        unit='files',
+        desc='Converting {} files to BGZF'.format(len(filenames))
+    ) as file_pbar:
+        for filename in pool.imap_unordered(convert_file_to_bgzf, filenames):
+            logging.debug('converted {} to BGZF'.format(filename))
+            file_pbar.update(1)
+    pool.close()
+    pool.join()
+
+
+def convert_file_to_bgzf(filename):
+    bgzf.convert(filename)
+    return filename
+
 def delimited(file, delimiter='\n', bufsize=4096):
     buf = ''
     while True:
@@ -224,161 +424,2826 @@ def delimited(file, delimiter='\n', bufsize=4096):
             yield line
         buf = lines[-1]
 
-def long_substr(data):
-    if len(data) == 1:
-        return data[0]
-    substr = ''
-    if len(data) > 1 and len(data[0]) > 0:
-        for i in range(len(data[0])):
-            for j in range(len(data[0])-i+1):
-                if j > len(substr) and all(data[0][i:i+j] in x for x in data):
-                    substr = data[0][i:i+j]
-    return substr
+class UnsupportedRecord(Exception):
+    """
+    Raised by LazyRecord for anything it doesn't know how to deal with, in
+    which case we fall back to parsing the record with Biopython.
+    """
 
-def process_record(record, args, output_file):
-    global matching_record_count
-    global matching_feature_count
+
+class Feature(object):
+    """
+    A feature from the feature table of a record: just the type, the location
+    as a string (e.g. "complement(join(1..10,20..30))") and a dict of
+    qualifiers, where each qualifier has a list of values like in Biopython.
+    """
+    __slots__ = ('type', 'location', 'qualifiers')
+
+    def __init__(self, type, location, qualifiers):
+        self.type = type
+        self.location = location
+        self.qualifiers = qualifiers
+
+    def __str__(self):
+        lines = ['type: {}'.format(self.type), 'location: {}'.format(self.location), 'qualifiers:']
+        for key, values in sorted(self.qualifiers.items()):
+            lines.append('    Key: {}, Value: {}'.format(key, values))
+        return '\n'.join(lines) + '\n'
 
 
+record_id_res = [
+    re.compile(r'^VERSION +(\S+)', re.MULTILINE),
+    re.compile(r'^ACCESSION +(\S+)', re.MULTILINE),
+    re.compile(r'^LOCUS +(\S+)', re.MULTILINE),
+]
+taxid_text_re = re.compile(r'/db_xref="taxon:(\d+)"')
+simple_location_re = re.compile(r'[<>]?(\d+)(?:(\.\.|\^)[<>]?(\d+))?')
 
-    keep_record = False
+# delete line numbers and whitespace from ORIGIN lines
+sequence_junk = str.maketrans('', '', '0123456789 \n\t\r')
 
-    # if the quick test fails, we don't want this record
-    if longest_substring not in record.lower():
+# the same as Biopython, including the ambiguity codes
+complement_table = str.maketrans(
+    'ACGTUMRWSYKVHDBXNacgtumrwsykvhdbxn',
+    'TGCAAKYWSRMBDHVXNtgcaakywsrmbdhvxn'
+)
+
+
+class LazyRecord(object):
+    """
+    A genbank record that only parses as much as it needs to. The feature
+    table is parsed into Feature objects the first time that features is used,
+    and the sequence is only read from the ORIGIN section if we extract a
+    feature. This is a lot quicker than parsing the whole record with
+    SeqIO.read, but only handles normal records; anything odd raises
+    UnsupportedRecord. If a sequence_store is given and the record is in it,
+    features are extracted from there instead of from ORIGIN.
+    """
+    __slots__ = ('text', 'sequence_store', '_id', '_features', '_sequence')
+
+    def __init__(self, text, sequence_store=None):
+        self.text = text
+        self.sequence_store = sequence_store
+        self._id = None
+        self._features = None
+        self._sequence = None
+
+    @property
+    def id(self):
+        if self._id is None:
+            # the same as Biopython: accession.version if there is one, then
+            # the accession, then the LOCUS name
+            header_end = self.text.find('\nFEATURES ')
+            if header_end == -1:
+                header_end = len(self.text)
+            for regex in record_id_res:
+                match = regex.search(self.text, 0, header_end)
+                if match:
+                    self._id = match.group(1)
+                    break
+            else:
+                raise UnsupportedRecord('no LOCUS, ACCESSION or VERSION')
+        return self._id
+
+    @property
+    def features(self):
+        if self._features is None:
+            self._features = []
+            for feature_type, location, qualifier_list in parse_feature_table(self.text):
+                qualifiers = {}
+                for key, value in qualifier_list:
+                    if key in qualifiers:
+                        # Biopython only keeps the first of valueless keys
+                        # like /pseudo
+                        if value or qualifiers[key] != ['']:
+                            qualifiers[key].append(value)
+                    else:
+                        qualifiers[key] = [value]
+                self._features.append(Feature(feature_type, location, qualifiers))
+        return self._features
+
+    @property
+    def sequence(self):
+        if self._sequence is None:
+            origin_start = self.text.find('\nORIGIN')
+            if origin_start == -1:
+                raise UnsupportedRecord('no ORIGIN')
+            sequence_start = self.text.find('\n', origin_start + 1)
+            if sequence_start == -1:
+                raise UnsupportedRecord('no sequence after ORIGIN')
+            # Biopython upper cases the sequence too
+            self._sequence = self.text[sequence_start:].translate(sequence_junk).upper()
+        return self._sequence
+
+    def extract(self, feature):
+        """
+        Return the sequence of a feature as a string, in the same way as
+        str(feature.extract(record).seq) does in Biopython.
+        """
+        if self.sequence_store is not None and self.id in self.sequence_store:
+            def get_range(start, end):
+                return self.sequence_store.extract(self.id, start, end)
+        else:
+            sequence = self.sequence
+
+            def get_range(start, end):
+                return sequence[start:end]
+
+        parts = []
+        for start, end, strand in parse_location(feature.location):
+            if strand == -1:
+                parts.append(get_range(start, end).translate(complement_table)[::-1])
+            else:
+                parts.append(get_range(start, end))
+        return ''.join(parts)
+
+
+def parse_location(location):
+    """
+    Turn a location string into a list of (start, end, strand) tuples with
+    Python style coordinates, in the order that they should be joined.
+    """
+    location = ''.join(location.split())
+    parts, position = parse_location_part(location, 0)
+    if position != len(location):
+        raise UnsupportedRecord('unexpected location {}'.format(location))
+    return parts
+
+
+def parse_location_part(location, position):
+    for operator in ('complement(', 'join(', 'order('):
+        if location.startswith(operator, position):
+            position += len(operator)
+            items = []
+            while True:
+                item, position = parse_location_part(location, position)
+                items.append(item)
+                if location[position:position + 1] == ',':
+                    position += 1
+                elif location[position:position + 1] == ')':
+                    position += 1
+                    break
+                else:
+                    raise UnsupportedRecord('unexpected location {}'.format(location))
+            if operator == 'complement(':
+                if len(items) != 1:
+                    raise UnsupportedRecord('unexpected location {}'.format(location))
+                return [(start, end, -strand) for start, end, strand in reversed(items[0])], position
+            return [part for item in items for part in item], position
+
+    # anything else, like references to other records, is left to Biopython
+    match = simple_location_re.match(location, position)
+    if match is None:
+        raise UnsupportedRecord('unexpected location {}'.format(location))
+    start, separator, end = match.groups()
+    start = int(start)
+    if separator is None:
+        return [(start - 1, start, 1)], match.end()
+    end = int(end)
+    if separator == '^':
+        if end != start + 1:
+            raise UnsupportedRecord('unexpected location {}'.format(location))
+        return [(start, start, 1)], match.end()
+    if end < start:
+        raise UnsupportedRecord('unexpected location {}'.format(location))
+    return [(start - 1, end, 1)], match.end()
+
+
+class BiopythonRecord(object):
+    """
+    A record parsed by Biopython, with the same interface as LazyRecord.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.record = SeqIO.read(StringIO(text), format='gb')
+        self.id = self.record.id
+        self.features = self.record.features
+
+    def extract(self, feature):
+        return str(feature.extract(self.record).seq)
+
+
+def parse_feature_table(record):
+    """
+    Yield (type, location, qualifiers) for each feature in a record, where
+    qualifiers is a list of (key, value) tuples. Values are cleaned up the same
+    way that Biopython does it: quotes are removed, continuation lines are
+    joined with spaces (except for translations, which are joined with
+    nothing) and qualifiers without a value like /pseudo get an empty string.
+    """
+    start = record.find('\nFEATURES ')
+    if start == -1:
+        return
+    end = len(record)
+    for marker in ('\nORIGIN', '\nCONTIG', '\nBASE COUNT'):
+        marker_start = record.find(marker, start)
+        if marker_start != -1 and marker_start < end:
+            end = marker_start
+
+    feature_type = None
+    location = None
+    qualifiers = []
+    key = None
+    value_lines = None
+    # the number of quotes in the value so far: it's finished when this is
+    # even, since escaped quotes ("") come in pairs
+    quote_count = 0
+
+    # the first line is the empty string before the newline, the second is the
+    # FEATURES line itself
+    for line in record[start:end].split('\n')[2:]:
+        if value_lines is not None:
+            # inside a quoted value that spans several lines
+            value_lines.append(line.strip())
+            quote_count += value_lines[-1].count('"')
+            if quote_count % 2 == 0:
+                qualifiers.append((key, clean_qualifier_value(key, value_lines)))
+                value_lines = None
+            continue
+
+        if line[:5] == '     ' and line[5:6] not in (' ', ''):
+            # a new feature
+            if feature_type is not None:
+                yield feature_type, location, qualifiers
+            feature_type, _, location = line.strip().partition(' ')
+            location = location.strip()
+            qualifiers = []
+            key = None
+        elif line[21:22] == '/' and line[:21].strip() == '':
+            key, equals, value = line[22:].rstrip().partition('=')
+            if not equals:
+                qualifiers.append((key, ''))
+            elif value.startswith('"') and value.count('"') % 2 == 1:
+                value_lines = [value]
+                quote_count = value.count('"')
+            else:
+                qualifiers.append((key, clean_qualifier_value(key, [value])))
+        elif feature_type is not None and line.strip():
+            if key is None:
+                # location that wraps onto several lines
+                location += line.strip()
+            elif qualifiers:
+                # continuation of an unquoted value
+                qualifiers[-1] = (key, qualifiers[-1][1] + ' ' + line.strip())
+
+    if feature_type is not None:
+        yield feature_type, location, qualifiers
+
+
+def clean_qualifier_value(key, value_lines):
+    if key == 'translation':
+        value = ''.join(''.join(value_lines).split())
+    else:
+        value = ' '.join(value_lines)
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        value = value[1:-1]
+    return value.replace('""', '"')
+
+
+def process_record(record, queries, output_files, sequence_store=None, stats=None):
+    """
+    Run queries that the record has passed the prefilter for, writing what
+    each one finds to the matching output file. However many queries there
+    are, the record is only parsed once. Features are extracted from
+    sequence_store if it's given and has the record. If stats (a SearchStats)
+    is given, how long each step took is added to it.
+    """
+    if stats is not None:
+        start = time.perf_counter()
+
+    taxid = None
+    wanted = []
+    for query, output_file in zip(queries, output_files):
+        if query.taxid_set is not None:
+            # check if we want to allow this taxid
+            if taxid is None:
+                taxid = record_taxid_text(record)
+            if taxid not in query.taxid_set:
+                logging.debug('taxid {} not in taxids file'.format(taxid))
+                continue
+        wanted.append((query, output_file))
+
+    if stats is not None:
+        stats.seconds['taxid_filter'] += time.perf_counter() - start
+        if not wanted:
+            stats.counts['taxid_rejected'] += 1
+    if not wanted:
         return None
 
-    if taxid_set is not None:
-        # check if we want to allow this taxid
-        taxid_match = re.search('/db_xref="taxon:(\d+)"', record)
-        taxid = taxid_match.group(1)
-        if taxid not in taxid_set:
-            logging.debug('taxid {} not in taxids file'.format(taxid))
-            return None
+    # if we get this far, we want to parse the record properly. Try the quick
+    # parser first, and only use Biopython if it can't handle the record
+    try:
+        if stats is not None:
+            start = time.perf_counter()
+            parsed_record = LazyRecord(record, sequence_store)
+            parsed_record.features
+            stats.seconds['parse'] += time.perf_counter() - start
+            stats.counts['parsed'] += 1
+            start = time.perf_counter()
+        else:
+            parsed_record = LazyRecord(record, sequence_store)
+        results = [process_features(parsed_record, query) for query, output_file in wanted]
+    except UnsupportedRecord as e:
+        logging.debug('parsing record with Biopython: {}'.format(e))
+        if stats is not None:
+            start = time.perf_counter()
+            parsed_record = BiopythonRecord(record)
+            stats.seconds['biopython_parse'] += time.perf_counter() - start
+            stats.counts['biopython_parsed'] += 1
+            start = time.perf_counter()
+        else:
+            parsed_record = BiopythonRecord(record)
+        results = [process_features(parsed_record, query) for query, output_file in wanted]
+
+    if stats is not None:
+        # finding the matching features is quick once the record is parsed,
+        # so this is nearly all extracting sequences and translations
+        stats.seconds['extract'] += time.perf_counter() - start
+        start = time.perf_counter()
+
+    output_size = 0
+    for (query, output_file), (output, feature_count) in zip(wanted, results):
+        output_file.writelines(output)
+
+        if feature_count > 0:
+            query.matching_feature_count += feature_count
+            query.matching_record_count += 1
+            if query.dump_genbank:
+                output_file.write(record + '\n//\n')
+                output_size += len(record) + 4
+        if stats is not None:
+            output_size += sum(len(line) for line in output)
+            stats.counts['features_matched'] += feature_count
+            stats.counts['records_matched'] += feature_count > 0
+
+    if stats is not None:
+        stats.seconds['write'] += time.perf_counter() - start
+        stats.counts['output_bytes'] += output_size
+
+
+def record_taxid_text(record):
+    """
+    The taxid of a record (as a string) from the first taxon db_xref in its
+    text, or None if it doesn't have one.
+    """
+    taxid_match = taxid_text_re.search(record)
+    return taxid_match.group(1) if taxid_match else None
+
 
-    # if we get this far, we want to parse the record properly
-    real_record = SeqIO.read(StringIO(record), format='gb')
-    for f in real_record.features:
-        keep_feature = False
+def matching_features(parsed_record, args):
+    """
+    Yield the features in a LazyRecord or BiopythonRecord that match the query
+    (a Query, or the arguments of query.py).
+    """
+    for f in parsed_record.features:
         if f.type == args.type:
             if args.qualifier is None:
-                keep_feature = True
+                yield f
 
             elif args.qualifier in f.qualifiers and args.terms is None:
-                keep_feature=True
+                yield f
 
             elif args.qualifier in f.qualifiers and f.qualifiers[args.qualifier][0].lower() in args.terms:
-                keep_feature = True
+                yield f
+
 
-        if keep_feature:
-            matching_feature_count += 1
-            keep_record = True
+def process_features(parsed_record, args):
+    """
+    Find the features in a LazyRecord or BiopythonRecord that match the query
+    (a Query, or the arguments of query.py). Returns a list of strings to write to the output and the number of
+    matching features.
+    """
+    output = []
+    feature_count = 0
+
+    for f in matching_features(parsed_record, args):
+        feature_count += 1
+        try:
+            if args.fasta_features:
+                output.append('>{}\n{}\n'.format(
+                    parsed_record.id,
+                    parsed_record.extract(f)
+                ))
+        except ValueError:
+            logging.debug("Couldn't extract feature from record {}".format(parsed_record.id))
+
+        if args.fasta_protein_features:
             try:
-                if args.fasta_features:
-                    output_file.write('>{}\n{}\n'.format(
-                        real_record.id,
-                        str(f.extract(real_record).seq)
-                    ))
-            except ValueError:
-                logging.debug("Couldn't extract feature from record {}".format(real_record.id))
+                output.append('>{}\n{}\n'.format(
+                    parsed_record.id,
+                    f.qualifiers['translation'][0]
+                ))
+            except KeyError:
+                print('could not find a translation for feature:\n')
+                print(f)
 
+        if args.feature_table:
+            output.append(feature_table_row(parsed_record, f, args) + '\n')
 
-            if args.fasta_protein_features:
-                try:
-                    output_file.write('>{}\n{}\n'.format(
-                        real_record.id,
-                        f.qualifiers['translation'][0]
-                    ))
-                except KeyError:
-                    print('could not find a translation for feature:\n')
-                    print(f)
+    return output, feature_count
 
 
+def record_taxid(parsed_record):
+    """
+    The taxid from the db_xref of a record's source feature, or None.
+    """
+    for feature in parsed_record.features:
+        if feature.type == 'source':
+            for xref in feature.qualifiers.get('db_xref', []):
+                if xref.startswith('taxon:') and xref[6:].isdigit():
+                    return int(xref[6:])
+            return None
+    return None
 
-    if keep_record:
-        matching_record_count += 1
-        if args.dump_genbank:
-            output_file.write(record + '\n//\n')
 
-longest_substring = None
-taxid_set = None
+def feature_span(feature):
+    """
+    Return (start, end, strand) covering the whole of a feature's location,
+    with Python style coordinates like Biopython. strand is 1 or -1, or 0 if
+    the parts of the location are on different strands.
+    """
+    if isinstance(feature.location, str):
+        parts = parse_location(feature.location)
+        strands = set(strand for start, end, strand in parts)
+        return (
+            min(start for start, end, strand in parts),
+            max(end for start, end, strand in parts),
+            strands.pop() if len(strands) == 1 else 0
+        )
+    location = feature.location
+    return int(location.start), int(location.end), location.strand or 0
 
-matching_record_count = 0
-matching_feature_count = 0
 
+def feature_table_row(parsed_record, feature, query):
+    """
+    A row of the feature table (see featuretable.py) for a feature, as a
+    line of JSON: accession, version, taxid, type, start, end, strand, the
+    first value of each of query.table_qualifiers and, if
+    query.table_sequences, the sequence.
+    """
+    accession, _, version = parsed_record.id.partition('.')
+    start, end, strand = feature_span(feature)
+    row = [
+        accession, int(version) if version.isdigit() else None, record_taxid(parsed_record),
+        feature.type, start, end, strand
+    ]
+    for name in query.table_qualifiers:
+        values = feature.qualifiers.get(name)
+        row.append(values[0] if values else None)
+    if query.table_sequences:
+        try:
+            row.append(parsed_record.extract(feature))
+        except ValueError:
+            logging.debug("Couldn't extract feature from record {}".format(parsed_record.id))
+            row.append(None)
+    return json.dumps(row)
+
+# the state of a worker process (see init_search_worker and
+# init_generic_worker). Searches in the main process pass everything they
+# need around instead, so that several can run at once
+prefilter = None
+worker_queries = None
+worker_sequence_store = None
+
+# uncompressed files bigger than this are split into several chunks (at record
+# boundaries) when searching with more than one worker
+CHUNK_SIZE = 256 * 2 ** 20
+
+
+RECORD_DELIMITER = b'\n//\n'
+
+# when reading memory-mapped files, hand back the pages we have finished with
+# every this many bytes so that resident memory doesn't grow with the file
+MMAP_RELEASE_SIZE = 16 * 2 ** 20
+
+
+class SearchStats(object):
+    """
+    Counters and timers (in seconds) for the stages of searching one file in
+    one process, for query.py --report. read is the time spent getting
+    records out of the file, which includes reading, decompressing (inflate,
+    for compressed files) and splitting it into records.
+    """
 
-def do_search(args):
+    COUNTERS = [
+        'records', 'bytes_read', 'prefilter_passed', 'prefilter_rejected',
+        'taxid_rejected', 'parsed', 'biopython_parsed', 'features_matched',
+        'records_matched', 'output_bytes',
+    ]
+    TIMERS = [
+        'read', 'inflate', 'prefilter', 'taxid_filter', 'parse',
+        'biopython_parse', 'extract', 'write',
+    ]
+
+    def __init__(self, filename, worker=None):
+        self.filename = filename
+        if worker is None:
+            worker = multiprocessing.current_process().name
+        self.worker = worker
+        self.counts = dict((name, 0) for name in self.COUNTERS)
+        self.seconds = dict((name, 0.0) for name in self.TIMERS)
+
+    def add(self, other):
+        for name in self.COUNTERS:
+            self.counts[name] += other.counts[name]
+        for name in self.TIMERS:
+            self.seconds[name] += other.seconds[name]
+
+    def stage_seconds(self):
+        """
+        The time spent in each stage, without overlaps: split is the part of
+        read that wasn't spent in inflate.
+        """
+        stages = dict(self.seconds)
+        stages['split'] = max(stages.pop('read') - stages['inflate'], 0.0)
+        return stages
+
+    def to_dict(self):
+        return {
+            'counts': dict(self.counts),
+            'seconds': dict(self.seconds),
+        }
+
+
+class TimedReader(object):
+    """
+    A binary file object that adds the time spent in its reads and seeks
+    (which for compressed files is mostly decompressing) to the inflate timer
+    of a SearchStats.
+    """
+
+    def __init__(self, file, stats):
+        self.file = file
+        self.stats = stats
+
+    def readinto(self, buffer):
+        start = time.perf_counter()
+        size = self.file.readinto(buffer)
+        self.stats.seconds['inflate'] += time.perf_counter() - start
+        return size
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.file.read(size)
+        self.stats.seconds['inflate'] += time.perf_counter() - start
+        return data
+
+    def seek(self, offset):
+        start = time.perf_counter()
+        position = self.file.seek(offset)
+        self.stats.seconds['inflate'] += time.perf_counter() - start
+        return position
+
+
+def timed_records(records, stats):
+    """
+    Pass through the (offset, record) pairs from iter_records, adding the
+    time taken to get each one, and their number and size, to stats.
+    """
+    records = iter(records)
+    while True:
+        start = time.perf_counter()
+        try:
+            offset, record = next(records)
+        except StopIteration:
+            stats.seconds['read'] += time.perf_counter() - start
+            return
+        stats.seconds['read'] += time.perf_counter() - start
+        if len(record) > 0:
+            stats.counts['records'] += 1
+            stats.counts['bytes_read'] += len(record)
+        yield offset, record
+
+
+def open_genbank(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode="rt", encoding='latin-1')
+    else:
+        return open(filename, encoding='latin-1')
+
+
+def iter_records(filename, start=0, end=None, spans=None, bufsize=4096*256, stats=None):
+    """
+    Yield (offset, record) for each record in filename, where record is a
+    memoryview of the bytes of the record (without the trailing //) and offset
+    is its position in the uncompressed file. If end is given, only the records
+    in the byte range start..end are read (see split_file); if spans is given,
+    only the records at those sorted (offset, length) spans are read.
+
+    Nothing is copied or decoded: uncompressed files are memory-mapped and
+    compressed files are read into a single reusable buffer. This means that a
+    record is only valid until the next one is read, so decode it (with
+    str(record, 'latin-1')) or copy it (with bytes(record)) to keep it.
+
+    If stats (a SearchStats) is given, the time spent reading and
+    decompressing compressed files is added to it.
+    """
+    if bgzf.is_bgzf(filename):
+        with bgzf.BgzfReader(filename, end=end) as genbank_file:
+            if stats is not None:
+                genbank_file = TimedReader(genbank_file, stats)
+            if spans is not None:
+                for offset, length in spans:
+                    genbank_file.seek(offset)
+                    yield offset, memoryview(genbank_file.read(length))
+            else:
+                genbank_file.seek(start)
+                for offset, record in buffered_records(genbank_file, bufsize, start):
+                    yield offset, record
+        return
+
+    if filename.endswith('.gz'):
+        with gzip.open(filename, mode='rb') as genbank_file:
+            if stats is not None:
+                genbank_file = TimedReader(genbank_file, stats)
+            if spans is not None:
+                for offset, length in spans:
+                    # gzip files can only seek by decompressing, but since
+                    # the offsets are sorted we only ever go forwards
+                    genbank_file.seek(offset)
+                    yield offset, memoryview(genbank_file.read(length))
+            else:
+                for offset, record in buffered_records(genbank_file, bufsize):
+                    yield offset, record
+        return
+
+    with open(filename, mode='rb') as genbank_file:
+        size = os.fstat(genbank_file.fileno()).st_size
+        if size == 0:
+            # can't mmap an empty file
+            if spans is None:
+                yield 0, memoryview(b'')
+            return
+        with mmap.mmap(genbank_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise') and spans is None:
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            if spans is not None:
+                ranges = ((offset, offset + length) for offset, length in spans)
+            else:
+                ranges = mapped_record_ranges(mapped, start, size if end is None else end)
+
+            view = memoryview(mapped)
+            released = 0
+            try:
+                for record_start, record_end in ranges:
+                    record = view[record_start:record_end]
+                    try:
+                        yield record_start, record
+                    finally:
+                        record.release()
+                    if (
+                        record_start - released > MMAP_RELEASE_SIZE
+                        and hasattr(mmap, 'MADV_DONTNEED')
+                    ):
+                        # the mapping is read only, so this just drops our
+                        # copy of the pages; they stay in the page cache
+                        released_end = record_start - record_start % mmap.PAGESIZE
+                        mapped.madvise(mmap.MADV_DONTNEED, released, released_end - released)
+                        released = released_end
+            finally:
+                view.release()
+
+
+def mapped_record_ranges(mapped, start, end):
+    """
+    Yield (start, end) for each record in mapped[start:end], splitting in the
+    same places as delimited() would.
+    """
+    position = start
+    while True:
+        delimiter_start = mapped.find(RECORD_DELIMITER, position, end)
+        if delimiter_start == -1:
+            yield position, end
+            return
+        yield position, delimiter_start
+        position = delimiter_start + len(RECORD_DELIMITER)
+
+
+def buffered_records(genbank_file, bufsize=4096*256, start=0):
+    """
+    Yield (offset, record) for each record in a binary file object, where
+    record is a memoryview into a buffer that is reused (so it is only valid
+    until the next record). Unlike delimited(), each byte is only searched
+    once, so very large records don't get copied over and over again. start is
+    the position in the file that genbank_file is reading from.
+    """
+    buf = bytearray()
+    chunk = bytearray(bufsize)
+    # offset in the file of the start of buf
+    buf_offset = start
+    # start of the current record in buf
+    position = 0
+    # where to start looking for the next delimiter
+    search_from = 0
+
+    while True:
+        delimiter_start = buf.find(RECORD_DELIMITER, search_from)
+        if delimiter_start == -1:
+            # throw away the records we've finished with and read some more
+            del buf[:position]
+            buf_offset += position
+            search_from = max(len(buf) - len(RECORD_DELIMITER) + 1, 0)
+            position = 0
+            chunk_size = genbank_file.readinto(chunk)
+            if not chunk_size:
+                with memoryview(buf) as record:
+                    yield buf_offset, record
+                return
+            buf += memoryview(chunk)[:chunk_size]
+            continue
+
+        with memoryview(buf)[position:delimiter_start] as record:
+            yield buf_offset + position, record
+        position = delimiter_start + len(RECORD_DELIMITER)
+        search_from = position
+
+
+def read_records(filename, start=0, end=None, spans=None):
+    """
+    Yield the records from filename as strings (without the trailing //). The
+    arguments are the same as iter_records.
+    """
+    for offset, record in iter_records(filename, start, end, spans):
+        yield str(record, 'latin-1')
+
+
+def read_spans(filename, spans):
+    """
+    Yield the records at the given (offset, length) spans of filename, which
+    should be sorted by offset.
+    """
+    return read_records(filename, spans=spans)
+
+
+class Prefilter(object):
+    """
+    A cheap check that can be run straight on the bytes of a record, before
+    it's decoded. pattern is a bytes regular expression that is matched against
+    the lowercased record.
+    """
+
+    # lowercasing a copy of the record and doing a case sensitive search is
+    # much quicker than a case insensitive search, but for records bigger than
+    # this we search in place rather than copy them
+    COPY_LIMIT = 2 ** 20
+
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern)
+        self.ignorecase_pattern = re.compile(pattern, re.IGNORECASE)
+
+    def search(self, record):
+        if len(record) > self.COPY_LIMIT:
+            return self.ignorecase_pattern.search(record)
+        return self.pattern.search(bytes(record).lower())
+
+
+# the bytes of the latin-1 characters that lowercase to each character
+LATIN1_CASES = collections.defaultdict(set)
+for byte in range(256):
+    LATIN1_CASES[chr(byte).lower()].add(byte)
+
+
+def lowercase_pattern(text):
+    """
+    A bytes regular expression that finds text (which has to be lowercase
+    already) in a lowercased record however it was capitalised, the same as
+    comparing the lowercased, decoded record would. bytes.lower() only
+    lowercases ASCII, so other letters can be either case in the record.
+    """
+    pattern = []
+    for character in text:
+        if ord(character) < 128:
+            pattern.append(re.escape(character.encode('latin-1')))
+            continue
+        cases = LATIN1_CASES.get(character)
+        if not cases:
+            raise ValueError('{!r} in {!r} can never match, since records are read as latin-1'.format(
+                character, text
+            ))
+        escaped = b''.join(re.escape(bytes([byte])) for byte in sorted(cases))
+        pattern.append(escaped if len(cases) == 1 else b'[' + escaped + b']')
+    return b''.join(pattern)
+
+
+def build_prefilter(args):
+    """
+    Work out the cheap check for a query, which is run on the raw bytes of
+    every record to decide whether it's worth parsing. With terms, it checks
+    for any of the terms as the whole value of the qualifier, allowing for the
+    value being wrapped over several lines. Without terms, it checks for the
+    qualifier, and without a qualifier, for a feature of the right type.
+    """
+    if args.qualifier is None:
+        # feature keys start in column 6
+        return Prefilter(b'\n     ' + lowercase_pattern(args.type.lower()) + b' ')
+
+    qualifier = lowercase_pattern(args.qualifier.lower())
+    if args.terms is None:
+        return Prefilter(b'/' + qualifier + br'[=\s]')
+
+    term_patterns = []
+    for term in sorted(set(t.lower() for t in args.terms)):
+        # quotes inside values are doubled, and the value can be wrapped
+        # at any space
+        words = re.findall(r'\S+', term.replace('"', '""'), re.ASCII)
+        term_patterns.append(br'\s+'.join(lowercase_pattern(word) for word in words))
+    # values can be quoted or not, e.g. /number=3, can start or end with
+    # spaces (or a line break, if the value is wrapped straight after the
+    # quote), and an unquoted value can be the very end of the record
+    return Prefilter(
+        b'/' + qualifier + br'="?\s*(?:' + b'|'.join(term_patterns) + br')\s*(?:"|\n|\Z)'
+    )
+
+
+def compile_prefilter(text):
+    """
+    Turn the cheap check for a search (a string that has to appear somewhere
+    in the record, ignoring case) into a Prefilter.
+    """
+    return Prefilter(lowercase_pattern(text.lower()))
+
+
+class CombinedPrefilter(object):
+    """
+    The prefilters of several queries, run together on each record. A record
+    is lowercased once and checked against all of them in a single pattern,
+    and only if that matches are they checked one by one to see which.
+    """
+
+    def __init__(self, prefilters):
+        self.prefilters = prefilters
+        self.combined = Prefilter(
+            b'|'.join(b'(?:' + p.pattern.pattern + b')' for p in prefilters)
+        )
+
+    def matching(self, record):
+        """
+        Return the positions of the prefilters that the record passes.
+        """
+        if len(self.prefilters) == 1:
+            return [0] if self.prefilters[0].search(record) is not None else []
+        if len(record) > Prefilter.COPY_LIMIT:
+            text = record
+            patterns = [p.ignorecase_pattern for p in self.prefilters]
+            combined = self.combined.ignorecase_pattern
+        else:
+            text = bytes(record).lower()
+            patterns = [p.pattern for p in self.prefilters]
+            combined = self.combined.pattern
+        if combined.search(text) is None:
+            return []
+        return [i for i, pattern in enumerate(patterns) if pattern.search(text) is not None]
+
+
+class Query(object):
+    """
+    A feature query: what to look for (type, qualifier, terms and taxids),
+    what to do with the features that match (action, one of ACTIONS) and the
+    output file, along with counts of what it has found. It has the same
+    attributes as the arguments of query.py, so can go anywhere they can.
+    """
+
+    ACTIONS = ['fasta-features', 'fasta-protein-features', 'dump-genbank', 'count-features', 'feature-table']
+
+    # the qualifiers that go in a feature table unless others are asked for
+    TABLE_QUALIFIERS = ['gene', 'product', 'locus_tag', 'protein_id']
+
+    def __init__(
+        self, type, output=None, action=None, qualifier=None, terms=None, taxid_file=None,
+        table_qualifiers=None, table_sequences=False, taxids=None
+    ):
+        # queries for LocalGenBank.query don't have an output or an action
+        if action is not None and action not in self.ACTIONS:
+            raise ValueError('unknown action {}, should be one of {}'.format(
+                action, ', '.join(self.ACTIONS)
+            ))
+        self.type = type
+        self.output = output
+        self.action = action
+        for name in self.ACTIONS:
+            setattr(self, name.replace('-', '_'), name == action)
+        self.qualifier = qualifier
+        self.terms = [t.lower() for t in terms] if terms is not None else None
+        self.taxid_file = taxid_file
+        self.taxid_set = None
+        if taxid_file is not None:
+            self.taxid_set = set([line.rstrip('\n') for line in open(taxid_file)])
+        elif taxids is not None:
+            self.taxid_set = set(str(taxid) for taxid in taxids)
+        self.table_qualifiers = list(table_qualifiers if table_qualifiers is not None else self.TABLE_QUALIFIERS)
+        self.table_sequences = bool(table_sequences)
+        self.prefilter = build_prefilter(self)
+        self.reset_counts()
+
+    @classmethod
+    def from_args(cls, args):
+        action = [name for name in cls.ACTIONS if getattr(args, name.replace('-', '_'), False)][0]
+        return cls(
+            args.type, args.output, action,
+            qualifier=args.qualifier, terms=args.terms, taxid_file=args.taxid_file,
+            table_qualifiers=getattr(args, 'table_qualifiers', None),
+            table_sequences=getattr(args, 'table_sequences', False)
+        )
+
+    def open_output(self):
+        """
+        Open the output file, which for the feature-table action is a
+        featuretable.FeatureTableWriter that the rows are written to.
+        """
+        if self.feature_table:
+            # numpy is only needed for feature tables
+            import featuretable
+            return featuretable.FeatureTableWriter(self.output, self.table_qualifiers, self.table_sequences)
+        return open(self.output, 'w')
+
+    def reset_counts(self):
+        self.matching_record_count = 0
+        self.matching_feature_count = 0
+        self.prefilter_checked_count = 0
+        self.prefilter_passed_count = 0
+
+    def counts(self):
+        return {
+            'features': self.matching_feature_count,
+            'records': self.matching_record_count,
+            'checked': self.prefilter_checked_count,
+            'passed': self.prefilter_passed_count,
+        }
+
+    def add_counts(self, counts):
+        self.matching_feature_count += counts['features']
+        self.matching_record_count += counts['records']
+        self.prefilter_checked_count += counts['checked']
+        self.prefilter_passed_count += counts['passed']
+
+
+# the keys that can be used for each query in a batch file, and the
+# arguments of Query that they go to
+QUERY_SPEC_KEYS = {
+    'type': 'type',
+    'output': 'output',
+    'action': 'action',
+    'qualifier': 'qualifier',
+    'terms': 'terms',
+    'taxid-file': 'taxid_file',
+    'table-qualifiers': 'table_qualifiers',
+    'table-sequences': 'table_sequences',
+}
+
+
+def read_query_spec(filename):
+    """
+    Read a batch of queries from a JSON file containing a list of objects,
+    each with the same keys as the query.py options (type, qualifier, terms,
+    taxid-file, output, table-qualifiers and table-sequences) and an action,
+    e.g. "fasta-features". Returns a list of Query.
+    """
+    with open(filename) as spec_file:
+        spec = json.load(spec_file)
+    if not isinstance(spec, list):
+        raise ValueError('{} should contain a list of queries'.format(filename))
+
+    queries = []
+    for number, query_spec in enumerate(spec, 1):
+        unknown = set(query_spec) - set(QUERY_SPEC_KEYS)
+        if unknown:
+            raise ValueError('query {} in {} has unknown keys: {}'.format(
+                number, filename, ', '.join(sorted(unknown))
+            ))
+        missing = set(['type', 'output', 'action']) - set(query_spec)
+        if missing:
+            raise ValueError('query {} in {} is missing: {}'.format(
+                number, filename, ', '.join(sorted(missing))
+            ))
+        arguments = dict((QUERY_SPEC_KEYS[key], value) for key, value in query_spec.items())
+        for name in ('terms', 'table_qualifiers'):
+            if isinstance(arguments.get(name), str):
+                arguments[name] = [arguments[name]]
+        queries.append(Query(**arguments))
 
-    global longest_substring
-    global taxid_set
+    outputs = [query.output for query in queries]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError('each query in {} needs its own output file'.format(filename))
+    return queries
 
 
-    # figure out what the cheap check is
-    if args.terms is None and args.qualifier is None:
-        longest_substring = args.type.lower()
-    elif args.terms is None:
-        longest_substring = args.qualifier.lower()
+def split_file(filename, chunk_size=CHUNK_SIZE):
+    """
+    Split a file into a list of (filename, start, end, spans) tasks. Gzip and
+    small files are a single task with start=0, end=None; big uncompressed and
+    BGZF files are cut just after a record delimiter roughly every chunk_size
+    (uncompressed) bytes.
+    """
+    if bgzf.is_bgzf(filename):
+        genbank_file = bgzf.BgzfReader(filename)
+        size = genbank_file.size
+    elif filename.endswith('.gz'):
+        return [(filename, 0, None, None)]
     else:
-        if len(args.terms) == 1:
-            longest_term_substring = args.terms[0].lower()
+        size = os.path.getsize(filename)
+        genbank_file = open(filename, 'rb')
+
+    if size <= chunk_size:
+        genbank_file.close()
+        return [(filename, 0, None, None)]
+
+    boundaries = [0]
+    with genbank_file:
+        position = chunk_size
+        while position < size:
+            # look for the next delimiter, starting a little before the
+            # position in case we landed in the middle of one
+            genbank_file.seek(position - 3)
+            window = b''
+            found = -1
+            while found == -1:
+                newbuf = genbank_file.read(4096 * 256)
+                if not newbuf:
+                    break
+                window += newbuf
+                found = window.find(b'\n//\n')
+            if found == -1:
+                break
+            boundary = position - 3 + found + 4
+            if boundary >= size:
+                break
+            boundaries.append(boundary)
+            position = max(boundary, position) + chunk_size
+    boundaries.append(size)
+
+    return [
+        (filename, start, end, None)
+        for start, end in zip(boundaries, boundaries[1:])
+    ]
+
+
+# when searching with an index, the candidate records of each file are shared
+# out between workers in groups of this many
+SPANS_PER_TASK = 10000
+
+
+def get_tasks(filenames, workers, candidates=None):
+    """
+    Turn a list of files into a list of (filename, start, end, spans) tasks.
+    candidates is a dict of filename to the (offset, length) spans of the
+    records worth looking at, as returned by index_candidates(); files that
+    aren't in it are read in full.
+    """
+    tasks = []
+    for filename in filenames:
+        spans = candidates.get(filename) if candidates is not None else None
+        if spans is not None:
+            if workers > 1:
+                for i in range(0, len(spans), SPANS_PER_TASK):
+                    tasks.append((filename, 0, None, spans[i:i + SPANS_PER_TASK]))
+            else:
+                tasks.append((filename, 0, None, spans))
+        elif workers > 1:
+            tasks.extend(split_file(filename))
         else:
-            longest_term_substring = long_substr(args.terms).lower()
+            tasks.append((filename, 0, None, None))
+    return tasks
+
 
-        if len(longest_term_substring) > 2:
-            longest_substring = longest_term_substring
+def search_file(task, queries, output_files, sequence_store=None, stats=None):
+    """
+    Run queries on the records of a (filename, start, end, spans) task,
+    reading each record once. sequence_store and stats are passed on to
+    process_record.
+    """
+    record_prefilter = CombinedPrefilter([query.prefilter for query in queries])
+    checked_count = 0
+    records = iter_records(*task, stats=stats)
+    if stats is not None:
+        records = timed_records(records, stats)
+    for offset, record in records:
+        if len(record) == 0:
+            continue
+        checked_count += 1
+        # if the quick test fails, we don't want this record, so don't
+        # bother decoding it
+        if stats is not None:
+            start = time.perf_counter()
+            passed = record_prefilter.matching(record)
+            stats.seconds['prefilter'] += time.perf_counter() - start
+            stats.counts['prefilter_passed' if passed else 'prefilter_rejected'] += 1
         else:
-            longest_substring = args.qualifier.lower()
-        args.terms = [t.lower() for t in args.terms]
+            passed = record_prefilter.matching(record)
+        if not passed:
+            continue
+        for i in passed:
+            queries[i].prefilter_passed_count += 1
+        process_record(
+            str(record, 'latin-1'),
+            [queries[i] for i in passed],
+            [output_files[i] for i in passed],
+            sequence_store, stats
+        )
+    for query in queries:
+        query.prefilter_checked_count += checked_count
+
+
+def init_search_worker(queries, index_filename, collect_stats=False, profile_interval=None):
+    global worker_queries
+    global worker_sequence_store
+    global search_collect_stats
+    global search_profiler
+    worker_queries = queries
+    # each worker needs its own connection to the sequence store
+    worker_sequence_store = search_sequence_store(queries, index_filename)
+    search_collect_stats = collect_stats
+    search_profiler = None
+    if profile_interval is not None:
+        search_profiler = SamplingProfiler(profile_interval)
+        search_profiler.start()
+
+
+def worker_stats(filename):
+    """
+    Start collecting stats for a file in a worker process, if we're
+    collecting them, and return the SearchStats (or None).
+    """
+    if search_collect_stats:
+        return SearchStats(filename)
+    return None
 
 
-    print('looking for "{}"'.format(longest_substring))
+def worker_samples():
+    """
+    Return the profiler samples taken in a worker process since the last time
+    this was called, if we're profiling.
+    """
+    if search_profiler is None:
+        return None
+    return search_profiler.take_samples()
+
+
+def search_sequence_store(queries, index_filename):
+    """
+    Features only need extracting for fasta-features, and we can only get
+    them from the sequence store if there's an index.
+    """
+    if index_filename is not None and any(query.fasta_features for query in queries):
+        return open_sequence_store(index_filename)
+    return None
 
-    taxid_set = None
-    if args.taxid_file is not None:
-        taxid_set = set([line.rstrip('\n') for line in open(args.taxid_file)])
 
+def search_worker(task):
+    """
+    Run the search on a single (query numbers, task) inside a worker process.
+    The results for each query go to a temporary part file next to its
+    output, which the parent process appends to the output in task order, so
+    the output doesn't depend on which worker finished first. Returns a list
+    of (part filename, counts), one for each query, and the SearchStats and
+    profiler samples for the task if we're collecting them.
+    """
+    query_numbers, file_task = task
+    stats = worker_stats(file_task[0])
+    queries = [worker_queries[i] for i in query_numbers]
+    part_filenames = []
+    part_files = []
+    for query in queries:
+        query.reset_counts()
+        output_dir = os.path.dirname(os.path.abspath(query.output))
+        part_fd, part_filename = tempfile.mkstemp(
+            prefix='.localgb.', suffix='.part', dir=output_dir
+        )
+        part_filenames.append(part_filename)
+        part_files.append(open(part_fd, 'w'))
 
+    search_file(file_task, queries, part_files, worker_sequence_store, stats)
 
+    results = []
+    for query, part_filename, part_file in zip(queries, part_filenames, part_files):
+        part_file.close()
+        results.append((part_filename, query.counts()))
+    return results, stats, worker_samples()
 
-    output_file = open(args.output, 'w')
 
-    filenames_pbar = tqdm(args.files, unit='files')
-    for filename in filenames_pbar:
+# the records that pass the prefilter are sent to the parser processes of a
+# SearchPipeline in batches of about this many bytes
+PIPELINE_BATCH_SIZE = 2 ** 20
+
+
+def parse_batch(query_numbers, filename, batch):
+    """
+    Run the queries on a batch of (positions of the queries that passed the
+    prefilter, record bytes) from filename inside a parser process. Returns a
+    list of (output, counts) for each query, how long it took, and the
+    SearchStats and profiler samples if we're collecting them.
+    """
+    start = time.time()
+    stats = worker_stats(filename)
+    queries = [worker_queries[i] for i in query_numbers]
+    outputs = [StringIO() for query in queries]
+    for query in queries:
+        query.reset_counts()
+    for passed, record in batch:
+        process_record(
+            str(record, 'latin-1'),
+            [queries[i] for i in passed],
+            [outputs[i] for i in passed],
+            worker_sequence_store, stats
+        )
+    return [
+        (output.getvalue(), query.counts()) for query, output in zip(queries, outputs)
+    ], time.time() - start, stats, worker_samples()
+
+
+class SearchPipeline(object):
+    """
+    Searches a file in three stages that run at the same time, so that
+    reading the file overlaps with parsing it:
+
+    - a reader thread decompresses the file, splits it into records and runs
+      the prefilter (zlib releases the GIL while it inflates, so this runs
+      alongside the rest)
+    - a pool of parser processes parses the records that pass, in batches,
+      and runs the queries on them
+    - a writer thread writes the results to the output files in order
+
+    The stages are connected by queues of at most queue_size batches, so a
+    slow stage holds up the ones before it rather than letting batches pile
+    up in memory. How long each stage spent working and waiting, and how full
+    each queue was, are kept in busy, waiting and depths; summary() sums them
+    up. If a SearchReport is given, the SearchStats of the reader thread and
+    the parser processes are added to it.
+    """
+
+    STAGES = ['read', 'parse', 'write']
+
+    def __init__(
+        self, queries, workers, index_filename=None, queue_size=None,
+        batch_size=PIPELINE_BATCH_SIZE, report=None, profile_interval=None
+    ):
+        self.queries = queries
+        self.workers = workers
+        self.queue_size = queue_size or 2 * workers
+        self.batch_size = batch_size
+        self.report = report
+        self.executor = ProcessPoolExecutor(
+            workers, initializer=init_search_worker,
+            initargs=(queries, index_filename, report is not None, profile_interval)
+        )
+        self.busy = dict((stage, 0.0) for stage in self.STAGES)
+        self.waiting = dict((stage, 0.0) for stage in self.STAGES)
+        # the number of batches waiting for each stage, every time a batch is
+        # handed over
+        self.depths = dict((stage, []) for stage in self.STAGES)
+        self.pbar = None
+        self.error = None
+
+    def search(self, task, query_numbers, output_files):
+        """
+        Run the queries with the given numbers on a (filename, start, end,
+        spans) task, writing the results for each to output_files.
+        """
+        read_queue = queue.Queue(self.queue_size)
+        write_queue = queue.Queue(self.queue_size)
+        self.error = None
+        reader = threading.Thread(target=self.read, args=(task, query_numbers, read_queue))
+        writer = threading.Thread(target=self.write, args=(query_numbers, output_files, write_queue))
+        reader.start()
+        writer.start()
+
+        # batches that the parser processes are working on, oldest first
+        parsing = collections.deque()
+        reading = True
+        try:
+            while True:
+                batch = read_queue.get()
+                if batch is None:
+                    reading = False
+                    break
+                self.depths['read'].append(read_queue.qsize())
+                parsing.append(self.executor.submit(parse_batch, query_numbers, task[0], batch))
+                self.depths['parse'].append(len(parsing))
+                if len(parsing) >= self.queue_size:
+                    self.hand_over(parsing.popleft(), write_queue)
+                if self.pbar is not None:
+                    self.pbar.set_postfix(
+                        read_queue=read_queue.qsize(), parsing=len(parsing),
+                        write_queue=write_queue.qsize(), refresh=False
+                    )
+            while parsing:
+                self.hand_over(parsing.popleft(), write_queue)
+        except Exception as e:
+            self.error = e
+            # let the reader see the error and stop
+            while reading and read_queue.get() is not None:
+                pass
+        write_queue.put(None)
+        reader.join()
+        writer.join()
+        if self.error is not None:
+            raise self.error
+
+    def hand_over(self, future, write_queue):
+        self.depths['write'].append(write_queue.qsize())
+        write_queue.put(future.result())
+
+    def put(self, stage_queue, item, stage):
         start = time.time()
-        filenames_pbar.set_description(
-            'processing {}, found {} ({}) matching features (records)'
-            .format(os.path.basename(filename), matching_feature_count, matching_record_count)
+        stage_queue.put(item)
+        self.waiting[stage] += time.time() - start
+
+    def read(self, task, query_numbers, read_queue):
+        try:
+            record_prefilter = CombinedPrefilter(
+                [self.queries[i].prefilter for i in query_numbers]
+            )
+            queries = [self.queries[i] for i in query_numbers]
+            stats = None
+            if self.report is not None:
+                stats = SearchStats(task[0], 'reader')
+            batch = []
+            batch_size = 0
+            checked_count = 0
+            start = time.time()
+            records = iter_records(*task, stats=stats)
+            if stats is not None:
+                records = timed_records(records, stats)
+            for offset, record in records:
+                if self.error is not None:
+                    break
+                if len(record) == 0:
+                    continue
+                checked_count += 1
+                if stats is not None:
+                    prefilter_start = time.perf_counter()
+                    passed = record_prefilter.matching(record)
+                    stats.seconds['prefilter'] += time.perf_counter() - prefilter_start
+                    stats.counts['prefilter_passed' if passed else 'prefilter_rejected'] += 1
+                else:
+                    passed = record_prefilter.matching(record)
+                if not passed:
+                    continue
+                for i in passed:
+                    queries[i].prefilter_passed_count += 1
+                batch.append((passed, bytes(record)))
+                batch_size += len(record)
+                if batch_size >= self.batch_size:
+                    self.busy['read'] += time.time() - start
+                    self.put(read_queue, batch, 'read')
+                    start = time.time()
+                    batch = []
+                    batch_size = 0
+            self.busy['read'] += time.time() - start
+            if batch:
+                self.put(read_queue, batch, 'read')
+            for query in queries:
+                query.prefilter_checked_count += checked_count
+            if stats is not None:
+                self.report.add(stats)
+        except Exception as e:
+            self.error = e
+        finally:
+            read_queue.put(None)
+
+    def write(self, query_numbers, output_files, write_queue):
+        while True:
+            start = time.time()
+            item = write_queue.get()
+            self.waiting['write'] += time.time() - start
+            if item is None:
+                break
+            if self.error is not None:
+                # keep taking batches so that the other stages can finish
+                continue
+            results, parse_time, stats, samples = item
+            self.busy['parse'] += parse_time
+            if stats is not None:
+                self.report.add(stats)
+            if samples is not None:
+                self.report.add_samples(samples)
+            start = time.time()
+            try:
+                for i, output_file, (output, counts) in zip(query_numbers, output_files, results):
+                    output_file.write(output)
+                    self.queries[i].add_counts(counts)
+            except Exception as e:
+                self.error = e
+            self.busy['write'] += time.time() - start
+
+    def summary(self):
+        lines = []
+        for stage in self.STAGES:
+            depths = self.depths[stage]
+            line = '{}: busy {:.1f}s'.format(stage, self.busy[stage])
+            if stage == 'parse':
+                line += ' over {} processes'.format(self.workers)
+            else:
+                line += ', {} {:.1f}s'.format(
+                    'blocked' if stage == 'read' else 'waiting', self.waiting[stage]
+                )
+            line += ', queue depth {:.1f} on average, {} at most (limit {})'.format(
+                sum(depths) / max(len(depths), 1), max(depths, default=0), self.queue_size
+            )
+            lines.append(line)
+        return lines
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class SearchReport(object):
+    """
+    Collects the SearchStats from every file and worker of a search, and the
+    samples from the SamplingProfiler, for query.py --report and --profile.
+    """
+
+    def __init__(self, queries):
+        self.queries = queries
+        # (filename, worker) to SearchStats
+        self.stats = {}
+        self.samples = collections.Counter()
+        self.cached_files = []
+        self.start = time.time()
+
+    def add(self, stats):
+        key = (stats.filename, stats.worker)
+        if key not in self.stats:
+            self.stats[key] = SearchStats(stats.filename, stats.worker)
+        self.stats[key].add(stats)
+
+    def add_samples(self, samples):
+        self.samples.update(samples)
+
+    def summary(self, stats_list):
+        total = SearchStats(None)
+        for stats in stats_list:
+            total.add(stats)
+        stages = total.stage_seconds()
+        stage_total = sum(stages.values())
+        summary = total.to_dict()
+        summary['stage_fractions'] = dict(
+            (stage, seconds / stage_total if stage_total else 0.0)
+            for stage, seconds in stages.items()
         )
-        if filename.endswith('.gz'):
-            genbank_file = gzip.open(filename, mode="rt", encoding='latin-1')
-        else:
-            genbank_file = open(filename, encoding='latin-1')
+        summary['slowest_stage'] = max(stages, key=stages.get) if stage_total else None
+        return summary
+
+    def to_dict(self):
+        filenames = []
+        workers = []
+        for filename, worker in self.stats:
+            if filename not in filenames:
+                filenames.append(filename)
+            if worker not in workers:
+                workers.append(worker)
+
+        report = {
+            'wall_seconds': time.time() - self.start,
+            'queries': [
+                dict(query_signature(query), output=query.output, taxid_file=query.taxid_file)
+                for query in self.queries
+            ],
+            'cached_files': self.cached_files,
+            'totals': self.summary(self.stats.values()),
+            'workers': dict(
+                (worker, self.summary(s for (f, w), s in self.stats.items() if w == worker))
+                for worker in workers
+            ),
+            'files': dict(
+                (filename, {
+                    'totals': self.summary(s for (f, w), s in self.stats.items() if f == filename),
+                    'workers': dict(
+                        (w, s.to_dict()) for (f, w), s in self.stats.items() if f == filename
+                    ),
+                })
+                for filename in filenames
+            ),
+        }
+        if self.samples:
+            # where the time went, by the function that was running
+            functions = collections.Counter()
+            for stack, count in self.samples.items():
+                functions[stack.rsplit(';', 1)[-1]] += count
+            report['profile'] = {
+                'samples': sum(self.samples.values()),
+                'top_functions': functions.most_common(20),
+            }
+        return report
+
+    def write(self, filename):
+        with open(filename, 'w') as report_file:
+            json.dump(self.to_dict(), report_file, indent=2)
+
+    def write_profile(self, filename):
+        """
+        Write the profiler samples in the "collapsed" format (one line per
+        stack, with functions separated by ; and then the number of samples),
+        which flamegraph.pl and speedscope can read.
+        """
+        with open(filename, 'w') as profile_file:
+            for stack, count in self.samples.most_common():
+                profile_file.write('{} {}\n'.format(stack, count))
+
+
+# seconds of CPU time between samples when profiling
+PROFILE_INTERVAL = 0.005
+
+
+class SamplingProfiler(object):
+    """
+    A statistical profiler that is cheap enough to leave running on a real
+    search: every interval seconds of CPU time, a SIGPROF signal interrupts
+    the process and the stack of the main thread is recorded. samples counts
+    how often each stack was seen, as strings of function (file:line) names
+    separated by ;.
+    """
 
-        for record in delimited(genbank_file, '\n//\n', bufsize=4096*256):
-            process_record(record, args, output_file)
-        if args.verbosity > 0:
-            logging.debug("{} took {} seconds".format(
-            filename, time.time() - start
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = collections.Counter()
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def sample(self, signal_number, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(
+                code.co_name, os.path.basename(code.co_filename), code.co_firstlineno
             ))
-    output_file.close()
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def take_samples(self):
+        samples = self.samples
+        self.samples = collections.Counter()
+        return samples
+
+
+def search_queries(queries, args):
+    """
+    Run a list of Query on args.files, reading and parsing each record once
+    however many queries there are, and write the results for each query to
+    its output file. args has the other options of query.py: workers, index,
+    as_of_release, cache, cache_size, pipeline, queue_size, report, profile
+    and profile_interval. The counts on each query are updated with what it
+    found.
+
+    With more than one worker, files (or chunks of them) are normally shared
+    out between the workers. With pipeline, the files are searched one at a
+    time by a SearchPipeline, with the workers parsing the records of the same
+    file.
+    """
+    filenames = args.files
+    if getattr(args, 'as_of_release', False):
+        filenames = [f for f in filenames if not is_daily_update(f)]
+
+    workers = getattr(args, 'workers', 1)
+    use_pipeline = getattr(args, 'pipeline', False) and workers > 1
+    index_filename = getattr(args, 'index', None)
+    sequence_store = None
+    search_stats = None
+    if workers == 1:
+        sequence_store = search_sequence_store(queries, index_filename)
+
+    # look up the results we already have
+    cache = None
+    cache_keys = {}
+    cached = {}
+    if getattr(args, 'cache', None) is not None:
+        cache = resultcache.ResultCache(
+            args.cache, getattr(args, 'cache_size', None) or resultcache.MAX_SIZE
+        )
+        for i, query in enumerate(queries):
+            for filename, key in result_cache_keys(query, filenames, args).items():
+                cache_keys[i, filename] = key
+                entry = cache.get(key)
+                if entry is not None:
+                    cached[i, filename] = entry
+        logging.info('using {} cached results'.format(len(cached)))
+
+    # the queries that each file has to be searched for
+    file_queries = dict(
+        (filename, [i for i in range(len(queries)) if (i, filename) not in cached])
+        for filename in filenames
+    )
+
+    # a file's records are worth reading if any of its queries could match
+    # them, and it has to be read in full if any of them can't use the index
+    candidates = None
+    if index_filename is not None:
+        candidates = {}
+        full_files = set()
+        for i, query in enumerate(queries):
+            query_files = [f for f in filenames if i in file_queries[f]]
+            if not query_files:
+                continue
+            index_args = argparse.Namespace(**vars(args))
+            for name in ['type', 'qualifier', 'terms']:
+                setattr(index_args, name, getattr(query, name))
+            index_args.files = query_files
+            query_candidates = index_candidates(index_args, index_filename, query.taxid_set)
+            for filename in query_files:
+                if filename not in query_candidates:
+                    full_files.add(filename)
+                else:
+                    candidates.setdefault(filename, set()).update(query_candidates[filename])
+        candidates = dict(
+            (filename, sorted(spans)) for filename, spans in candidates.items()
+            if filename not in full_files
+        )
+
+    file_tasks = dict(
+        (filename, [
+            (file_queries[filename], task)
+            for task in get_tasks([filename], 1 if use_pipeline else workers, candidates)
+        ] if file_queries[filename] else [])
+        for filename in filenames
+    )
+    tasks = [task for filename in filenames for task in file_tasks[filename]]
+    searched_files = [f for f in filenames if file_tasks[f]]
+
+    output_files = [query.open_output() for query in queries]
+
+    # stats for --report and samples for --profile
+    report = None
+    collect_stats = getattr(args, 'report', None) is not None
+    profile_interval = None
+    profiler = None
+    if getattr(args, 'profile', None) is not None:
+        profile_interval = getattr(args, 'profile_interval', None) or PROFILE_INTERVAL
+        profiler = SamplingProfiler(profile_interval)
+        profiler.start()
+    if collect_stats or profiler is not None:
+        report = SearchReport(queries)
+
+    tasks_pbar = tqdm(
+        total=len(tasks) + len(filenames) - len(searched_files),
+        unit='files' if len(tasks) == len(searched_files) else 'chunks'
+    )
+
+    def found():
+        return '{} ({})'.format(
+            sum(query.matching_feature_count for query in queries),
+            sum(query.matching_record_count for query in queries)
+        )
+
+    pool = None
+    pipeline = None
+    if use_pipeline and tasks:
+        pipeline = SearchPipeline(
+            queries, workers, index_filename, getattr(args, 'queue_size', None),
+            report=report if collect_stats else None, profile_interval=profile_interval
+        )
+        pipeline.pbar = tasks_pbar
+    elif workers > 1 and tasks:
+        pool = multiprocessing.Pool(
+            workers,
+            initializer=init_search_worker,
+            initargs=(queries, index_filename, collect_stats, profile_interval)
+        )
+        results = pool.imap(search_worker, tasks)
+
+    # go through the files in order, so that the output is the same whichever
+    # of them came from the cache
+    for filename in filenames:
+        for i in range(len(queries)):
+            if (i, filename) in cached:
+                data_filename, counts = cached[i, filename]
+                with open(data_filename) as data_file:
+                    shutil.copyfileobj(data_file, output_files[i])
+                queries[i].add_counts(counts)
+        if not file_tasks[filename]:
+            if report is not None:
+                report.cached_files.append(filename)
+            tasks_pbar.update()
+            tasks_pbar.set_description(
+                'used cached results for {}, found {} matching features (records)'
+                .format(os.path.basename(filename), found())
+            )
+            continue
+
+        # when caching, the results for the file are written to a new cache
+        # entry first and copied to the output once the file is finished
+        query_numbers = file_queries[filename]
+        counts_before = [queries[i].counts() for i in query_numbers]
+        if cache is not None:
+            file_outputs = [cache.new_entry() for i in query_numbers]
+        else:
+            file_outputs = [output_files[i] for i in query_numbers]
 
+        start = time.time()
+        if collect_stats and pool is None and pipeline is None:
+            search_stats = SearchStats(filename)
+        for task in file_tasks[filename]:
+            if pool is not None:
+                task_results, stats, samples = next(results)
+                for i, file_output, (part_filename, counts) in zip(
+                    query_numbers, file_outputs, task_results
+                ):
+                    with open(part_filename) as part_file:
+                        shutil.copyfileobj(part_file, file_output)
+                    os.remove(part_filename)
+                    queries[i].add_counts(counts)
+                if stats is not None:
+                    report.add(stats)
+                if samples is not None:
+                    report.add_samples(samples)
+                tasks_pbar.update()
+                tasks_pbar.set_description(
+                    'processed {}, found {} matching features (records)'
+                    .format(os.path.basename(filename), found())
+                )
+            else:
+                tasks_pbar.set_description(
+                    'processing {}, found {} matching features (records)'
+                    .format(os.path.basename(filename), found())
+                )
+                if pipeline is not None:
+                    pipeline.search(task[1], query_numbers, file_outputs)
+                else:
+                    search_file(
+                        task[1], [queries[i] for i in query_numbers], file_outputs,
+                        sequence_store, search_stats
+                    )
+                tasks_pbar.update()
+        logging.debug("{} took {} seconds".format(
+            filename, time.time() - start
+        ))
+        if search_stats is not None:
+            report.add(search_stats)
+            search_stats = None
+
+        if cache is not None:
+            for i, file_output, before in zip(query_numbers, file_outputs, counts_before):
+                file_output.seek(0)
+                shutil.copyfileobj(file_output, output_files[i])
+                after = queries[i].counts()
+                cache.add(
+                    cache_keys[i, filename], file_output, filename, query_signature(queries[i]),
+                    dict((name, after[name] - before[name]) for name in after)
+                )
+
+    tasks_pbar.close()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if pipeline is not None:
+        pipeline.close()
+        print('pipeline stages:')
+        for line in pipeline.summary():
+            print('  ' + line)
+    for output_file in output_files:
+        output_file.close()
+    if cache is not None:
+        # only now, so that entries this search is still going to use can't
+        # be deleted to make room for the ones it added
+        cache.evict()
+        cache.close()
+        print('used cached results for {} of {} files'.format(
+            len(cached), len(filenames) * len(queries)
+        ))
+    if profiler is not None:
+        profiler.stop()
+        report.add_samples(profiler.take_samples())
+        report.write_profile(args.profile)
+        print('wrote {} profiler samples to {}'.format(sum(report.samples.values()), args.profile))
+    if collect_stats:
+        report.write(args.report)
+        print('wrote search report to {}'.format(args.report))
+
+
+def print_counts(query):
+    print('prefilter passed {} of {} records ({:.2%})'.format(
+        query.prefilter_passed_count, query.prefilter_checked_count,
+        query.prefilter_passed_count / max(query.prefilter_checked_count, 1)
+        ))
     print('found {} matching features in {} records'.format(
-        matching_feature_count, matching_record_count)
+        query.matching_feature_count, query.matching_record_count)
         )
 
-def do_search_generic(process_record_function, filenames):
 
+def do_search(args):
+    """
+    Run the query given by the arguments of query.py.
+    """
+    query = Query.from_args(args)
+    print('looking for {}'.format(query.prefilter.pattern.pattern.decode('latin-1')))
+    search_queries([query], args)
+    print_counts(query)
 
-    filenames_pbar = tqdm(filenames, unit='files')
-    for filename in filenames_pbar:
-        filenames_pbar.set_description(
+
+def do_batch_search(args):
+    """
+    Run all the queries in the file args.batch (see read_query_spec) in one
+    pass over the files.
+    """
+    queries = read_query_spec(args.batch)
+    search_queries(queries, args)
+    for query in queries:
+        print('{}:'.format(query.output))
+        print_counts(query)
+
+
+# the genbank files in a mirror directory: the release files (gb*.seq.gz) and
+# the daily updates (nc*.flat.gz), either of them possibly uncompressed
+MIRROR_FILE_SUFFIXES = ('.seq', '.seq.gz', '.flat', '.flat.gz')
+
+
+class Match(object):
+    """
+    A feature that matched a query, along with the record it's from. Matches
+    from the same record share the parsed record, and the sequence of the
+    feature is only extracted if you ask for it.
+    """
+    __slots__ = ('record', 'feature', 'feature_number')
+
+    def __init__(self, record, feature, feature_number):
+        self.record = record
+        self.feature = feature
+        # where the feature is in record.features, so that it can be found
+        # again if the record has to be parsed with Biopython
+        self.feature_number = feature_number
+
+    @property
+    def record_id(self):
+        return self.record.id
+
+    @property
+    def taxid(self):
+        return record_taxid(self.record)
+
+    @property
+    def sequence(self):
+        try:
+            return self.record.extract(self.feature)
+        except UnsupportedRecord as e:
+            logging.debug('extracting feature with Biopython: {}'.format(e))
+            record = BiopythonRecord(self.record.text)
+            return record.extract(record.features[self.feature_number])
+
+    @property
+    def translation(self):
+        return self.feature.qualifiers.get('translation', [None])[0]
+
+    @property
+    def genbank(self):
+        """
+        The whole record in genbank format.
+        """
+        return self.record.text + '\n//\n'
+
+    def __repr__(self):
+        return 'Match({}, {} {})'.format(self.record_id, self.feature.type, self.feature.location)
+
+
+class QueryMatches(object):
+    """
+    An iterator over the Matches for a query, as returned by
+    LocalGenBank.query. The files are read as you go: nothing is read until
+    you ask for the first match, and if you stop early the rest is never
+    read. counts() gives the counts for what has been read so far. It should
+    be used from the thread that made it.
+    """
+
+    def __init__(self, query, tasks, sequence_store=None):
+        self.query = query
+        self.sequence_store = sequence_store
+        self.matches = self.search(tasks)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.matches)
+
+    def counts(self):
+        return self.query.counts()
+
+    def search(self, tasks):
+        query = self.query
+        for task in tasks:
+            for offset, record in iter_records(*task):
+                if len(record) == 0:
+                    continue
+                query.prefilter_checked_count += 1
+                if query.prefilter.search(record) is None:
+                    continue
+                query.prefilter_passed_count += 1
+                # decode it now, as the bytes are only valid until the next
+                # record is read
+                matches = self.record_matches(str(record, 'latin-1'))
+                if matches:
+                    query.matching_record_count += 1
+                    query.matching_feature_count += len(matches)
+                    for match in matches:
+                        yield match
+
+    def record_matches(self, record):
+        if self.query.taxid_set is not None and record_taxid_text(record) not in self.query.taxid_set:
+            return []
+        try:
+            parsed_record = LazyRecord(record, self.sequence_store)
+            features = parsed_record.features
+        except UnsupportedRecord as e:
+            logging.debug('parsing record with Biopython: {}'.format(e))
+            parsed_record = BiopythonRecord(record)
+            features = parsed_record.features
+        wanted = set(id(feature) for feature in matching_features(parsed_record, self.query))
+        return [
+            Match(parsed_record, feature, number)
+            for number, feature in enumerate(features) if id(feature) in wanted
+        ]
+
+    def close(self):
+        """
+        Stop searching and close the file being read, if you stop iterating
+        before the end. The sequence store (which the matches may still need)
+        is closed when the last of them is garbage collected.
+        """
+        self.matches.close()
+
+
+class LocalGenBank(object):
+    """
+    A local copy of genbank: the genbank files in mirror_dir (or the list of
+    files given) and the index next to them, if there is one (pass
+    index=False to not use it).
+
+    query() runs a query in the calling thread and returns its matches as
+    they are found, with nothing written to disk; search() runs queries with
+    their results written to their output files, with all the options of
+    query.py. Neither keeps any state in the module or the LocalGenBank, so
+    any number of them can run at once, from different threads or not.
+    """
+
+    def __init__(self, mirror_dir='.', files=None, index=None):
+        self.mirror_dir = mirror_dir
+        if files is None:
+            files = sorted(
+                os.path.join(mirror_dir, name) for name in os.listdir(mirror_dir)
+                if name.endswith(MIRROR_FILE_SUFFIXES)
+            )
+        self.files = list(files)
+        if index is None:
+            index = os.path.join(mirror_dir, INDEX_FILENAME)
+            if not os.path.exists(index):
+                index = None
+        elif index is False:
+            index = None
+        self.index = index
+
+    def query(
+        self, type, qualifier=None, terms=None, taxids=None, taxid_file=None,
+        as_of_release=False, files=None
+    ):
+        """
+        Find the features of the given type (and if qualifier is given, with
+        that qualifier, and if terms are given, with one of them as its value)
+        in records from any of the taxids, and return a QueryMatches that
+        yields a Match for each one, in file order. With the index, only the
+        records it says could match are read, and superseded records are
+        skipped unless as_of_release is True, in which case the daily update
+        files are left out instead. files limits the search to some of the
+        files.
+        """
+        query = Query(
+            type, qualifier=qualifier, terms=terms, taxid_file=taxid_file, taxids=taxids
+        )
+        filenames = self.files if files is None else list(files)
+        if as_of_release:
+            filenames = [f for f in filenames if not is_daily_update(f)]
+        candidates = None
+        sequence_store = None
+        if self.index is not None:
+            candidates = index_candidates(
+                argparse.Namespace(
+                    files=filenames, type=query.type, qualifier=query.qualifier,
+                    terms=query.terms, as_of_release=as_of_release
+                ),
+                self.index, query.taxid_set
+            )
+            sequence_store = open_sequence_store(self.index)
+        return QueryMatches(query, get_tasks(filenames, 1, candidates), sequence_store)
+
+    def search(self, queries, workers=1, as_of_release=False, **options):
+        """
+        Run a list of Query in one pass over the files, writing what each
+        finds to its output file (see search_queries, which takes the other
+        options: cache, cache_size, pipeline, queue_size, report, profile and
+        profile_interval). The counts on each query are updated with what it
+        found.
+        """
+        search_queries(queries, argparse.Namespace(
+            files=self.files, index=self.index, workers=workers,
+            as_of_release=as_of_release, **options
+        ))
+        return queries
+
+
+# bump this when a change to the search changes what it writes, so that
+# results cached by older versions aren't used
+RESULT_CACHE_VERSION = 1
+
+
+def query_signature(query):
+    """
+    Everything about a query that affects what it finds in a file, for
+    keying the result cache. Things that only change how the search is done,
+    like the number of workers, are left out.
+    """
+    taxids = None
+    if query.taxid_set is not None:
+        taxids = hashlib.sha1('\n'.join(sorted(query.taxid_set)).encode('utf-8')).hexdigest()
+    signature = {
+        'version': RESULT_CACHE_VERSION,
+        'type': query.type,
+        'qualifier': query.qualifier,
+        'terms': sorted(set(query.terms)) if query.terms is not None else None,
+        'taxids': taxids,
+        'fasta_features': bool(query.fasta_features),
+        'fasta_protein_features': bool(query.fasta_protein_features),
+        'dump_genbank': bool(query.dump_genbank),
+    }
+    if query.feature_table:
+        signature['table'] = [query.table_qualifiers, query.table_sequences]
+    return signature
+
+
+def result_cache_keys(query, filenames, args):
+    """
+    Return a dict of filename to result cache key for a query. When the
+    search skips superseded records (args.index without args.as_of_release),
+    which records those are is part of the key, so a file's cached results
+    stop being used when an update replaces more of its records.
+    """
+    signature = query_signature(query)
+    index_filename = getattr(args, 'index', None)
+    connection = None
+    if index_filename is not None and not getattr(args, 'as_of_release', False):
+        connection = open_index(index_filename)
+
+    keys = {}
+    for filename in filenames:
+        superseded = None
+        if connection is not None:
+            file_info = indexed_file(connection, filename, index_filename)
+            if file_info is not None:
+                superseded_count, offset_total = connection.execute(
+                    'SELECT count(*), total(offset) FROM records '
+                    'WHERE file_id = ? AND superseded = 1',
+                    (file_info[0],)
+                ).fetchone()
+                if superseded_count > 0:
+                    superseded = [superseded_count, offset_total]
+        keys[filename] = resultcache.make_key(
+            filename, dict(signature, superseded=superseded)
+        )
+    if connection is not None:
+        connection.close()
+    return keys
+
+
+# the bases that each IUPAC code in a motif stands for. T also matches U, so
+# that motifs work on RNA sequences too
+IUPAC_CODES = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT',
+}
+
+# upper case the sequence and delete line numbers and whitespace from ORIGIN
+# lines in one go, like sequence_junk but for bytes
+sequence_upper = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyz', b'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+sequence_junk_bytes = b'0123456789 \n\t\r'
+
+
+def record_sequence(record):
+    """
+    Get the sequence of a record (as bytes) straight from its ORIGIN section,
+    upper cased like LazyRecord.sequence, or b'' if it doesn't have one.
+    """
+    origin_start = record.find(b'\nORIGIN')
+    if origin_start == -1:
+        return b''
+    sequence_start = record.find(b'\n', origin_start + 1)
+    if sequence_start == -1:
+        return b''
+    return record[sequence_start:].translate(sequence_upper, sequence_junk_bytes)
+
+
+def record_id(record):
+    """
+    Get the id of a record (as bytes) the same way as Biopython: the VERSION,
+    or the ACCESSION, or the LOCUS name.
+    """
+    locus, accession, version = parse_record_header(record)
+    return version or accession or locus
+
+
+def motif_pattern(motif):
+    """
+    Turn a motif, which can contain IUPAC ambiguity codes, into a bytes
+    regular expression that matches it in an upper case sequence.
+    """
+    parts = []
+    for code in motif.upper():
+        if code not in IUPAC_CODES:
+            raise ValueError('{} in motif {} is not an IUPAC code'.format(code, motif))
+        bases = IUPAC_CODES[code]
+        if 'T' in bases:
+            bases += 'U'
+        parts.append(bases if len(bases) == 1 else '[{}]'.format(bases))
+    return ''.join(parts).encode('ascii')
+
+
+class MotifScanner(object):
+    """
+    Finds every place in a sequence where any of a set of motifs matches,
+    on both strands unless reverse_complement is False. motifs is a dict of
+    name to motif, or a list of motifs which are used as their own names.
+    Motifs that are their own reverse complement (like most restriction
+    sites) are only reported once, on the forward strand.
+
+    Calling it with a record (as bytes, e.g. from do_search_generic with
+    raw=True) returns (record id, hits) if the record's sequence has any hits,
+    so it can be used as the process_record_function of do_search_generic.
+    """
+
+    def __init__(self, motifs, reverse_complement=True):
+        if not isinstance(motifs, dict):
+            motifs = dict((motif, motif) for motif in motifs)
+        if not motifs:
+            raise ValueError('no motifs to look for')
+        # (name, strand, regular expression) for everything we look for
+        self.patterns = []
+        for name, motif in motifs.items():
+            forward = motif.upper()
+            self.patterns.append((name, 1, re.compile(motif_pattern(forward))))
+            reverse = forward.translate(complement_table)[::-1]
+            if reverse_complement and reverse != forward:
+                self.patterns.append((name, -1, re.compile(motif_pattern(reverse))))
+        # finds the positions where any of them starts, including
+        # overlapping ones, so that only those have to be checked one by one
+        self.combined = re.compile(
+            b'(?=' + b'|'.join(pattern.pattern for name, strand, pattern in self.patterns) + b')'
+        )
+
+    def scan(self, sequence):
+        """
+        Return a list of (name, start, end, strand) for every hit in an upper
+        case sequence (bytes, as from record_sequence), in order of start.
+        start and end are Python style coordinates on the forward strand.
+        """
+        hits = []
+        for match in self.combined.finditer(sequence):
+            position = match.start()
+            for name, strand, pattern in self.patterns:
+                hit = pattern.match(sequence, position)
+                if hit is not None:
+                    hits.append((name, position, hit.end(), strand))
+        return hits
+
+    def __call__(self, record):
+        if isinstance(record, str):
+            record = record.encode('latin-1')
+        hits = self.scan(record_sequence(record))
+        if hits:
+            return record_id(record), hits
+
+
+def init_generic_worker(process_record_function, generic_prefilter, raw=False):
+    global generic_function
+    global generic_raw
+    global prefilter
+    generic_function = process_record_function
+    generic_raw = raw
+    prefilter = generic_prefilter
+
+
+def generic_records(task, record_prefilter, raw=False):
+    for offset, record in iter_records(*task):
+        if len(record) == 0: # sometimes we get empty records
+            continue
+        if record_prefilter is not None and record_prefilter.search(record) is None:
+            continue
+        if raw:
+            yield bytes(record)
+        else:
+            yield str(record, 'latin-1')
+
+
+def generic_worker(task):
+    """
+    Run the generic search on a single task inside a worker process and return
+    everything that the record function returned (other than None).
+    """
+    results = []
+    for record in generic_records(task, prefilter, generic_raw):
+        result = generic_function(record)
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def do_search_generic(
+    process_record_function, filenames, workers=1, result_function=None, prefilter=None,
+    index=None, as_of_release=False, raw=False
+):
+    """
+    Call process_record_function on every record in filenames. With more than
+    one worker the records are processed in a pool of processes, so anything
+    that process_record_function does to global state is lost; instead, pass a
+    result_function, which is called in this process with every value that
+    process_record_function returns (other than None), in file order.
+
+    If prefilter is given (either a string, which is matched ignoring case, or
+    anything with a search method that takes the bytes of a record, like a
+    compiled bytes regular expression) only records that match it are decoded
+    and passed to process_record_function. If raw is True, records are passed
+    as bytes rather than decoded into strings, which is quicker if
+    process_record_function only needs a small part of them, e.g. the sequence
+    (see record_sequence and MotifScanner).
+
+    If index is given (the filename of an index built with build_index),
+    records that have been superseded by a later version are skipped. If
+    as_of_release is True, the daily update files are left out, so the results
+    are for the release as it was published.
+    """
+
+    if isinstance(prefilter, str):
+        prefilter = compile_prefilter(prefilter)
+
+    if as_of_release:
+        filenames = [f for f in filenames if not is_daily_update(f)]
+
+    candidates = None
+    if index is not None and not as_of_release:
+        candidates = current_records(filenames, index)
+    tasks = get_tasks(filenames, workers, candidates)
+
+    if workers > 1:
+        tasks_pbar = tqdm(tasks, unit='files' if len(tasks) == len(filenames) else 'chunks')
+        pool = multiprocessing.Pool(
+            workers,
+            initializer=init_generic_worker,
+            initargs=(process_record_function, prefilter, raw)
+        )
+        for task, results in zip(tasks_pbar, pool.imap(generic_worker, tasks)):
+            tasks_pbar.set_description(
+                'processed {}'
+                .format(os.path.basename(task[0]))
+            )
+            if result_function is not None:
+                for result in results:
+                    result_function(result)
+        pool.close()
+        pool.join()
+        return
+
+    tasks_pbar = tqdm(tasks, unit='files')
+    for task in tasks_pbar:
+        tasks_pbar.set_description(
             'processing {}'
-            .format(os.path.basename(filename))
+            .format(os.path.basename(task[0]))
         )
-        if filename.endswith('.gz'):
-            genbank_file = gzip.open(filename, mode="rt", encoding='latin-1')
+
+        for record in generic_records(task, prefilter, raw):
+            result = process_record_function(record)
+            if result is not None and result_function is not None:
+                result_function(result)
+
+
+# the record index lives in the mirror directory alongside the genbank files
+INDEX_FILENAME = 'localgb.sqlite'
+
+locus_re = re.compile(rb'^LOCUS +(\S+)', re.MULTILINE)
+accession_re = re.compile(rb'^ACCESSION +(\S+)', re.MULTILINE)
+version_re = re.compile(rb'^VERSION +(\S+)', re.MULTILINE)
+taxid_re = re.compile(rb'/db_xref="taxon:(\d+)"')
+
+
+def open_index(index_filename=INDEX_FILENAME):
+    connection = sqlite3.connect(index_filename)
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS files (
+            file_id INTEGER PRIMARY KEY,
+            filename TEXT UNIQUE,
+            size INTEGER,
+            mtime REAL,
+            features INTEGER DEFAULT 0,
+            taxids INTEGER DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS records (
+            record_id INTEGER PRIMARY KEY,
+            file_id INTEGER,
+            locus TEXT,
+            accession TEXT,
+            version TEXT,
+            offset INTEGER,
+            length INTEGER,
+            taxid INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS records_accession ON records (accession);
+        CREATE INDEX IF NOT EXISTS records_version ON records (version);
+        CREATE INDEX IF NOT EXISTS records_file ON records (file_id, offset);
+        CREATE TABLE IF NOT EXISTS features (
+            record_id INTEGER,
+            type TEXT
+        );
+        CREATE INDEX IF NOT EXISTS features_type ON features (type, record_id);
+        CREATE TABLE IF NOT EXISTS qualifiers (
+            record_id INTEGER,
+            type TEXT,
+            qualifier TEXT,
+            value TEXT
+        );
+        CREATE INDEX IF NOT EXISTS qualifiers_value
+            ON qualifiers (type, qualifier, value, record_id);
+        CREATE TEMP TABLE IF NOT EXISTS touched_accessions (
+            accession TEXT PRIMARY KEY
+        );
+    """)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS sequences (
+            version TEXT PRIMARY KEY,
+            offset INTEGER,
+            length INTEGER,
+            exceptions_offset INTEGER,
+            exception_count INTEGER
+        )
+    """)
+    add_missing_columns(connection, 'files', [
+        ('features', 'INTEGER DEFAULT 0'),
+        ('taxids', 'INTEGER DEFAULT 0'),
+        ('sequences', 'INTEGER DEFAULT 0'),
+    ])
+    added = add_missing_columns(connection, 'records', [
+        ('taxid', 'INTEGER'),
+        ('superseded', 'INTEGER DEFAULT 0'),
+    ])
+    connection.execute('CREATE INDEX IF NOT EXISTS records_taxid ON records (taxid)')
+    if 'superseded' in added:
+        # an index from before we tracked superseded records; only accessions
+        # with more than one record can have any
+        connection.execute("""
+            INSERT INTO touched_accessions (accession)
+            SELECT accession FROM records
+            WHERE accession IS NOT NULL
+            GROUP BY accession HAVING count(*) > 1
+        """)
+        resolve_superseded(connection)
+        connection.commit()
+    return connection
+
+
+def add_missing_columns(connection, table, columns):
+    """
+    Add columns to indexes that were created by an older version of localgb.
+    Returns the names of the columns that were added.
+    """
+    existing = set(row[1] for row in connection.execute('PRAGMA table_info({})'.format(table)))
+    added = []
+    for name, definition in columns:
+        if name not in existing:
+            connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, name, definition))
+            added.append(name)
+    return added
+
+
+def is_daily_update(filename):
+    """
+    Daily update files (nc*.flat.gz) come after the release files (gb*.seq.gz)
+    so their records win when they have the same version.
+    """
+    return os.path.basename(filename).startswith('nc')
+
+
+def version_number(version):
+    if version is None or '.' not in version:
+        return 0
+    try:
+        return int(version.rsplit('.', 1)[1])
+    except ValueError:
+        return 0
+
+
+def resolve_superseded(connection):
+    """
+    For every accession in the touched_accessions temporary table, mark all of
+    its records as superseded apart from the latest one: the one with the
+    highest version, or if there's more than one copy of that version, the
+    one in the latest daily update file (or the latest one in the file). The
+    touched_accessions table is emptied afterwards.
+    """
+    rows = connection.execute("""
+        SELECT records.accession, records.record_id, records.version,
+            files.filename, records.offset, records.superseded
+        FROM records JOIN files ON records.file_id = files.file_id
+        WHERE records.accession IN (SELECT accession FROM touched_accessions)
+        ORDER BY records.accession
+    """).fetchall()
+
+    changes = []
+    for accession, accession_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        accession_rows = list(accession_rows)
+        latest = max(
+            accession_rows,
+            key=lambda row: (version_number(row[2]), is_daily_update(row[3]), row[3], row[4])
+        )
+        for row in accession_rows:
+            superseded = int(row is not latest)
+            if row[5] != superseded:
+                changes.append((superseded, row[1]))
+    connection.executemany('UPDATE records SET superseded = ? WHERE record_id = ?', changes)
+    connection.execute('DELETE FROM touched_accessions')
+
+
+def index_path(filename, index_filename):
+    """
+    Filenames are stored in the index relative to the index itself, so that
+    the mirror directory can be moved around.
+    """
+    index_dir = os.path.dirname(os.path.abspath(index_filename))
+    return os.path.relpath(os.path.abspath(filename), index_dir)
+
+
+def resolve_index_path(stored_filename, index_filename):
+    index_dir = os.path.dirname(os.path.abspath(index_filename))
+    return os.path.join(index_dir, stored_filename)
+
+
+def parse_record_header(record):
+    """
+    Get the LOCUS name, ACCESSION and VERSION from a record (as bytes) without
+    looking any further than the start of the feature table.
+    """
+    header_end = record.find(b'\nFEATURES')
+    if header_end == -1:
+        header_end = len(record)
+    names = []
+    for regex in (locus_re, accession_re, version_re):
+        match = regex.search(record, 0, header_end)
+        names.append(match.group(1).decode('latin-1') if match else None)
+    return names
+
+
+def index_file_records(filename):
+    """
+    Yield (locus, accession, version, taxid, offset, length, record) for each
+    record in a genbank file. Offsets are into the uncompressed file.
+    """
+    for offset, record in iter_records(filename):
+        record = bytes(record)
+        # release files start with a header before the first LOCUS line
+        # so skip forward to it
+        locus_start = record.find(b'LOCUS ')
+        if locus_start == -1:
+            continue
+        if locus_start > 0 and record[locus_start - 1:locus_start] != b'\n':
+            continue
+        record = record[locus_start:]
+        locus, accession, version = parse_record_header(record)
+        taxid_match = taxid_re.search(record)
+        taxid = int(taxid_match.group(1)) if taxid_match else None
+        yield locus, accession, version, taxid, offset + locus_start, len(record), record
+
+
+def build_index(filenames, index_filename=INDEX_FILENAME, features=False, sequences=False):
+    """
+    Add the records in filenames to the index. Files that are already in the
+    index with the same size and modification time are skipped, and files that
+    have changed are indexed again from scratch. If features is True, the
+    feature types, qualifiers and qualifier values of each record are indexed
+    too, so that do_search can skip records that can't match. If sequences is
+    True, the sequence of each record is packed into the sequence store (see
+    seqstore.py) so that features can be extracted without parsing ORIGIN.
+
+    As each file is added, records that it makes out of date (older versions
+    of the same accession, usually in the release files) are marked as
+    superseded, and so are any of its own records that are already out of
+    date.
+    """
+    connection = open_index(index_filename)
+    sequence_writer = None
+
+    filenames_pbar = tqdm(filenames, unit='files')
+    for filename in filenames_pbar:
+        filenames_pbar.set_description('indexing {}'.format(os.path.basename(filename)))
+        stored_filename = index_path(filename, index_filename)
+        stat = os.stat(filename)
+        index_features = features
+        index_sequences = sequences
+
+        existing = connection.execute(
+            'SELECT file_id, size, mtime, features, taxids, sequences FROM files WHERE filename = ?',
+            (stored_filename,)
+        ).fetchone()
+        if existing is not None:
+            file_id, size, mtime, has_features, has_taxids, has_sequences = existing
+            if (
+                size == stat.st_size and mtime == stat.st_mtime
+                and has_taxids and (has_features or not features)
+                and (has_sequences or not sequences)
+            ):
+                logging.debug('{} is already indexed'.format(filename))
+                continue
+            logging.debug('{} has changed, indexing it again'.format(filename))
+            delete_indexed_file(connection, file_id)
+            # don't lose the feature index or sequences for files that had them
+            index_features = features or bool(has_features)
+            index_sequences = sequences or bool(has_sequences)
+
+        if index_sequences and sequence_writer is None:
+            import seqstore
+            sequence_writer = seqstore.SequenceStoreWriter(sequence_store_filename(index_filename))
+
+        file_id = connection.execute(
+            'INSERT INTO files (filename, size, mtime, features, taxids, sequences) '
+            'VALUES (?, ?, ?, ?, 1, ?)',
+            (stored_filename, stat.st_size, stat.st_mtime, int(index_features), int(index_sequences))
+        ).lastrowid
+        for locus, accession, version, taxid, offset, length, record in index_file_records(filename):
+            record_id = connection.execute(
+                'INSERT INTO records (file_id, locus, accession, version, taxid, offset, length) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (file_id, locus, accession, version, taxid, offset, length)
+            ).lastrowid
+            if index_features:
+                index_record_features(connection, record_id, record.decode('latin-1'))
+            if index_sequences:
+                store_record_sequence(connection, sequence_writer, record.decode('latin-1'))
+        connection.execute("""
+            INSERT OR IGNORE INTO touched_accessions (accession)
+            SELECT accession FROM records WHERE file_id = ? AND accession IS NOT NULL
+        """, (file_id,))
+        resolve_superseded(connection)
+        if sequence_writer is not None:
+            sequence_writer.file.flush()
+        connection.commit()
+
+    if sequence_writer is not None:
+        sequence_writer.close()
+    connection.close()
+
+
+def store_record_sequence(connection, sequence_writer, record):
+    lazy_record = LazyRecord(record)
+    try:
+        record_id = lazy_record.id
+        sequence = lazy_record.sequence
+    except UnsupportedRecord:
+        # e.g. CON records, which don't have a sequence
+        return
+    if connection.execute(
+        'SELECT 1 FROM sequences WHERE version = ?', (record_id,)
+    ).fetchone() is not None:
+        return
+    connection.execute(
+        'INSERT INTO sequences (version, offset, length, exceptions_offset, exception_count) '
+        'VALUES (?, ?, ?, ?, ?)',
+        (record_id,) + sequence_writer.add(sequence)
+    )
+
+
+def sequence_store_filename(index_filename=INDEX_FILENAME):
+    return os.path.splitext(index_filename)[0] + '.seqs'
+
+
+def open_sequence_store(index_filename=INDEX_FILENAME):
+    """
+    Open the sequence store next to the index, or return None if there isn't
+    one.
+    """
+    filename = sequence_store_filename(index_filename)
+    if not os.path.exists(filename):
+        return None
+    # numpy is only needed if there is a sequence store
+    import seqstore
+    connection = open_index(index_filename)
+
+    def lookup(record_id):
+        return connection.execute(
+            'SELECT offset, length, exceptions_offset, exception_count '
+            'FROM sequences WHERE version = ?',
+            (record_id,)
+        ).fetchone()
+
+    return seqstore.SequenceStore(filename, lookup)
+
+
+def delete_indexed_file(connection, file_id):
+    """
+    Remove a file from the index. Records in other files that it superseded
+    become current again once resolve_superseded is called.
+    """
+    connection.execute("""
+        INSERT OR IGNORE INTO touched_accessions (accession)
+        SELECT accession FROM records WHERE file_id = ? AND accession IS NOT NULL
+    """, (file_id,))
+    record_ids = 'SELECT record_id FROM records WHERE file_id = ?'
+    connection.execute(
+        'DELETE FROM features WHERE record_id IN ({})'.format(record_ids), (file_id,)
+    )
+    connection.execute(
+        'DELETE FROM qualifiers WHERE record_id IN ({})'.format(record_ids), (file_id,)
+    )
+    connection.execute('DELETE FROM records WHERE file_id = ?', (file_id,))
+    connection.execute('DELETE FROM files WHERE file_id = ?', (file_id,))
+
+
+def normalise_value(value):
+    """
+    Lowercase a qualifier value or search term and collapse runs of whitespace
+    (including line breaks) into single spaces.
+    """
+    return ' '.join(value.lower().split())
+
+
+# qualifier values longer than this (and all translations) aren't stored in the
+# feature index, so searches for them just look at all records with the
+# qualifier
+MAX_INDEXED_VALUE_LENGTH = 200
+UNINDEXED_QUALIFIERS = set(['translation'])
+
+
+def index_record_features(connection, record_id, record):
+    feature_types = set()
+    qualifier_values = set()
+    for feature_type, location, qualifiers in parse_feature_table(record):
+        feature_types.add(feature_type)
+        for key, value in qualifiers:
+            value = normalise_value(value)
+            if key in UNINDEXED_QUALIFIERS or len(value) > MAX_INDEXED_VALUE_LENGTH:
+                value = None
+            qualifier_values.add((feature_type, key, value))
+    connection.executemany(
+        'INSERT INTO features (record_id, type) VALUES (?, ?)',
+        ((record_id, feature_type) for feature_type in feature_types)
+    )
+    connection.executemany(
+        'INSERT INTO qualifiers (record_id, type, qualifier, value) VALUES (?, ?, ?, ?)',
+        ((record_id,) + qualifier_value for qualifier_value in qualifier_values)
+    )
+
+
+def indexed_file(connection, filename, index_filename):
+    """
+    Return (file_id, has features, has superseded records) for a file, or None
+    if it isn't in the index or has changed since it was indexed.
+    """
+    row = connection.execute(
+        'SELECT file_id, size, mtime, features, taxids FROM files WHERE filename = ?',
+        (index_path(filename, index_filename),)
+    ).fetchone()
+    stat = os.stat(filename)
+    if row is None or not row[4] or row[1] != stat.st_size or row[2] != stat.st_mtime:
+        return None
+    file_id, size, mtime, has_features, has_taxids = row
+    has_superseded = connection.execute(
+        'SELECT 1 FROM records WHERE file_id = ? AND superseded = 1 LIMIT 1', (file_id,)
+    ).fetchone() is not None
+    return file_id, has_features, has_superseded
+
+
+def current_records(filenames, index_filename=INDEX_FILENAME):
+    """
+    Use the index to find the records in filenames that haven't been
+    superseded by a later version. Returns a dict of filename to a sorted list
+    of (offset, length) spans, like index_candidates, for just the files that
+    have superseded records in them; the rest can be read in full.
+    """
+    connection = open_index(index_filename)
+    candidates = {}
+    for filename in filenames:
+        file_info = indexed_file(connection, filename, index_filename)
+        if file_info is None or not file_info[2]:
+            continue
+        candidates[filename] = connection.execute(
+            'SELECT offset, length FROM records WHERE file_id = ? AND superseded = 0 '
+            'ORDER BY offset',
+            (file_info[0],)
+        ).fetchall()
+    connection.close()
+    return candidates
+
+
+def index_candidates(args, index_filename=INDEX_FILENAME, taxid_set=None):
+    """
+    Use the index to find the records in args.files that could match the
+    query: records with a matching feature (for files in the feature index)
+    and, if taxid_set is given, a taxid in the set. Records that have been
+    superseded by a later version are left out, unless args.as_of_release is
+    set. Returns a dict of filename to a sorted list of (offset, length)
+    spans. Files that aren't in the index, or have changed since they were
+    indexed, are left out, so they will be searched in full.
+    """
+    connection = open_index(index_filename)
+    skip_superseded = not getattr(args, 'as_of_release', False)
+
+    indexed_files = {}
+    feature_file_ids = []
+    other_file_ids = []
+    for filename in args.files:
+        file_info = indexed_file(connection, filename, index_filename)
+        if file_info is None:
+            logging.info('{} is not in the index, searching all of it'.format(filename))
+            continue
+        file_id, has_features, has_superseded = file_info
+        if has_features:
+            feature_file_ids.append(file_id)
+        elif taxid_set is not None or (skip_superseded and has_superseded):
+            # we can still skip records from the wrong taxa, or out of date
+            # ones
+            other_file_ids.append(file_id)
         else:
-            genbank_file = open(filename, encoding='latin-1')
+            logging.info('{} is not in the feature index, searching all of it'.format(filename))
+            continue
+        indexed_files[file_id] = filename
 
-        for record in delimited(genbank_file, '\n//\n', bufsize=4096*256):
-            if record != '': # sometimes we get empty records
-                process_record_function(record)
+    if args.qualifier is None:
+        feature_query = 'SELECT record_id FROM features WHERE type = ?'
+        parameters = [args.type]
+    else:
+        feature_query = 'SELECT record_id FROM qualifiers WHERE type = ? AND qualifier = ?'
+        parameters = [args.type, args.qualifier]
+        if args.terms is not None:
+            terms = sorted(set(normalise_value(term) for term in args.terms))
+            feature_query += ' AND (value IN ({}) OR value IS NULL)'.format(
+                ', '.join('?' for term in terms)
+            )
+            parameters.extend(terms)
+
+    query = """
+        SELECT file_id, offset, length FROM records
+        WHERE (
+            (file_id IN ({}) AND record_id IN ({}))
+            OR file_id IN ({})
+        )
+    """.format(
+        ', '.join(str(file_id) for file_id in feature_file_ids),
+        feature_query,
+        ', '.join(str(file_id) for file_id in other_file_ids)
+    )
+
+    if skip_superseded:
+        query += ' AND superseded = 0'
+
+    if taxid_set is not None:
+        connection.execute('CREATE TEMP TABLE wanted_taxids (taxid INTEGER PRIMARY KEY)')
+        connection.executemany(
+            'INSERT OR IGNORE INTO wanted_taxids (taxid) VALUES (?)',
+            ((int(taxid),) for taxid in taxid_set if taxid.strip())
+        )
+        query += ' AND taxid IN (SELECT taxid FROM wanted_taxids)'
+
+    candidates = dict((filename, []) for filename in indexed_files.values())
+    rows = connection.execute(query + ' ORDER BY file_id, offset', parameters)
+    for file_id, offset, length in rows:
+        candidates[indexed_files[file_id]].append((offset, length))
+    connection.close()
+
+    logging.info('found {} candidate records in the index'.format(
+        sum(len(spans) for spans in candidates.values())
+    ))
+    return candidates
+
+
+def fetch(accessions, index_filename=INDEX_FILENAME):
+    """
+    Yield the records (as strings, like read_records) for a list of
+    accessions, which can be either bare accessions or accession.version. A
+    bare accession gets the latest version. The records come back in the order
+    they are stored on disk rather than the order they were asked for, so that
+    each file is only read forwards.
+    """
+    connection = open_index(index_filename)
+    connection.execute('CREATE TEMP TABLE wanted (name TEXT PRIMARY KEY)')
+    connection.executemany(
+        'INSERT OR IGNORE INTO wanted (name) VALUES (?)',
+        ((accession,) for accession in accessions)
+    )
+    # if there's more than one copy of a version, min(superseded) makes
+    # sqlite take the other columns from the current one
+    rows = connection.execute("""
+        SELECT file_id, offset, length FROM records
+            JOIN wanted ON records.accession = wanted.name
+        WHERE superseded = 0
+        UNION
+        SELECT file_id, offset, length FROM (
+            SELECT file_id, offset, length, min(superseded) FROM records
+                JOIN wanted ON records.version = wanted.name
+            GROUP BY version
+        )
+        ORDER BY file_id, offset
+    """).fetchall()
+    filenames = dict(connection.execute('SELECT file_id, filename FROM files'))
+    connection.close()
+
+    for file_id, file_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        filename = resolve_index_path(filenames[file_id], index_filename)
+        spans = [(offset, length) for file_id, offset, length in file_rows]
+        for record in read_spans(filename, spans):
+            yield record
@@ -6,7 +6,9 @@ import re
 import logging
 import gzip
 import time
+import signal
 import localgb
+import resultcache
 
 
 # hide gb file warnings, don't do this in production
@@ -16,7 +18,7 @@ warnings.filterwarnings("ignore")
 parser = argparse.ArgumentParser(
     description='Query genbank files based on features.'
     )
-parser.add_argument('--output',  help='output file', required=True)
+parser.add_argument('--output',  help='output file')
 
 parser.add_argument(
     "-v", "--verbosity", action="count", help="show lots of debugging output", default=0
@@ -24,7 +26,6 @@ parser.add_argument(
 
 parser.add_argument(
     '--type',
-    required=True,
     help="""
 The feature type to look for. Interesting types include:
 
@@ -77,7 +78,7 @@ parser.add_argument(
 )
 
 # all the different things we can do wtih the records/features we find
-action_group = parser.add_mutually_exclusive_group(required=True)
+action_group = parser.add_mutually_exclusive_group()
 action_group.add_argument(
     '--fasta-features',
     action='store_true',
@@ -98,21 +99,144 @@ action_group.add_argument(
     action='store_true',
     help='attempt to get a translation from the matching features andw write in FASTA format to the output file. Note: this is unlikely to work on anything other than CDS type features.'
     )
+action_group.add_argument(
+    '--feature-table',
+    action='store_true',
+    help='write the matching features as a table with one row per feature (accession, version, taxid, type, start, end, strand, --table-qualifiers and optionally the sequence) to the output file, as Parquet if pyarrow is installed and the output file does not end in .npz, otherwise as NumPy arrays in an .npz file. Needs numpy.'
+    )
+
+parser.add_argument(
+    '--table-qualifiers',
+    nargs='+',
+    default=localgb.Query.TABLE_QUALIFIERS,
+    help='with --feature-table, the qualifiers to give a column each (default: %(default)s)'
+    )
+
+parser.add_argument(
+    '--table-sequences',
+    action='store_true',
+    help='with --feature-table, add a column with the sequence of each feature'
+    )
 
 parser.add_argument(
     '--files', nargs='+', help='genbank files to process', required=True
     )
-args = parser.parse_args()
 
-if args.verbosity is None:
-    logging.basicConfig(level=logging.INFO)
-elif args.verbosity > 0:
-    logging.basicConfig(level=logging.DEBUG)
+parser.add_argument(
+    '--index',
+    help='feature index built with build_index.py --features. Only the records that the index says could match are read, and records that have been replaced by a newer version (e.g. in a daily update file) are skipped; files that are not in the index are searched in full.'
+    )
 
+parser.add_argument(
+    '--as-of-release',
+    action='store_true',
+    help='ignore the daily update files (nc*.flat.gz), so that the results are the same as for the release on its own, and do not skip records that the updates have replaced.'
+    )
 
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=1,
+    help='number of processes to search with. Big uncompressed files are split between workers, compressed files are processed one per worker.'
+    )
 
+parser.add_argument(
+    '--pipeline',
+    action='store_true',
+    help='search one file at a time, with one thread reading (and decompressing) the file, the --workers processes parsing its records and another thread writing the output, all at the same time. This is quicker than sharing out whole files when there are only a few big compressed files, or when reading is slow (e.g. over NFS). The time each stage was busy and how full the queues between them got are printed at the end.'
+    )
 
+parser.add_argument(
+    '--queue-size',
+    type=int,
+    help='with --pipeline, the most batches of records that can be waiting between stages (default: twice the number of workers)'
+    )
+
+parser.add_argument(
+    '--report',
+    help='write a JSON report of where the time went to this file: for each file and worker, the bytes and records read, prefilter passes and rejects, taxid rejects, records parsed and output written, and the time spent reading, decompressing, prefiltering, taxid filtering, parsing, extracting and writing. Collecting it slows the search down a little.'
+    )
+
+parser.add_argument(
+    '--profile',
+    help='run a sampling profiler in every process and write the samples to this file, in the collapsed stack format that flamegraph.pl and speedscope read. The top functions are also added to the --report.'
+    )
+
+parser.add_argument(
+    '--profile-interval',
+    type=float,
+    default=localgb.PROFILE_INTERVAL,
+    help='seconds of CPU time between profiler samples (default: %(default)s)'
+    )
+
+parser.add_argument(
+    '--batch',
+    help='run several queries in one pass over the files, reading and parsing each record only once. The file is a JSON list of queries, each with the keys type, output and action (fasta-features, count-features, dump-genbank, fasta-protein-features or feature-table) and optionally qualifier, terms, taxid-file, table-qualifiers and table-sequences. --type, --output, --qualifier, --terms, --taxid-file, the action options and the --table options are not used.'
+    )
+
+parser.add_argument(
+    '--cache',
+    nargs='?',
+    const=resultcache.CACHE_DIRECTORY,
+    help='keep the results for each file in a cache directory (default: {}), so that running the same query again only searches the files that are new or have changed. Use query_cache.py to see what is in the cache or empty it.'.format(resultcache.CACHE_DIRECTORY)
+    )
+
+parser.add_argument(
+    '--cache-size',
+    type=float,
+    default=resultcache.MAX_SIZE / 2 ** 20,
+    help='the most space in MB the cache can use before the least recently used results are deleted (default: %(default)d)'
+    )
+
+
+def main(args):
+    """
+    Run the query (or batch of queries) given by the parsed arguments. This
+    is also what serve.py runs for each query it gets.
+    """
+    if args.batch is None:
+        if args.type is None or args.output is None:
+            parser.error('--type and --output are required (unless using --batch)')
+        if not (args.fasta_features or args.count_features or args.dump_genbank or args.fasta_protein_features or args.feature_table):
+            parser.error('one of --fasta-features, --count-features, --dump-genbank, --fasta-protein-features or --feature-table is required (unless using --batch)')
+
+    if args.verbosity is None:
+        logging.basicConfig(level=logging.INFO)
+    elif args.verbosity > 0:
+        logging.basicConfig(level=logging.DEBUG)
+
+    if args.profile is not None and not hasattr(signal, 'SIGPROF'):
+        parser.error('--profile needs SIGPROF, which this platform does not have')
+
+    try:
+        if args.batch is not None:
+            queries = localgb.read_query_spec(args.batch)
+        else:
+            queries = [localgb.Query.from_args(args)]
+    except ValueError as e:
+        parser.error(str(e))
+    if args.batch is None:
+        print('looking for {}'.format(queries[0].prefilter.pattern.pattern.decode('latin-1')))
+
+    genbank = localgb.LocalGenBank(files=args.files, index=args.index or False)
+    genbank.search(
+        queries,
+        workers=args.workers,
+        as_of_release=args.as_of_release,
+        cache=args.cache,
+        cache_size=int(args.cache_size * 2 ** 20),
+        pipeline=args.pipeline,
+        queue_size=args.queue_size,
+        report=args.report,
+        profile=args.profile,
+        profile_interval=args.profile_interval
+    )
 
+    for query in queries:
+        if args.batch is not None:
+            print('{}:'.format(query.output))
+        localgb.print_counts(query)
 
 
-localgb.do_search(args)
+if __name__ == '__main__':
+    main(parser.parse_args())
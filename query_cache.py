@@ -0,0 +1,63 @@
+import os
+import json
+import time
+import argparse
+import resultcache
+
+parser = argparse.ArgumentParser(
+    description='Show what is in the query result cache (see query.py --cache), or delete results from it.'
+    )
+
+parser.add_argument(
+    '--cache',
+    default=resultcache.CACHE_DIRECTORY,
+    help='the cache directory (default: %(default)s)'
+    )
+
+parser.add_argument(
+    '--purge',
+    nargs='*',
+    metavar='FILE',
+    help='delete the cached results for these genbank files, or for every file if none are given'
+    )
+
+parser.add_argument(
+    '--max-size',
+    type=float,
+    help='delete the least recently used results until the cache is no bigger than this many MB'
+    )
+
+args = parser.parse_args()
+
+if not os.path.exists(args.cache):
+    print('no cache at {}'.format(args.cache))
+    raise SystemExit
+
+cache = resultcache.ResultCache(args.cache)
+
+if args.purge is not None:
+    if args.purge:
+        count = sum(cache.purge(filename) for filename in args.purge)
+    else:
+        count = cache.purge()
+    print('deleted {} cached results'.format(count))
+
+elif args.max_size is not None:
+    before = len(cache.entries())
+    cache.evict(int(args.max_size * 2 ** 20))
+    print('deleted {} cached results'.format(before - len(cache.entries())))
+
+else:
+    for key, filename, query, size, created, last_used in cache.entries():
+        query = json.loads(query)
+        print('{}\t{:.1f} KB\tlast used {}\t{} {}{}'.format(
+            filename, size / 2 ** 10,
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used)),
+            query['type'],
+            query['qualifier'] or '',
+            ' ' + ','.join(query['terms']) if query['terms'] else ''
+        ))
+
+entries = cache.entries()
+print('{} cached results, {:.1f} MB'.format(len(entries), cache.total_size() / 2 ** 20))
+cache.close()
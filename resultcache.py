@@ -0,0 +1,179 @@
+"""
+A cache of the results of searching individual files, so that running the
+same query again only has to search the files that are new or have changed.
+
+Each entry is the output that a query produced for one file, stored as a
+file in the cache directory, along with the counts that go with it. Entries
+are looked up by a key made from the file's path, size and modification time
+and a signature of the query (see localgb.query_signature). A small SQLite
+database keeps track of the entries and when each was last used, and the
+least recently used entries are deleted (by evict, once a search has
+finished with the entries it is using) when the cache grows beyond its
+maximum size.
+"""
+import os
+import time
+import json
+import hashlib
+import sqlite3
+import tempfile
+
+CACHE_DIRECTORY = '.localgb_cache'
+DATABASE_FILENAME = 'cache.sqlite'
+
+# in bytes
+MAX_SIZE = 2 * 2 ** 30
+
+# entries that are still being written are .tmp files; ones that haven't
+# been touched for this many seconds were left by a search that was
+# interrupted (searching a single file never takes anywhere near this long)
+STALE_ENTRY_AGE = 24 * 60 * 60
+
+
+def make_key(filename, query_signature):
+    stat = os.stat(filename)
+    return hashlib.sha1(json.dumps(
+        [os.path.abspath(filename), stat.st_size, stat.st_mtime, query_signature],
+        sort_keys=True
+    ).encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+
+    def __init__(self, directory=CACHE_DIRECTORY, max_size=MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(os.path.join(directory, DATABASE_FILENAME), timeout=60)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                filename TEXT,
+                query TEXT,
+                size INTEGER,
+                created REAL,
+                last_used REAL,
+                counts TEXT
+            )
+        """)
+        self.connection.commit()
+
+    def data_filename(self, key):
+        return os.path.join(self.directory, key + '.out')
+
+    def get(self, key):
+        """
+        Return (data filename, counts) for an entry, or None if it isn't in
+        the cache.
+        """
+        row = self.connection.execute(
+            'SELECT counts FROM entries WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None or not os.path.exists(self.data_filename(key)):
+            return None
+        self.connection.execute(
+            'UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key)
+        )
+        self.connection.commit()
+        return self.data_filename(key), json.loads(row[0])
+
+    def new_entry(self):
+        """
+        Return an open file to write the data for a new entry into, which is
+        then passed to add.
+        """
+        entry_fd, entry_filename = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(entry_fd)
+        return open(entry_filename, 'w+')
+
+    def add(self, key, entry_file, filename, query, counts):
+        entry_file.close()
+        os.replace(entry_file.name, self.data_filename(key))
+        now = time.time()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO entries (key, filename, query, size, created, last_used, counts) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (
+                key, os.path.abspath(filename), json.dumps(query, sort_keys=True),
+                os.path.getsize(self.data_filename(key)), now, now, json.dumps(counts)
+            )
+        )
+        self.connection.commit()
+
+    def discard(self, entry_file):
+        entry_file.close()
+        os.remove(entry_file.name)
+
+    def total_size(self):
+        return self.connection.execute('SELECT total(size) FROM entries').fetchone()[0]
+
+    def evict(self, max_size=None):
+        """
+        Delete the least recently used entries until the cache is no bigger
+        than max_size (by default, the size it was opened with).
+        """
+        if max_size is None:
+            max_size = self.max_size
+        total_size = self.total_size()
+        if total_size <= max_size:
+            return
+        for key, size in self.connection.execute(
+            'SELECT key, size FROM entries ORDER BY last_used'
+        ).fetchall():
+            if total_size <= max_size:
+                break
+            self.remove(key)
+            total_size -= size
+        self.connection.commit()
+
+    def remove(self, key):
+        if os.path.exists(self.data_filename(key)):
+            os.remove(self.data_filename(key))
+        self.connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def entries(self):
+        """
+        Return (key, filename, query, size, created, last_used) for every
+        entry, most recently used first.
+        """
+        return self.connection.execute(
+            'SELECT key, filename, query, size, created, last_used FROM entries '
+            'ORDER BY last_used DESC'
+        ).fetchall()
+
+    def purge(self, filename=None):
+        """
+        Delete every entry, or just the entries for one file.
+        """
+        if filename is None:
+            keys = self.connection.execute('SELECT key FROM entries').fetchall()
+        else:
+            keys = self.connection.execute(
+                'SELECT key FROM entries WHERE filename = ?', (os.path.abspath(filename),)
+            ).fetchall()
+        for key, in keys:
+            self.remove(key)
+        self.connection.commit()
+        self.remove_stale_entries()
+        return len(keys)
+
+    def remove_stale_entries(self):
+        """
+        Clean up the entries left half written by searches that were
+        interrupted, but not the ones that searches are writing now.
+        """
+        stale_before = time.time() - STALE_ENTRY_AGE
+        for name in os.listdir(self.directory):
+            if not name.endswith('.tmp'):
+                continue
+            entry_filename = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(entry_filename) < stale_before:
+                    os.remove(entry_filename)
+            except FileNotFoundError:
+                # another purge got there first
+                pass
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,101 @@
+import os
+import logging
+import argparse
+import localgb
+
+
+parser = argparse.ArgumentParser(
+    description='Find every occurrence of a set of sequence motifs (e.g. restriction or primer sites) in genbank records'
+    )
+parser.add_argument('--output',  help='output file', required=True)
+
+parser.add_argument(
+    "-v", "--verbosity", action="count", help="show lots of debugging output", default=0
+)
+
+parser.add_argument(
+    '--motifs',
+    nargs='+',
+    default=[],
+    help='space-separated list of motifs to look for, either just the sequence (e.g. GAATTC) or name=sequence (e.g. EcoRI=GAATTC). IUPAC ambiguity codes (e.g. GANTC) are allowed.'
+    )
+
+parser.add_argument(
+    '--motif-file',
+    help='file with one motif per line, as a name and a sequence separated by whitespace. Lines starting with # are ignored.'
+    )
+
+parser.add_argument(
+    '--forward-only',
+    action='store_true',
+    help='only look for the motifs on the forward strand, not their reverse complements'
+    )
+
+parser.add_argument(
+    '--files', nargs='+', help='genbank files to process', required=True
+    )
+
+parser.add_argument(
+    '--index',
+    help='index built with build_index.py, to skip records that have been replaced by a newer version'
+    )
+
+parser.add_argument(
+    '--as-of-release',
+    action='store_true',
+    help='ignore the daily update files (nc*.flat.gz)'
+    )
+
+parser.add_argument(
+    '--workers',
+    type=int,
+    default=os.cpu_count(),
+    help='number of processes to search with (default: %(default)s)'
+    )
+args = parser.parse_args()
+
+if args.verbosity > 0:
+    logging.basicConfig(level=logging.DEBUG)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+motifs = {}
+for motif in args.motifs:
+    name, _, sequence = motif.rpartition('=')
+    motifs[name or sequence] = sequence
+if args.motif_file is not None:
+    for line in open(args.motif_file):
+        if line.strip() and not line.startswith('#'):
+            name, sequence = line.split()
+            motifs[name] = sequence
+
+try:
+    scanner = localgb.MotifScanner(motifs, reverse_complement=not args.forward_only)
+except ValueError as e:
+    parser.error(str(e))
+
+record_count = 0
+hit_count = 0
+
+with open(args.output, 'w') as output_file:
+    output_file.write('record\tmotif\tstart\tend\tstrand\n')
+
+    def write_hits(result):
+        global record_count, hit_count
+        record_id, hits = result
+        record_count += 1
+        hit_count += len(hits)
+        for name, start, end, strand in hits:
+            output_file.write('{}\t{}\t{}\t{}\t{}\n'.format(record_id, name, start, end, strand))
+
+    localgb.do_search_generic(
+        scanner,
+        filenames=args.files,
+        workers=args.workers,
+        result_function=write_hits,
+        index=args.index,
+        as_of_release=args.as_of_release,
+        raw=True
+    )
+
+print('found {} hits in {} records'.format(hit_count, record_count))
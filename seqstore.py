@@ -0,0 +1,150 @@
+"""
+A compact store for the sequences of genbank records, so that features can be
+extracted without reading and parsing the ORIGIN section of the record.
+
+Each sequence is stored as 2 bits per base (A, C, G, T), four bases to a byte,
+followed by a list of exceptions: runs of any other character (N, IUPAC
+ambiguity codes, etc.) as (start, length, character). The sequences all live
+in one data file next to the index, and the index has a table saying where
+each one starts. Decoding a range only touches the bytes for that range, and
+is done with NumPy rather than character by character.
+"""
+import mmap
+import os
+import numpy as np
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+# maps a character code to its two bit value, or 255 if it has to be stored
+# as an exception
+BASE_VALUES = np.full(256, 255, dtype=np.uint8)
+for value, base in enumerate(b'ACGT'):
+    BASE_VALUES[base] = value
+
+
+def pack(sequence):
+    """
+    Pack an upper case sequence string into (packed bytes, exception bytes,
+    number of exceptions).
+    """
+    codes = np.frombuffer(sequence.encode('latin-1'), dtype=np.uint8)
+    values = BASE_VALUES[codes]
+    other = values == 255
+    values[other] = 0
+
+    padded = np.zeros((len(values) + 3) // 4 * 4, dtype=np.uint8)
+    padded[:len(values)] = values
+    packed = (
+        (padded[0::4] << 6) | (padded[1::4] << 4) | (padded[2::4] << 2) | padded[3::4]
+    )
+
+    positions = np.flatnonzero(other)
+    if len(positions) == 0:
+        return packed.tobytes(), b'', 0
+    # a new run starts wherever the position or the character isn't a
+    # continuation of the previous one
+    run_starts = np.ones(len(positions), dtype=bool)
+    run_starts[1:] = (np.diff(positions) != 1) | (np.diff(codes[positions]) != 0)
+    first = np.flatnonzero(run_starts)
+    starts = positions[first].astype('<i8')
+    lengths = np.diff(np.append(first, len(positions))).astype('<i8')
+    characters = codes[positions[first]].astype(np.uint8)
+    exceptions = starts.tobytes() + lengths.tobytes() + characters.tobytes()
+    return packed.tobytes(), exceptions, len(first)
+
+
+class SequenceStoreWriter(object):
+    """
+    Appends packed sequences to the data file. add() returns the values to
+    store in the sequences table of the index.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'ab')
+        self.offset = self.file.seek(0, os.SEEK_END)
+
+    def add(self, sequence):
+        packed, exceptions, exception_count = pack(sequence)
+        offset = self.offset
+        self.file.write(packed)
+        self.file.write(exceptions)
+        self.offset += len(packed) + len(exceptions)
+        return offset, len(sequence), offset + len(packed), exception_count
+
+    def close(self):
+        self.file.close()
+
+
+class SequenceStore(object):
+    """
+    Read access to the data file. lookup is a function that takes a record id
+    and returns (offset, length, exceptions offset, exception count) or None
+    if the record isn't in the store.
+    """
+
+    def __init__(self, filename, lookup):
+        self.file = open(filename, 'rb')
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+        self.lookup = lookup
+        self.last_id = None
+        self.last_entry = None
+
+    def entry(self, record_id):
+        if record_id != self.last_id:
+            self.last_entry = self.lookup(record_id)
+            self.last_id = record_id
+        return self.last_entry
+
+    def __contains__(self, record_id):
+        return self.entry(record_id) is not None
+
+    def extract(self, record_id, start, end):
+        """
+        Return sequence[start:end] for a record as a string.
+        """
+        offset, length, exceptions_offset, exception_count = self.entry(record_id)
+        start = max(start, 0)
+        end = min(end, length)
+        if end <= start:
+            return ''
+
+        first_byte = start // 4
+        last_byte = (end + 3) // 4
+        packed = np.frombuffer(
+            self.data, dtype=np.uint8, count=last_byte - first_byte, offset=offset + first_byte
+        )
+        values = np.empty(len(packed) * 4, dtype=np.uint8)
+        values[0::4] = packed >> 6
+        values[1::4] = (packed >> 4) & 3
+        values[2::4] = (packed >> 2) & 3
+        values[3::4] = packed & 3
+        skip = start - first_byte * 4
+        sequence = BASES[values[skip:skip + end - start]]
+
+        if exception_count:
+            starts = np.frombuffer(
+                self.data, dtype='<i8', count=exception_count, offset=exceptions_offset
+            )
+            lengths = np.frombuffer(
+                self.data, dtype='<i8', count=exception_count,
+                offset=exceptions_offset + 8 * exception_count
+            )
+            characters = np.frombuffer(
+                self.data, dtype=np.uint8, count=exception_count,
+                offset=exceptions_offset + 16 * exception_count
+            )
+            overlapping = np.flatnonzero((starts < end) & (starts + lengths > start))
+            for i in overlapping:
+                run_start = max(starts[i], start) - start
+                run_end = min(starts[i] + lengths[i], end) - start
+                sequence[run_start:run_end] = characters[i]
+
+        return sequence.tobytes().decode('latin-1')
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
@@ -0,0 +1,342 @@
+"""
+A long running process that answers query.py and get_taxids.py requests over
+a Unix socket (or a TCP port on localhost), so that each one doesn't have to
+start Python, import Biopython and NumPy and open the taxonomy and index
+before it can do any work. Use client.py to send it requests.
+
+Each request is handled in a process forked from the server, which already
+has everything imported and open, so requests can't interfere with each
+other or with the server, and queries with --workers fork their workers
+from there too.
+
+The protocol is lines of JSON. The client sends one request:
+
+    {"command": "query", "args": ["--type", "CDS", ...], "cwd": "/some/dir"}
+
+where command is query or get_taxids (args are the same as for the script)
+or matches (see matches_parser), and cwd is the directory that relative
+paths in args are relative to. The server then sends back what the command
+prints, as {"stdout": text} and {"stderr": text} messages, and finally
+{"exit": status}.
+"""
+import os
+import io
+import sys
+import json
+import signal
+import socket
+import logging
+import argparse
+import traceback
+import socketserver
+import localgb
+import taxonomy
+import query
+import get_taxids
+
+SOCKET_FILENAME = 'localgb.sock'
+
+COMMANDS = ['query', 'get_taxids', 'matches']
+
+# the parsers were made when we imported the scripts, so they think that
+# they're serve.py
+query.parser.prog = 'query.py'
+get_taxids.parser.prog = 'get_taxids.py'
+
+matches_parser = argparse.ArgumentParser(
+    prog='matches',
+    description='Stream the features that match a query as JSON, one per line, with the record id, taxid, type, start, end, strand and qualifiers of each. The counts go to stderr at the end.'
+    )
+matches_parser.add_argument('--type', required=True, help='the feature type to look for')
+matches_parser.add_argument('--qualifier', help="the qualifier who's value you want to check")
+matches_parser.add_argument('--terms', nargs='+', help='the values you want to find in the qualifier')
+matches_parser.add_argument('--taxid-file', help='file with the taxids that we want to allow')
+matches_parser.add_argument('--files', nargs='+', help='genbank files to search (default: the ones the server has)')
+matches_parser.add_argument('--as-of-release', action='store_true', help='ignore the daily update files')
+matches_parser.add_argument('--sequences', action='store_true', help='include the sequence of each feature')
+matches_parser.add_argument('--translations', action='store_true', help='include the translation of each feature')
+
+
+class MessageStream(io.TextIOBase):
+    """
+    A text file that sends everything written to it back to the client as
+    {name: text} messages.
+    """
+
+    def __init__(self, connection_file, name, always_flush=False):
+        self.connection_file = connection_file
+        self.name = name
+        self.always_flush = always_flush
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if text:
+            self.connection_file.write((json.dumps({self.name: text}) + '\n').encode('utf-8'))
+            if self.always_flush:
+                self.connection_file.flush()
+        return len(text)
+
+    def flush(self):
+        self.connection_file.flush()
+
+
+def with_server_files(argv, genbank):
+    """
+    Queries search the server's files (with its index) unless they say
+    otherwise.
+    """
+    argv = list(argv)
+    if '--files' not in argv:
+        argv.extend(['--files'] + genbank.files)
+    if '--index' not in argv and genbank.index is not None:
+        argv.extend(['--index', genbank.index])
+    return argv
+
+
+def with_server_taxonomy(argv, taxonomy_directory):
+    """
+    get_taxids requests use the server's taxonomy unless they say otherwise,
+    wherever the client is.
+    """
+    argv = list(argv)
+    if '--taxonomy' not in argv:
+        argv.extend(['--taxonomy', taxonomy_directory])
+    return argv
+
+
+def stream_matches(genbank, args):
+    matches = genbank.query(
+        args.type, qualifier=args.qualifier, terms=args.terms, taxid_file=args.taxid_file,
+        as_of_release=args.as_of_release, files=args.files
+    )
+    for match in matches:
+        try:
+            start, end, strand = localgb.feature_span(match.feature)
+        except localgb.UnsupportedRecord:
+            start, end, strand = None, None, None
+        result = {
+            'record': match.record_id,
+            'taxid': match.taxid,
+            'type': match.feature.type,
+            'start': start,
+            'end': end,
+            'strand': strand,
+            'qualifiers': dict(match.feature.qualifiers),
+        }
+        if args.sequences:
+            result['sequence'] = match.sequence
+        if args.translations:
+            result['translation'] = match.translation
+        print(json.dumps(result))
+    print(json.dumps({'counts': matches.counts()}), file=sys.stderr)
+
+
+def run_request(genbank, taxonomy_directory, request):
+    """
+    Run a request in the (forked) process handling it, with sys.stdout and
+    sys.stderr already sending to the client, and return the exit status.
+    taxonomy_directory is the server's taxonomy, as an absolute path since
+    the request runs in the client's directory.
+    """
+    # so that the command's logging goes to the client too
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+
+    try:
+        os.chdir(request.get('cwd', os.getcwd()))
+        command = request.get('command')
+        argv = request.get('args', [])
+        if command == 'query':
+            query.main(query.parser.parse_args(with_server_files(argv, genbank)))
+        elif command == 'get_taxids':
+            get_taxids.main(get_taxids.parser.parse_args(
+                with_server_taxonomy(argv, taxonomy_directory)
+            ))
+        elif command == 'matches':
+            stream_matches(genbank, matches_parser.parse_args(argv))
+        else:
+            print('unknown command {}, should be one of {}'.format(
+                command, ', '.join(COMMANDS)
+            ), file=sys.stderr)
+            return 2
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def flush_before_fork():
+    """
+    Send whatever a request has written so far before it forks (e.g. its
+    search workers), so that the new process doesn't start with a copy of it
+    in the connection's buffer.
+    """
+    if isinstance(sys.stdout, MessageStream):
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+def detach_forked_child():
+    """
+    Processes forked by a request (e.g. its search workers) write to the
+    server's own stdout and stderr, not to the client, so that only the
+    request's process ever writes to the connection.
+    """
+    if isinstance(sys.stdout, MessageStream):
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        for handler in logging.root.handlers:
+            if isinstance(handler, logging.StreamHandler):
+                handler.setStream(sys.__stderr__)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    # stdout is buffered, stderr (progress bars and so on) isn't
+    wbufsize = 2 ** 16
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            self.wfile.write(b'{"stderr": "bad request\\n"}\n{"exit": 2}\n')
+            return
+        sys.stdout = MessageStream(self.wfile, 'stdout')
+        sys.stderr = MessageStream(self.wfile, 'stderr', always_flush=True)
+        try:
+            status = run_request(self.server.genbank, self.server.taxonomy_directory, request)
+            sys.stdout.flush()
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+        self.wfile.write((json.dumps({'exit': status}) + '\n').encode('utf-8'))
+
+
+class UnixServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+class TCPServer(socketserver.ForkingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+def remove_stale_socket(filename):
+    """
+    Remove a socket left behind by a server that didn't shut down cleanly,
+    but not one that a server is still listening on.
+    """
+    if not os.path.exists(filename):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(filename)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.remove(filename)
+    else:
+        raise SystemExit('a server is already listening on {}'.format(filename))
+    finally:
+        probe.close()
+
+
+def warm_up(genbank, taxonomy_directory):
+    """
+    Open everything that requests are likely to need, so that the processes
+    handling them start with it already open.
+    """
+    if genbank.index is not None:
+        # upgrades the index if it needs it, so that requests don't have to
+        localgb.open_index(genbank.index).close()
+    if os.path.exists(taxonomy_directory):
+        taxonomy.load(taxonomy_directory)
+        taxonomy.load_names(taxonomy_directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Keep localgb loaded and answer query.py and get_taxids.py requests from client.py'
+        )
+    parser.add_argument(
+        "-v", "--verbosity", action="count", help="show lots of debugging output", default=0
+    )
+    parser.add_argument(
+        '--socket',
+        default=SOCKET_FILENAME,
+        help='Unix socket to listen on (default: %(default)s). Only the user running the server can connect to it.'
+        )
+    parser.add_argument(
+        '--port',
+        type=int,
+        help='listen on this TCP port on localhost instead of a Unix socket. Note that any user on the machine can connect to it, and requests can read and write any files the server can, so it also needs --insecure-tcp.'
+        )
+    parser.add_argument(
+        '--insecure-tcp',
+        action='store_true',
+        help='needed with --port, to say that you understand that any user on the machine will be able to run queries as you'
+        )
+    parser.add_argument(
+        '--files',
+        nargs='+',
+        help='genbank files that queries search unless they give --files (default: the genbank files in the current directory)'
+        )
+    parser.add_argument(
+        '--index',
+        help='index that queries use unless they give --index (default: {} if it exists)'.format(localgb.INDEX_FILENAME)
+        )
+    parser.add_argument(
+        '--taxonomy',
+        default=taxonomy.TAXONOMY_DIRECTORY,
+        help='taxonomy directory that get_taxids requests use unless they give --taxonomy (default: %(default)s)'
+        )
+    args = parser.parse_args()
+    if args.port is not None and not args.insecure_tcp:
+        parser.error('any user on the machine can connect to a TCP port and read or write any files you can through it; use a Unix socket, or give --insecure-tcp as well as --port if that is really what you want')
+
+    if args.verbosity > 0:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    # requests run in the client's directory, so the server's paths have to
+    # work from anywhere
+    genbank = localgb.LocalGenBank(
+        files=[os.path.abspath(f) for f in args.files] if args.files is not None else None,
+        index=os.path.abspath(args.index) if args.index is not None else None
+    )
+    genbank.files = [os.path.abspath(f) for f in genbank.files]
+    if genbank.index is not None:
+        genbank.index = os.path.abspath(genbank.index)
+    taxonomy_directory = os.path.abspath(args.taxonomy)
+    warm_up(genbank, taxonomy_directory)
+    os.register_at_fork(before=flush_before_fork, after_in_child=detach_forked_child)
+
+    if args.port is not None:
+        server = TCPServer(('127.0.0.1', args.port), RequestHandler)
+        address = 'localhost port {}'.format(args.port)
+    else:
+        remove_stale_socket(args.socket)
+        old_umask = os.umask(0o077)
+        try:
+            server = UnixServer(args.socket, RequestHandler)
+        finally:
+            os.umask(old_umask)
+        address = args.socket
+    server.genbank = genbank
+    server.taxonomy_directory = taxonomy_directory
+
+    # shut down cleanly (and remove the socket) when killed
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
+    logging.info('serving {} files on {}'.format(len(genbank.files), address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.port is None and os.path.exists(args.socket):
+            os.remove(args.socket)
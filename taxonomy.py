@@ -0,0 +1,710 @@
+"""
+The NCBI taxonomy tree stored as NumPy arrays indexed by taxid, so that it
+can be memory-mapped rather than unpickled, and subtree questions are
+answered with arithmetic instead of by walking the tree.
+
+Each taxid gets a parent, a rank code and a nested set interval: start is
+the position of the taxid in a pre-order walk of the tree and end is one past
+the position of its last descendant, so a taxid is a descendant of another
+exactly when its start falls inside the other's interval. order lists the
+taxids in pre-order, which means the descendants of a taxid are the slice
+order[start + 1:end].
+
+For lowest common ancestors there's also a binary lifting table: ancestors[k]
+is the ancestor 2**k levels above each taxid (or the root if that's further
+up than the root), which lets us jump from a taxid to any ancestor in a
+handful of steps. Everything that takes taxids takes arrays of them, so that
+hundreds of thousands of queries go through NumPy rather than Python loops.
+
+Names from names.dmp are kept in a separate sorted index (see NameIndex) in
+the same directory.
+
+The directory is really a symlink to a versioned directory next to it.
+Rebuilding writes a complete new version and then swaps the symlink over,
+so readers (which resolve the symlink once when they open the taxonomy)
+always see a consistent set of files.
+"""
+import os
+import bisect
+import collections
+import contextlib
+import heapq
+import mmap
+import shutil
+import tarfile
+import tempfile
+from array import array
+import numpy as np
+
+TAXONOMY_DIRECTORY = 'taxonomy'
+
+NODES_FILENAME = 'nodes.dmp'
+NAMES_FILENAME = 'names.dmp'
+TAXDUMP_FILENAME = 'taxdump.tar.gz'
+
+ROOT_TAXID = 1
+
+ARRAYS = ['parent', 'rank', 'start', 'end', 'depth', 'order', 'ancestors']
+
+# the ranks that get_taxids.py --lineage reports by default
+MAIN_RANKS = [
+    'superkingdom', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species'
+]
+
+
+def read_nodes(nodes_file):
+    """
+    Read (taxid, parent, rank) from the lines of nodes.dmp.
+    """
+    for line in nodes_file:
+        taxid, parent, rank = line.rstrip('\t|\n').split('\t|\t')[0:3]
+        yield int(taxid), int(parent), rank
+
+
+@contextlib.contextmanager
+def updating(directory=TAXONOMY_DIRECTORY):
+    """
+    Context manager that gives a new empty directory to write files into,
+    and then makes it the current version of directory. Files from the
+    current version that weren't written are carried over, so the node
+    arrays and the name index can be rebuilt separately. If anything goes
+    wrong, the current version is left alone. The version that it replaces
+    is kept (as directory.previous) until the next time.
+    """
+    directory = directory.rstrip(os.sep)
+    parent_directory = os.path.dirname(os.path.abspath(directory))
+    new_version = tempfile.mkdtemp(prefix=os.path.basename(directory) + '.', dir=parent_directory)
+    try:
+        yield new_version
+    except BaseException:
+        shutil.rmtree(new_version)
+        raise
+
+    old_version = None
+    if os.path.islink(directory):
+        old_version = os.path.realpath(directory)
+    elif os.path.isdir(directory):
+        # a plain directory, from before we used versions
+        old_version = new_version + '.old'
+        os.rename(directory, old_version)
+    if old_version is not None and os.path.isdir(old_version):
+        for filename in os.listdir(old_version):
+            if not os.path.exists(os.path.join(new_version, filename)):
+                os.link(os.path.join(old_version, filename), os.path.join(new_version, filename))
+
+    os.chmod(new_version, 0o755)
+    link = new_version + '.link'
+    os.symlink(os.path.basename(new_version), link)
+    os.replace(link, directory)
+
+    # the version before is kept until the next rebuild, as readers that
+    # resolved the symlink just before we swapped it may still be opening
+    # its files; the one before that is deleted now
+    previous = directory + '.previous'
+    if os.path.islink(previous):
+        older_version = os.path.join(parent_directory, os.readlink(previous))
+        if os.path.isdir(older_version) and older_version != old_version:
+            shutil.rmtree(older_version)
+    if old_version is not None and os.path.isdir(old_version):
+        link = new_version + '.previous'
+        os.symlink(os.path.basename(old_version), link)
+        os.replace(link, previous)
+
+
+def build(nodes, directory=TAXONOMY_DIRECTORY):
+    """
+    Build the arrays from an iterable of (taxid, parent, rank), as returned by
+    read_nodes, and make them the current version in directory.
+    """
+    with updating(directory) as new_version:
+        write_nodes(nodes, new_version)
+
+
+def write_nodes(nodes, directory):
+    # array rather than lists of ints, which take several times the memory
+    taxids = array('i')
+    parents = array('i')
+    rank_names = []
+    rank_codes = {}
+    node_ranks = array('B')
+    for taxid, parent, rank in nodes:
+        taxids.append(taxid)
+        parents.append(parent)
+        if rank not in rank_codes:
+            rank_codes[rank] = len(rank_names)
+            rank_names.append(rank)
+        node_ranks.append(rank_codes[rank])
+
+    taxids = np.frombuffer(taxids, dtype=np.int32)
+    size = int(taxids.max()) + 1
+    parent = np.full(size, -1, dtype=np.int32)
+    parent[taxids] = np.frombuffer(parents, dtype=np.int32)
+    rank = np.full(size, 255, dtype=np.uint8)
+    rank[taxids] = np.frombuffer(node_ranks, dtype=np.uint8)
+
+    # the depth of every node, by following all the parents up at once
+    depth = np.full(size, -1, dtype=np.int32)
+    depth[taxids] = 0
+    current = taxids[taxids != ROOT_TAXID]
+    nodes_below = current
+    while len(current):
+        depth[nodes_below] += 1
+        parents_of_current = parent[current]
+        keep = (parents_of_current != ROOT_TAXID) & (parents_of_current != -1)
+        current = parents_of_current[keep]
+        nodes_below = nodes_below[keep]
+
+    # children grouped by depth, and sorted by parent (then taxid) within
+    # each depth
+    levels = []
+    max_depth = int(depth.max())
+    by_depth = taxids[np.lexsort((taxids, parent[taxids], depth[taxids]))]
+    level_bounds = np.searchsorted(depth[by_depth], np.arange(max_depth + 2))
+    for level in range(max_depth + 1):
+        levels.append(by_depth[level_bounds[level]:level_bounds[level + 1]])
+
+    # subtree sizes, from the bottom up
+    subtree_size = np.zeros(size, dtype=np.int32)
+    subtree_size[taxids] = 1
+    for level in reversed(levels[1:]):
+        np.add.at(subtree_size, parent[level], subtree_size[level])
+
+    # pre-order positions, from the top down: each child starts after its
+    # parent and all the subtrees of the siblings before it
+    start = np.full(size, -1, dtype=np.int32)
+    start[ROOT_TAXID] = 0
+    for level in levels[1:]:
+        sizes = subtree_size[level]
+        before = np.cumsum(sizes) - sizes
+        level_parents = parent[level]
+        first_sibling = np.flatnonzero(np.r_[True, level_parents[1:] != level_parents[:-1]])
+        group_offsets = np.repeat(before[first_sibling], np.diff(np.r_[first_sibling, len(level)]))
+        start[level] = start[level_parents] + 1 + before - group_offsets
+    end = np.full(size, -1, dtype=np.int32)
+    end[taxids] = start[taxids] + subtree_size[taxids]
+
+    order = np.empty(len(taxids), dtype=np.int32)
+    order[start[taxids]] = taxids
+
+    # binary lifting table; missing taxids point at 0, which points at itself
+    ancestors = np.empty((max(max_depth, 1).bit_length(), size), dtype=np.int32)
+    ancestors[0] = np.where(parent >= 0, parent, 0)
+    ancestors[0][ROOT_TAXID] = ROOT_TAXID
+    for k in range(1, len(ancestors)):
+        ancestors[k] = ancestors[k - 1][ancestors[k - 1]]
+
+    save(directory, dict(
+        parent=parent, rank=rank, start=start, end=end, depth=depth, order=order,
+        ancestors=ancestors
+    ), {'ranks.txt': ''.join(name + '\n' for name in rank_names).encode()})
+
+
+def save(directory, arrays, files):
+    """
+    Save a dict of name to array as .npy files, and a dict of filename to
+    bytes as plain files, in directory.
+    """
+    for name, values in arrays.items():
+        np.save(os.path.join(directory, name + '.npy'), values)
+    for filename, data in files.items():
+        with open(os.path.join(directory, filename), 'wb') as output:
+            output.write(data)
+
+
+def build_from_dump(nodes_filename=NODES_FILENAME, directory=TAXONOMY_DIRECTORY):
+    with open(nodes_filename, encoding='utf-8') as nodes_file:
+        build(read_nodes(nodes_file), directory)
+
+
+def build_from_taxdump(taxdump_filename=TAXDUMP_FILENAME, directory=TAXONOMY_DIRECTORY):
+    """
+    Build the node arrays and the name index straight from the compressed
+    taxonomy dump, in a single pass through the tar file and without
+    extracting anything to disk.
+    """
+    with updating(directory) as new_version:
+        # r|gz reads the tar as a stream, so each member has to be dealt
+        # with as we come to it
+        with tarfile.open(taxdump_filename, 'r|gz') as tar:
+            for member in tar:
+                if member.name not in (NODES_FILENAME, NAMES_FILENAME):
+                    continue
+                # (TextIOWrapper doesn't work on members of a streamed tar)
+                dump_file = (line.decode('utf-8') for line in tar.extractfile(member))
+                if member.name == NODES_FILENAME:
+                    write_nodes(read_nodes(dump_file), new_version)
+                else:
+                    write_names(read_names(dump_file), new_version)
+
+
+def rebuild(directory, dump_filename, build_from_dump_function):
+    """
+    Rebuild part of the taxonomy for load() and load_names(): from the
+    taxonomy dump if we have it, otherwise from the extracted file. Both are
+    looked for next to the directory (where update.py puts them), rather
+    than in the current directory.
+    """
+    dump_directory = os.path.dirname(os.path.abspath(directory))
+    taxdump_filename = os.path.join(dump_directory, TAXDUMP_FILENAME)
+    if os.path.exists(taxdump_filename):
+        build_from_taxdump(taxdump_filename, directory)
+    else:
+        build_from_dump_function(os.path.join(dump_directory, dump_filename), directory)
+
+
+# the taxonomies and name indexes that have been opened, by the version
+# directory they came from, so that a long running process (like serve.py)
+# only opens them once, but still picks up a rebuilt taxonomy
+opened = {}
+
+
+def open_cached(cls, directory):
+    key = (cls, os.path.realpath(directory))
+    if key not in opened:
+        opened[key] = cls(directory)
+    return opened[key]
+
+
+def load(directory=TAXONOMY_DIRECTORY, nodes_filename=NODES_FILENAME):
+    """
+    Open the taxonomy, building it first if it's missing or was built by an
+    older version.
+    """
+    if not all(
+        os.path.exists(os.path.join(directory, name + '.npy')) for name in ARRAYS
+    ):
+        rebuild(directory, nodes_filename, build_from_dump)
+    return open_cached(Taxonomy, directory)
+
+
+class Taxonomy(object):
+    """
+    The taxonomy arrays, memory-mapped from directory. Loading is instant and
+    only the pages that are actually used are read.
+    """
+
+    def __init__(self, directory=TAXONOMY_DIRECTORY):
+        # so that all the files come from the same version
+        directory = os.path.realpath(directory)
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+        with open(os.path.join(directory, 'ranks.txt')) as ranks_file:
+            self.rank_names = ranks_file.read().splitlines()
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, taxid):
+        return 0 <= taxid < len(self.parent) and self.parent[taxid] != -1
+
+    def check(self, taxid):
+        if taxid not in self:
+            raise KeyError('taxid {} is not in the taxonomy'.format(taxid))
+
+    def check_all(self, taxids):
+        """
+        Check an array of taxids, and return it as an int array.
+        """
+        taxids = np.asarray(taxids, dtype=np.int64)
+        missing = (taxids < 0) | (taxids >= len(self.parent))
+        missing[~missing] = self.parent[taxids[~missing]] == -1
+        if missing.any():
+            raise KeyError('taxid {} is not in the taxonomy'.format(taxids[missing][0]))
+        return taxids
+
+    def get_rank(self, taxid):
+        self.check(taxid)
+        return self.rank_names[self.rank[taxid]]
+
+    def get_parent(self, taxid):
+        self.check(taxid)
+        return int(self.parent[taxid])
+
+    def descendants(self, taxid):
+        """
+        All the taxids below taxid (not including taxid itself) as an array,
+        in pre-order.
+        """
+        self.check(taxid)
+        return self.order[self.start[taxid] + 1:self.end[taxid]]
+
+    def is_descendant(self, taxids, ancestor):
+        """
+        Return a boolean array saying which of an array of taxids are below
+        ancestor. Taxids that aren't in the taxonomy are never descendants.
+        """
+        self.check(ancestor)
+        taxids = np.asarray(taxids)
+        positions = np.full(taxids.shape, -1, dtype=np.int64)
+        in_range = (taxids >= 0) & (taxids < len(self.start))
+        positions[in_range] = self.start[taxids[in_range]]
+        return (positions > self.start[ancestor]) & (positions < self.end[ancestor])
+
+    def selection(self):
+        return TaxidSelection(self)
+
+    def lift(self, taxids, levels):
+        """
+        Return the ancestors of an array of taxids the given number of levels
+        up (stopping at the root).
+        """
+        taxids = np.array(taxids, dtype=np.int64)
+        levels = np.asarray(levels)
+        for k in range(len(self.ancestors)):
+            move = (levels >> k) & 1 == 1
+            taxids[move] = self.ancestors[k][taxids[move]]
+        return taxids
+
+    def lca(self, taxids_a, taxids_b):
+        """
+        Return the lowest common ancestor of each pair of taxids from two
+        arrays of the same length.
+        """
+        a = self.check_all(taxids_a)
+        b = self.check_all(taxids_b)
+        depth_a = self.depth[a]
+        depth_b = self.depth[b]
+        # bring the deeper of each pair up to the same depth as the other
+        a = self.lift(a, np.maximum(depth_a - depth_b, 0))
+        b = self.lift(b, np.maximum(depth_b - depth_a, 0))
+        # then jump both up as far as we can without them meeting
+        for k in reversed(range(len(self.ancestors))):
+            up_a = self.ancestors[k][a]
+            up_b = self.ancestors[k][b]
+            move = up_a != up_b
+            a[move] = up_a[move]
+            b[move] = up_b[move]
+        return np.where(a == b, a, self.ancestors[0][a])
+
+    def lca_of_sets(self, taxid_sets):
+        """
+        Return an array with the lowest common ancestor of each of a list of
+        taxid arrays. Within a set, the LCA of everything is the LCA of the
+        first and last members in pre-order, so each set is only one pair.
+        """
+        lengths = np.array([len(taxids) for taxids in taxid_sets])
+        if (lengths == 0).any():
+            raise ValueError("can't find the LCA of an empty set of taxids")
+        if len(taxid_sets) == 0:
+            return np.zeros(0, dtype=np.int64)
+        taxids = self.check_all(np.concatenate([np.asarray(t) for t in taxid_sets]))
+        positions = self.start[taxids]
+        set_starts = np.r_[0, np.cumsum(lengths)[:-1]]
+        first = np.minimum.reduceat(positions, set_starts)
+        last = np.maximum.reduceat(positions, set_starts)
+        return self.lca(self.order[first], self.order[last])
+
+    def lineage(self, taxid):
+        """
+        The taxids from the root down to taxid.
+        """
+        self.check(taxid)
+        result = [taxid]
+        while taxid != ROOT_TAXID:
+            taxid = int(self.parent[taxid])
+            result.append(taxid)
+        return result[::-1]
+
+    def ranked_lineages(self, taxids, ranks=MAIN_RANKS):
+        """
+        Return an array with a row for each of an array of taxids and a column
+        for each of ranks, giving the ancestor (or the taxid itself) at that
+        rank, or 0 if there isn't one.
+        """
+        current = self.check_all(taxids).copy()
+        result = np.zeros((len(current), len(ranks)), dtype=np.int64)
+        rank_codes = [
+            self.rank_names.index(rank) if rank in self.rank_names else -1 for rank in ranks
+        ]
+        active = np.ones(len(current), dtype=bool)
+        while active.any():
+            current_ranks = self.rank[current]
+            for column, code in enumerate(rank_codes):
+                # if a rank appears more than once, keep the lowest
+                found = active & (current_ranks == code) & (result[:, column] == 0)
+                result[found, column] = current[found]
+            active &= current != ROOT_TAXID
+            current = np.where(active, self.parent[current], current)
+        return result
+
+
+class TaxidSelection(object):
+    """
+    A set of taxids built up by including and excluding whole subtrees, stored
+    as a flag for each pre-order position.
+    """
+
+    def __init__(self, taxonomy):
+        self.taxonomy = taxonomy
+        self.selected = np.zeros(len(taxonomy), dtype=bool)
+
+    def include(self, taxid):
+        """
+        Add the descendants of taxid (but not taxid itself).
+        """
+        self.taxonomy.check(taxid)
+        self.selected[self.taxonomy.start[taxid] + 1:self.taxonomy.end[taxid]] = True
+
+    def exclude(self, taxid):
+        """
+        Remove the descendants of taxid (but not taxid itself).
+        """
+        self.taxonomy.check(taxid)
+        self.selected[self.taxonomy.start[taxid] + 1:self.taxonomy.end[taxid]] = False
+
+    def __len__(self):
+        return int(np.count_nonzero(self.selected))
+
+    def taxids(self):
+        return self.taxonomy.order[self.selected]
+
+
+NAME_ARRAYS = ['name_key_offsets', 'name_offsets', 'name_taxids', 'name_classes']
+NAME_FILES = ['name_keys.bin', 'names.bin', 'name_classes.txt']
+
+
+def name_key(name):
+    """
+    Names are looked up ignoring case.
+    """
+    return name.lower()
+
+
+def read_names(names_file):
+    """
+    Read (taxid, name, name class) from the lines of names.dmp.
+    """
+    for line in names_file:
+        taxid, name, unique_name, name_class = line.rstrip('\t|\n').split('\t|\t')
+        yield int(taxid), name, name_class
+
+
+def build_names(names, directory=TAXONOMY_DIRECTORY):
+    """
+    Build the name index from an iterable of (taxid, name, name class), as
+    returned by read_names, and make it the current version in directory.
+    """
+    with updating(directory) as new_version:
+        write_names(names, new_version)
+
+
+# names are sorted in runs of this many, which are spilled to temporary files
+# and merged, so building the name index doesn't need all of names.dmp in
+# memory at once
+NAME_RUN_SIZE = 250000
+
+
+def spill_run(entries, directory):
+    """
+    Write a sorted run of (key, class code, taxid, name) entries to a
+    temporary file in directory, one per line with tabs between the fields
+    (which names.dmp uses for its delimiters, so names never contain them).
+    """
+    run_file = tempfile.TemporaryFile(dir=directory)
+    for key, class_code, taxid, name in entries:
+        run_file.write(b'%s\t%d\t%d\t%s\n' % (key, class_code, taxid, name))
+    run_file.seek(0)
+    return run_file
+
+
+def read_run(run_file):
+    for line in run_file:
+        key, class_code, taxid, name = line.rstrip(b'\n').split(b'\t', 3)
+        yield key, int(class_code), int(taxid), name
+
+
+def write_names(names, directory):
+    class_codes = {}
+    class_names = []
+    run_files = []
+    entries = []
+    for taxid, name, name_class in names:
+        if name_class not in class_codes:
+            class_codes[name_class] = len(class_names)
+            class_names.append(name_class)
+        # sorted by the bytes of the key, so that bisecting the encoded keys
+        # works
+        entries.append((
+            name_key(name).encode('utf-8'), class_codes[name_class], taxid, name.encode('utf-8')
+        ))
+        if len(entries) == NAME_RUN_SIZE:
+            entries.sort()
+            run_files.append(spill_run(entries, directory))
+            entries = []
+    # the last run doesn't need spilling
+    entries.sort()
+
+    # array rather than lists of ints, like write_nodes
+    key_offsets = array('q', [0])
+    name_offsets = array('q', [0])
+    taxids = array('i')
+    classes = array('B')
+    try:
+        with open(os.path.join(directory, 'name_keys.bin'), 'wb') as keys_file, \
+                open(os.path.join(directory, 'names.bin'), 'wb') as names_file:
+            runs = [read_run(run_file) for run_file in run_files] + [entries]
+            for key, class_code, taxid, name in heapq.merge(*runs):
+                keys_file.write(key)
+                names_file.write(name)
+                key_offsets.append(key_offsets[-1] + len(key))
+                name_offsets.append(name_offsets[-1] + len(name))
+                taxids.append(taxid)
+                classes.append(class_code)
+    finally:
+        for run_file in run_files:
+            run_file.close()
+
+    save(directory, dict(
+        name_key_offsets=np.frombuffer(key_offsets, dtype=np.int64),
+        name_offsets=np.frombuffer(name_offsets, dtype=np.int64),
+        name_taxids=np.frombuffer(taxids, dtype=np.int32),
+        name_classes=np.frombuffer(classes, dtype=np.uint8),
+    ), {
+        'name_classes.txt': ''.join(name + '\n' for name in class_names).encode(),
+    })
+
+
+def build_names_from_dump(names_filename=NAMES_FILENAME, directory=TAXONOMY_DIRECTORY):
+    with open(names_filename, encoding='utf-8') as names_file:
+        build_names(read_names(names_file), directory)
+
+
+def load_names(directory=TAXONOMY_DIRECTORY, names_filename=NAMES_FILENAME):
+    """
+    Open the name index, building it first if it's missing.
+    """
+    if not all(
+        os.path.exists(os.path.join(directory, name + '.npy')) for name in NAME_ARRAYS
+    ) or not all(
+        os.path.exists(os.path.join(directory, filename)) for filename in NAME_FILES
+    ):
+        rebuild(directory, names_filename, build_names_from_dump)
+    return open_cached(NameIndex, directory)
+
+
+class MappedStrings(object):
+    """
+    A read-only sequence of byte strings stored end to end in a memory-mapped
+    file, with an array of offsets. Works with bisect.
+    """
+
+    def __init__(self, filename, offsets):
+        self.file = open(filename, 'rb')
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b''
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+
+NameMatch = collections.namedtuple('NameMatch', 'name taxid name_class distance')
+
+
+class NameIndex(object):
+    """
+    Every name in names.dmp, sorted by lowercased name and memory-mapped, so
+    that a lookup only reads the few pages that a binary search touches.
+    """
+
+    def __init__(self, directory=TAXONOMY_DIRECTORY):
+        directory = os.path.realpath(directory)
+        for name in NAME_ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r'))
+        self.keys = MappedStrings(os.path.join(directory, 'name_keys.bin'), self.name_key_offsets)
+        self.names = MappedStrings(os.path.join(directory, 'names.bin'), self.name_offsets)
+        with open(os.path.join(directory, 'name_classes.txt')) as classes_file:
+            self.class_names = classes_file.read().splitlines()
+
+    def match(self, i, distance=0):
+        return NameMatch(
+            self.names[i].decode('utf-8'), int(self.name_taxids[i]),
+            self.class_names[self.name_classes[i]], distance
+        )
+
+    def key_range(self, key, start=0):
+        """
+        Return the range of positions of keys that start with key, looking
+        from start onwards.
+        """
+        encoded = key.encode('utf-8')
+        first = bisect.bisect_left(self.keys, encoded, start)
+        # no UTF-8 encoded string contains 0xff
+        last = bisect.bisect_left(self.keys, encoded + b'\xff', first)
+        return first, last
+
+    def exact(self, name):
+        """
+        Return a list of NameMatches for name, ignoring case.
+        """
+        encoded = name_key(name).encode('utf-8')
+        first = bisect.bisect_left(self.keys, encoded)
+        last = bisect.bisect_right(self.keys, encoded, first)
+        return [self.match(i) for i in range(first, last)]
+
+    def prefix(self, prefix, limit=100):
+        """
+        Return NameMatches for up to limit names that start with prefix,
+        ignoring case, in alphabetical order.
+        """
+        first, last = self.key_range(name_key(prefix))
+        return [self.match(i) for i in range(first, min(last, first + limit))]
+
+    def fuzzy(self, name, max_distance=2, limit=100):
+        """
+        Return NameMatches for up to limit names within max_distance edits
+        (insertions, deletions or substitutions) of name, ignoring case,
+        closest first.
+
+        The sorted keys are walked as though they were a trie: the edit
+        distance table for each key reuses the rows for the prefix it shares
+        with the previous key, and as soon as a prefix is too far from the
+        name to ever come back within max_distance, every key starting with
+        that prefix is skipped with a binary search.
+        """
+        query = name_key(name)
+        first_row = list(range(len(query) + 1))
+        rows = [first_row]
+        previous_key = ''
+        matches = []
+        i = 0
+        while i < len(self.keys):
+            key = self.keys[i].decode('utf-8')
+            shared = 0
+            limit_shared = min(len(key), len(previous_key), len(rows) - 1)
+            while shared < limit_shared and key[shared] == previous_key[shared]:
+                shared += 1
+            del rows[shared + 1:]
+
+            dead_end = None
+            for position in range(shared, len(key)):
+                above = rows[-1]
+                row = [above[0] + 1]
+                character = key[position]
+                for column in range(1, len(query) + 1):
+                    row.append(min(
+                        row[column - 1] + 1,
+                        above[column] + 1,
+                        above[column - 1] + (query[column - 1] != character)
+                    ))
+                rows.append(row)
+                if min(row) > max_distance:
+                    dead_end = position + 1
+                    break
+
+            if dead_end is not None:
+                previous_key = key[:dead_end]
+                i = self.key_range(previous_key, i)[1]
+                continue
+            previous_key = key
+            if rows[-1][-1] <= max_distance:
+                matches.append((rows[-1][-1], i))
+            i += 1
+
+        matches.sort()
+        return [self.match(i, distance) for distance, i in matches[:limit]]
@@ -0,0 +1,116 @@
+import io
+import os
+import gzip
+import random
+import bgzf
+import localgb
+
+
+def make_data(size, seed=1):
+    """
+    Some text that compresses well, with runs of random bytes that don't (and
+    so are stored uncompressed in their blocks).
+    """
+    rng = random.Random(seed)
+    chunks = []
+    while sum(len(chunk) for chunk in chunks) < size:
+        if rng.random() < 0.2:
+            chunks.append(bytes(rng.getrandbits(8) for i in range(rng.randint(1, 70000))))
+        else:
+            chunks.append(' '.join(rng.choice(['acgt', 'gene', 'CDS', '//']) for i in range(2000)).encode())
+    return b''.join(chunks)[:size]
+
+
+def write_data(tmp_path, data):
+    filename = str(tmp_path / 'data.gz')
+    assert bgzf.write_bgzf(io.BytesIO(data), filename) == len(data)
+    return filename
+
+
+def test_bgzf_files_are_gzip_files(tmp_path):
+    data = make_data(500000)
+    filename = write_data(tmp_path, data)
+    with gzip.open(filename, 'rb') as gzip_file:
+        assert gzip_file.read() == data
+    compressed_offsets, uncompressed_offsets = bgzf.read_index(filename)
+    assert uncompressed_offsets == list(range(0, len(data), bgzf.BLOCK_SIZE))
+
+
+def test_seek_and_read_across_blocks(tmp_path):
+    data = make_data(500000)
+    filename = write_data(tmp_path, data)
+    rng = random.Random(2)
+    boundaries = list(range(0, len(data), bgzf.BLOCK_SIZE))
+    with bgzf.BgzfReader(filename) as reader:
+        assert reader.size == len(data)
+        assert reader.read(100) == data[:100]
+        offsets = [rng.randrange(len(data)) for i in range(200)]
+        offsets += [boundary + delta for boundary in boundaries for delta in (-1, 0, 1)]
+        for offset in offsets:
+            offset = max(offset, 0)
+            size = rng.choice([0, 1, 10, bgzf.BLOCK_SIZE, 3 * bgzf.BLOCK_SIZE])
+            reader.seek(offset)
+            assert reader.read(size) == data[offset:offset + size]
+            assert reader.tell() == min(offset + size, len(data))
+        reader.seek(len(data) - 10)
+        assert reader.read() == data[-10:]
+        assert reader.read() == b''
+
+
+def test_reads_stop_at_end(tmp_path):
+    data = make_data(300000)
+    filename = write_data(tmp_path, data)
+    end = 2 * bgzf.BLOCK_SIZE + 17
+    with bgzf.BgzfReader(filename, end=end) as reader:
+        reader.seek(1000)
+        assert reader.read() == data[1000:end]
+        reader.seek(end - 5)
+        buffer = bytearray(100)
+        assert reader.readinto(buffer) == 5
+        assert bytes(buffer[:5]) == data[end - 5:end]
+
+
+def test_is_bgzf(tmp_path):
+    data = make_data(100000)
+    filename = write_data(tmp_path, data)
+    assert bgzf.is_bgzf(filename)
+
+    # an ordinary gzip file with a stale index next to it
+    gzip_filename = str(tmp_path / 'plain.gz')
+    with gzip.open(gzip_filename, 'wb') as gzip_file:
+        gzip_file.write(data)
+    with open(bgzf.index_filename(gzip_filename), 'wb') as index_file:
+        index_file.write(b'\0' * 8)
+    assert not bgzf.is_bgzf(gzip_filename)
+
+    os.remove(bgzf.index_filename(filename))
+    assert not bgzf.is_bgzf(filename)
+
+
+def test_converted_files_have_the_same_records(mirror):
+    for filename in ('gbinv1.seq', 'gbinv2.seq.gz'):
+        expected = list(localgb.read_records(filename))
+        assert len(expected) > 2 and expected[-1] == ''
+        bgzf.convert(filename)
+        assert bgzf.is_bgzf(filename)
+        assert not os.path.exists(filename + '.bgzf.tmp')
+        assert list(localgb.read_records(filename)) == expected
+
+        # split into several chunks, the records are still all there once
+        # (each chunk ends with an empty piece after its last delimiter, like
+        # the whole file does)
+        chunks = localgb.split_file(filename, chunk_size=20000)
+        assert len(chunks) > 2
+        assert [
+            record
+            for filename, start, end, spans in chunks
+            for record in localgb.read_records(filename, start, end)
+            if record
+        ] == expected[:-1]
+
+        spans = [
+            (offset, length)
+            for locus, accession, version, taxid, offset, length, record
+            in localgb.index_file_records(filename)
+        ]
+        assert list(localgb.read_spans(filename, spans[::3])) == expected[:-1][::3]
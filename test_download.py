@@ -0,0 +1,182 @@
+import os
+import time
+import multiprocessing
+import pytest
+import localgb
+
+pyftpdlib = pytest.importorskip('pyftpdlib')
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+DATA = bytes(range(256)) * 4000
+
+
+class FailingHandler(FTPHandler):
+    """
+    Serves the files in the server's root, but the first few RETRs of each
+    file can be made to fail: 'short' sends only the first half of the file
+    and 'hang up' also closes the connection once it has been sent. Writes
+    what happens to log_filename.
+    """
+    failures = {}
+    log_filename = None
+
+    def log_event(self, *event):
+        with open(self.log_filename, 'a') as log_file:
+            log_file.write(' '.join(str(x) for x in event) + '\n')
+
+    def on_connect(self):
+        self.log_event('connect')
+
+    def on_disconnect(self):
+        self.log_event('disconnect')
+
+    def ftp_REST(self, line):
+        self.log_event('REST', line)
+        return FTPHandler.ftp_REST(self, line)
+
+    def ftp_RETR(self, file):
+        self.log_event('RETR')
+        name = os.path.basename(file)
+        self.hang_up = False
+        if self.failures.get(name):
+            failure = self.failures[name].pop(0)
+            self.hang_up = failure == 'hang up'
+            with open(file, 'rb') as whole_file:
+                data = whole_file.read()
+            file = file + '.short'
+            with open(file, 'wb') as short_file:
+                short_file.write(data[:len(data) // 2])
+        return FTPHandler.ftp_RETR(self, file)
+
+    def on_file_sent(self, file):
+        if self.hang_up:
+            self.close()
+
+
+def serve(root, log_filename, failures, connection):
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(root)
+    FailingHandler.authorizer = authorizer
+    FailingHandler.failures = failures
+    FailingHandler.log_filename = log_filename
+    server = FTPServer(('127.0.0.1', 0), FailingHandler)
+    connection.send(server.socket.getsockname()[1])
+    server.serve_forever(timeout=0.1)
+
+
+class TestServer(object):
+    """
+    An FTP server in a process of its own (pyftpdlib changes directory while
+    it works, which would pull the rug out from under the downloads if it ran
+    in a thread of ours).
+    """
+    __test__ = False
+
+    def __init__(self, directory, failures=None):
+        root = directory / 'server'
+        (root / 'genbank').mkdir(parents=True)
+        (root / 'genbank' / 'gbinv1.seq.gz').write_bytes(DATA)
+        self.log_filename = str(directory / 'server.log')
+        open(self.log_filename, 'w').close()
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.get_context('fork').Process(
+            target=serve, args=(str(root), self.log_filename, failures or {}, sender)
+        )
+        self.process.start()
+        self.port = receiver.recv()
+
+    def events(self, kind=None):
+        with open(self.log_filename) as log_file:
+            events = [line.split() for line in log_file]
+        return [event for event in events if kind is None or event[0] == kind]
+
+    def open_sessions(self):
+        """
+        How many connections are still open, once they've had a moment to
+        close.
+        """
+        deadline = time.time() + 5
+        while True:
+            sessions = len(self.events('connect')) - len(self.events('disconnect'))
+            if sessions == 0 or time.time() > deadline:
+                return sessions
+            time.sleep(0.05)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+@pytest.fixture
+def start_server(tmp_path, monkeypatch):
+    servers = []
+
+    def start(failures=None):
+        server = TestServer(tmp_path, failures)
+        servers.append(server)
+        monkeypatch.setattr(localgb, 'FTP_HOST', '127.0.0.1')
+        monkeypatch.setattr(localgb, 'FTP_PORT', server.port)
+        monkeypatch.setattr(localgb, 'FTP_TIMEOUT', 10)
+        return server
+
+    download_directory = tmp_path / 'mirror'
+    download_directory.mkdir()
+    monkeypatch.chdir(download_directory)
+    yield start
+    for server in servers:
+        server.stop()
+
+
+def test_download(start_server):
+    server = start_server()
+    localgb.download_files([('gbinv1.seq.gz', {'size': str(len(DATA))})], 'genbank', connections=2)
+    with open('gbinv1.seq.gz', 'rb') as downloaded:
+        assert downloaded.read() == DATA
+    assert not os.path.exists('gbinv1.seq.gz' + localgb.PARTIAL_SUFFIX)
+    assert server.events('REST') == []
+    assert server.open_sessions() == 0
+
+
+def test_resume_from_partial_file(start_server):
+    server = start_server()
+    with open('gbinv1.seq.gz' + localgb.PARTIAL_SUFFIX, 'wb') as partial_file:
+        partial_file.write(DATA[:1000])
+    localgb.download_files([('gbinv1.seq.gz', {'size': str(len(DATA))})], 'genbank')
+    with open('gbinv1.seq.gz', 'rb') as downloaded:
+        assert downloaded.read() == DATA
+    assert server.events('REST') == [['REST', '1000']]
+    assert len(server.events('RETR')) == 1
+
+
+def test_interrupted_download_reconnects_and_resumes(start_server):
+    server = start_server({'gbinv1.seq.gz': ['hang up']})
+    localgb.download_files([('gbinv1.seq.gz', {'size': str(len(DATA))})], 'genbank')
+    with open('gbinv1.seq.gz', 'rb') as downloaded:
+        assert downloaded.read() == DATA
+    assert len(server.events('RETR')) == 2
+    assert len(server.events('connect')) == 2
+    assert server.events('REST') == [['REST', str(len(DATA) // 2)]]
+    assert server.open_sessions() == 0
+
+
+def test_size_mismatch_is_retried(start_server):
+    server = start_server({'gbinv1.seq.gz': ['short']})
+    localgb.download_files([('gbinv1.seq.gz', {'size': str(len(DATA))})], 'genbank')
+    with open('gbinv1.seq.gz', 'rb') as downloaded:
+        assert downloaded.read() == DATA
+    assert len(server.events('RETR')) == 2
+    assert server.events('REST') == [['REST', str(len(DATA) // 2)]]
+
+
+def test_gives_up_after_retries_and_closes_connections(start_server, monkeypatch):
+    server = start_server()
+    monkeypatch.setattr(localgb, 'DOWNLOAD_RETRIES', 2)
+    # the server's file is never as big as the listing says
+    with pytest.raises(IOError):
+        localgb.download_files([('gbinv1.seq.gz', {'size': str(len(DATA) + 10)})], 'genbank')
+    assert len(server.events('RETR')) == 3
+    assert not os.path.exists('gbinv1.seq.gz')
+    assert os.path.getsize('gbinv1.seq.gz' + localgb.PARTIAL_SUFFIX) == len(DATA)
+    assert server.open_sessions() == 0
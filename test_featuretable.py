@@ -0,0 +1,118 @@
+import io
+import json
+import random
+import pytest
+
+np = pytest.importorskip('numpy')
+import featuretable
+import query
+from conftest import run_query
+
+QUALIFIERS = ['product', 'gene']
+
+
+def random_rows(rng, count):
+    rows = []
+    for i in range(count):
+        rows.append([
+            'AB{:06d}'.format(i), rng.choice([1, 2, None]), rng.choice([7227, None]),
+            rng.choice(['CDS', 'gene']), rng.randint(0, 1000), rng.randint(1000, 2000),
+            rng.choice([1, -1, 0]), rng.choice(['enolase', 'énolase ü', '', None]),
+            rng.choice(['eno', None]), rng.choice(['ACGT' * rng.randint(0, 5), None]),
+        ])
+    return rows
+
+
+def write_table(filename, rows, sequences=True):
+    """
+    Write rows through a FeatureTableWriter the way the search does, as lines
+    of JSON split up into pieces of any size.
+    """
+    rng = random.Random(1)
+    text = ''.join(json.dumps(row) + '\n' for row in rows)
+    writer = featuretable.FeatureTableWriter(filename, QUALIFIERS, sequences)
+    position = 0
+    while position < len(text):
+        size = rng.randint(1, 200)
+        writer.write(text[position:position + size])
+        position += size
+    writer.close()
+    return writer
+
+
+def test_npz_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(featuretable, 'ROW_GROUP_SIZE', 7)
+    rows = random_rows(random.Random(2), 50)
+    filename = str(tmp_path / 'table.npz')
+    assert featuretable.table_format(filename) == 'npz'
+    writer = write_table(filename, rows)
+    assert writer.row_count == 50
+    assert writer.chunk_count == 8
+
+    table = featuretable.read_npz_table(filename)
+    columns = featuretable.table_columns(QUALIFIERS, sequences=True)
+    assert list(table) == [name for name, kind in columns]
+    for column, (name, kind) in enumerate(columns):
+        # missing values come back as -1 and ''
+        missing = -1 if kind == 'int' else ''
+        expected = [missing if row[column] is None else row[column] for row in rows]
+        assert table[name].tolist() == expected
+        assert table[name].dtype == (np.int64 if kind == 'int' else object)
+
+
+def test_empty_table(tmp_path):
+    filename = str(tmp_path / 'table.npz')
+    write_table(filename, [], sequences=False)
+    table = featuretable.read_npz_table(filename)
+    assert list(table) == [name for name, kind in featuretable.table_columns(QUALIFIERS)]
+    assert all(len(values) == 0 for values in table.values())
+
+
+def test_rows_need_every_column(tmp_path):
+    writer = featuretable.FeatureTableWriter(str(tmp_path / 'table.npz'), QUALIFIERS)
+    with pytest.raises(ValueError):
+        writer.write(json.dumps(['AB000001', 1, 7227, 'CDS', 0, 10, 1]) + '\n')
+    writer.close()
+
+
+def test_parquet_round_trip(tmp_path):
+    pytest.importorskip('pyarrow')
+    rows = random_rows(random.Random(3), 30)
+    filename = str(tmp_path / 'table.parquet')
+    write_table(filename, rows)
+    table = featuretable.read_feature_table(filename)
+    for column, (name, kind) in enumerate(featuretable.table_columns(QUALIFIERS, sequences=True)):
+        values = [None if value != value else value for value in list(table[name])]
+        assert values == [row[column] for row in rows]
+
+
+def test_feature_table_matches_the_records(mirror):
+    from Bio import SeqIO
+    files = sorted(mirror)
+    search = ['--files', *files, '--type', 'CDS', '--qualifier', 'product', '--terms', 'enolase']
+    query.main(query.parser.parse_args(search + [
+        '--feature-table', '--output', 'table.npz',
+        '--table-qualifiers', 'product', 'codon_start', 'note', '--table-sequences'
+    ]))
+    table = featuretable.read_npz_table('table.npz')
+
+    expected = []
+    for filename in files:
+        for text in mirror[filename]:
+            record = SeqIO.read(io.StringIO(text), 'genbank')
+            accession, version = record.id.split('.')
+            for feature in record.features:
+                if feature.type == 'CDS' and feature.qualifiers['product'][0].lower() == 'enolase':
+                    expected.append((
+                        accession, int(version), int(text.split('taxon:')[1].split('"')[0]),
+                        'CDS', int(feature.location.start), int(feature.location.end),
+                        feature.location.strand, feature.qualifiers['product'][0], '1', ''
+                    ))
+    assert len(expected) > 5
+    assert list(zip(*(table[name].tolist() for name in [
+        'accession', 'version', 'taxid', 'type', 'start', 'end', 'strand',
+        'product', 'codon_start', 'note'
+    ]))) == expected
+
+    fasta = run_query(*search, '--fasta-features').decode()
+    assert table['sequence'].tolist() == fasta.split('\n')[1::2]
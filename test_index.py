@@ -0,0 +1,164 @@
+import os
+import sqlite3
+import random
+import localgb
+from conftest import genbank_record, write_genbank, run_query
+
+RELEASE_FILES = ['gbinv1.seq', 'gbinv2.seq.gz']
+
+
+def without_delimiter(record):
+    return record[:-len(localgb.RECORD_DELIMITER)]
+
+
+def test_fetch_by_accession_and_version(mirror):
+    localgb.build_index(RELEASE_FILES)
+    records = mirror['gbinv1.seq'] + mirror['gbinv2.seq.gz']
+    fetched = list(localgb.fetch(['BM000060', 'BM000003', 'BM000041.1', 'BM000007.2', 'XX999999']))
+    # in the order they are on disk, and only the versions that exist
+    assert fetched == [without_delimiter(records[i]) for i in (3, 41, 60)]
+
+
+def test_fetch_with_the_index_somewhere_else(mirror):
+    os.mkdir('elsewhere')
+    index_filename = os.path.join('elsewhere', 'index.sqlite')
+    localgb.build_index(RELEASE_FILES, index_filename)
+    fetched = list(localgb.fetch(['BM000079'], index_filename))
+    assert fetched == [without_delimiter(mirror['gbinv2.seq.gz'][39])]
+
+
+def test_changed_files_are_indexed_again(mirror):
+    localgb.build_index(RELEASE_FILES)
+    localgb.build_index(RELEASE_FILES)
+    connection = sqlite3.connect(localgb.INDEX_FILENAME)
+    assert connection.execute('SELECT count(*) FROM records').fetchone() == (80,)
+
+    rng = random.Random(2)
+    replacement = [genbank_record(rng, 'BM{:06d}'.format(i)) for i in range(200, 205)]
+    write_genbank('gbinv1.seq', replacement)
+    stat = os.stat('gbinv1.seq')
+    os.utime('gbinv1.seq', (stat.st_atime, stat.st_mtime + 10))
+    localgb.build_index(RELEASE_FILES)
+    assert connection.execute('SELECT count(*) FROM records').fetchone() == (45,)
+    assert list(localgb.fetch(['BM000003'])) == []
+    assert list(localgb.fetch(['BM000202'])) == [without_delimiter(replacement[2])]
+
+
+SEARCHES = [
+    ['--type', 'CDS', '--qualifier', 'product', '--terms', 'ENOLASE', '--fasta-features'],
+    ['--type', 'rRNA', '--dump-genbank'],
+    ['--type', 'CDS', '--qualifier', 'product', '--terms', 'cytochrome oxidase subunit I',
+     '16S ribosomal RNA', '--fasta-protein-features'],
+    ['--type', 'gene', '--qualifier', 'product', '--terms',
+     'putative uncharacterized protein with a long name that wraps over several lines',
+     '--fasta-features'],
+    ['--type', 'CDS', '--qualifier', 'translation', '--fasta-features'],
+]
+
+
+def test_index_search_finds_the_same_features(mirror):
+    localgb.build_index(RELEASE_FILES, features=True)
+    for search in SEARCHES:
+        expected = run_query('--files', *RELEASE_FILES, *search)
+        assert expected
+        assert run_query('--files', *RELEASE_FILES, '--index', localgb.INDEX_FILENAME, *search) == expected
+
+
+def test_index_candidates_only_include_records_that_could_match(mirror):
+    localgb.build_index(RELEASE_FILES[1:], features=True)
+    localgb.build_index(RELEASE_FILES[:1])
+    args = localgb.argparse.Namespace(
+        files=RELEASE_FILES, type='CDS', qualifier='product', terms=['Enolase']
+    )
+    candidates = localgb.index_candidates(args)
+    # the file without features in the index is left to be searched in full
+    assert list(candidates) == ['gbinv2.seq.gz']
+    expected = [
+        (offset, length)
+        for locus, accession, version, taxid, offset, length, record
+        in localgb.index_file_records('gbinv2.seq.gz')
+        if any(
+            feature_type == 'CDS' and ('product', 'enolase') in
+            [(key, value.lower()) for key, value in qualifiers]
+            for feature_type, location, qualifiers in localgb.parse_feature_table(record.decode())
+        )
+    ]
+    assert 0 < len(expected) < 40
+    assert candidates['gbinv2.seq.gz'] == expected
+
+
+def test_latest_copy_of_each_accession_is_current(mirror):
+    rng = random.Random(3)
+    a9, a10, a10_later_file = [genbank_record(rng, 'AA000001', version) for version in (9, 10, 10)]
+    b1, b1_later_in_file = [genbank_record(rng, 'AA000002', 1) for i in range(2)]
+    c1, c2, c2_daily, c2_later_daily = [genbank_record(rng, 'AA000003', version) for version in (1, 2, 2, 2)]
+    files = {
+        'gbinv3.seq': [a9, a10, b1, c2, b1_later_in_file],
+        'gbinv4.seq': [c1, a10_later_file],
+        'nc0100.flat': [c2_daily],
+        'nc0102.flat': [c2_later_daily],
+    }
+    for filename, records in files.items():
+        write_genbank(filename, records)
+
+    # the order the files are indexed in doesn't matter
+    localgb.build_index(['nc0102.flat', 'gbinv4.seq'])
+    localgb.build_index(['gbinv3.seq', 'nc0100.flat'])
+    # the highest version wins (numerically), then daily update files, then
+    # the later file, then the later record in the file
+    assert sorted(localgb.fetch(['AA000001', 'AA000002', 'AA000003'])) == sorted(
+        without_delimiter(record) for record in (a10_later_file, b1_later_in_file, c2_later_daily)
+    )
+    # asking for a version gets the current copy of it if there's more than one
+    assert sorted(localgb.fetch(['AA000001.9', 'AA000001.10', 'AA000003.2'])) == sorted(
+        without_delimiter(record) for record in (a9, a10_later_file, c2_later_daily)
+    )
+
+    connection = sqlite3.connect(localgb.INDEX_FILENAME)
+    assert connection.execute(
+        "SELECT count(*) FROM records WHERE accession LIKE 'AA%' AND superseded = 0"
+    ).fetchone() == (3,)
+    assert connection.execute(
+        "SELECT count(*) FROM records WHERE accession LIKE 'AA%' AND superseded = 1"
+    ).fetchone() == (6,)
+
+    spans = dict(
+        (offset, length)
+        for locus, accession, version, taxid, offset, length, record
+        in localgb.index_file_records('gbinv3.seq')
+    )
+    current = localgb.current_records(list(files), localgb.INDEX_FILENAME)
+    # nc0102.flat has nothing superseded in it, so it's read in full
+    assert sorted(current) == ['gbinv3.seq', 'gbinv4.seq', 'nc0100.flat']
+    assert current['gbinv3.seq'] == [sorted(spans.items())[-1]]
+    assert current['nc0100.flat'] == []
+
+
+def test_index_search_skips_superseded_records(mirror):
+    files = sorted(mirror)
+    localgb.build_index(files)
+    search = ['--type', 'source', '--dump-genbank']
+
+    # the same as searching copies of the files without the superseded
+    # records in them
+    os.mkdir('current')
+    for filename, records in mirror.items():
+        write_genbank(os.path.join('current', filename), [
+            record for record in records
+            if not any(accession in record.split('\n')[0] for accession in ('BM000005', 'BM000045'))
+            or filename.startswith('nc')
+        ])
+    os.chdir('current')
+    expected = run_query('--files', *files, *search)
+    os.chdir('..')
+    assert run_query('--files', *files, '--index', localgb.INDEX_FILENAME, *search) == expected
+    assert b'BM000005.2' in expected and b'BM000005.1' not in expected
+
+    # and --as-of-release is the same as searching the release files on their
+    # own, the index or not
+    release = run_query('--files', *RELEASE_FILES, *search)
+    assert b'BM000005.1' in release
+    assert run_query('--files', *files, '--as-of-release', *search) == release
+    assert run_query(
+        '--files', *files, '--index', localgb.INDEX_FILENAME, '--as-of-release', *search
+    ) == release
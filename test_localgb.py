@@ -0,0 +1,171 @@
+import warnings
+import pytest
+import localgb
+
+warnings.filterwarnings("ignore")
+
+# escaped quotes ("") at the ends of lines, which mustn't be taken for the
+# end of the value
+RECORD = '''LOCUS       TEST0001                 120 bp    DNA     linear   INV 01-JAN-2020
+DEFINITION  Test record.
+ACCESSION   TEST0001
+VERSION     TEST0001.1
+KEYWORDS    .
+SOURCE      Test organism
+  ORGANISM  Test organism
+            Eukaryota.
+FEATURES             Location/Qualifiers
+     source          1..120
+                     /organism="Test organism"
+                     /db_xref="taxon:7227"
+     CDS             complement(join(1..30,61..90))
+                     /product="enolase"
+                     /note="a note that has a quote at line end ""x""
+                     continues here"
+                     /note="""quoted"" at the start and at the end ""y"""
+                     /note="ends on an escaped quote ""
+                     on the line before"
+                     /translation="MKVLAAGIVGLLLA
+                     LLAVRGQ"
+ORIGIN
+        1 atggcgaatt ccgatcgatc gatcgatcga tcgatcgatc gatcgatcga tcgatcgatc
+       61 gatcgatcga tcgatcgatc gatcgatcga tcgatcgatc gatcgatcga tcgatcgatc
+'''
+
+
+def test_lazy_record_matches_biopython():
+    lazy = localgb.LazyRecord(RECORD)
+    biopython = localgb.BiopythonRecord(RECORD)
+    assert lazy.id == biopython.id
+    assert len(lazy.features) == len(biopython.features)
+    for lazy_feature, biopython_feature in zip(lazy.features, biopython.features):
+        assert lazy_feature.type == biopython_feature.type
+        assert lazy_feature.qualifiers == dict(biopython_feature.qualifiers)
+        assert lazy.extract(lazy_feature) == biopython.extract(biopython_feature)
+
+
+def test_prefilter_matches_non_ascii_terms_in_any_case():
+    record = RECORD.replace('/product="enolase"', '/product="\xc9NOLASE \xe0 b\xeata"').encode('latin-1')
+    for term in ['\xe9nolase \xe0 b\xeata', '\xc9nolase \xc0 B\xcaTA']:
+        query = localgb.Query('CDS', qualifier='product', terms=[term])
+        assert query.prefilter.search(record) is not None
+        # records too big to copy are searched in place, ignoring case
+        assert query.prefilter.ignorecase_pattern.search(record) is not None
+        assert len(list(localgb.matching_features(localgb.LazyRecord(str(record, 'latin-1')), query))) == 1
+
+
+def test_prefilter_allows_spaces_around_the_value():
+    for value, term in [
+        ('" enolase"', ' enolase'),
+        ('"\n                     enolase"', ' enolase'),
+        ('"enolase  "', 'enolase  '),
+        ('"  Phosphopyruvate\n                     hydratase"', '  phosphopyruvate hydratase'),
+    ]:
+        record = RECORD.replace('/product="enolase"', '/product=' + value)
+        query = localgb.Query('CDS', qualifier='product', terms=[term])
+        assert len(list(localgb.matching_features(localgb.LazyRecord(record), query))) == 1
+        assert query.prefilter.search(record.encode('latin-1')) is not None
+
+
+def test_prefilter_finds_unquoted_values_at_the_end_of_the_record():
+    # the record as the search sees it, without its ORIGIN and the trailing
+    # newline before the //
+    record = RECORD[:RECORD.index('ORIGIN')] + '                     /number=3'
+    query = localgb.Query('CDS', qualifier='number', terms=['3'])
+    assert query.prefilter.search(record.encode('latin-1')) is not None
+    assert query.prefilter.search(record.encode('latin-1') + b'2') is None
+    assert len(list(localgb.matching_features(localgb.LazyRecord(record), query))) == 1
+
+
+def test_terms_that_can_never_match_are_rejected():
+    try:
+        localgb.Query('CDS', qualifier='product', terms=['α-enolase'])
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected a ValueError'
+
+
+def naive_scan(motifs, sequence, reverse_complement=True):
+    """
+    Every (name, start, end, strand) where a motif or its reverse complement
+    matches, by checking each position against the IUPAC codes one by one.
+    """
+    def matches(motif, position):
+        return all(
+            base in localgb.IUPAC_CODES[code] + ('U' if 'T' in localgb.IUPAC_CODES[code] else '')
+            for code, base in zip(motif, sequence[position:position + len(motif)])
+        ) and position + len(motif) <= len(sequence)
+
+    hits = []
+    for name, motif in motifs.items():
+        reverse = motif.translate(localgb.complement_table)[::-1]
+        for position in range(len(sequence)):
+            if matches(motif, position):
+                hits.append((name, position, position + len(motif), 1))
+            if reverse_complement and reverse != motif and matches(reverse, position):
+                hits.append((name, position, position + len(motif), -1))
+    return sorted(hits, key=lambda hit: hit[1])
+
+
+def test_motif_scanner_matches_naive_scan():
+    import random
+    rng = random.Random(1)
+    motifs = {
+        'EcoRI': 'GAATTC',    # its own reverse complement
+        'HinfI': 'GANTC',
+        'primer': 'ACRYGT',
+        'tail': 'AAAAA',      # overlaps itself
+        'short': 'GS',
+    }
+    for i in range(30):
+        sequence = ''.join(rng.choice('ACGTTAAAAN' if i % 2 else 'ACGTU') for i in range(500))
+        sequence += 'GAATTC'
+        for reverse_complement in (True, False):
+            scanner = localgb.MotifScanner(motifs, reverse_complement)
+            hits = scanner.scan(sequence.encode())
+            assert hits == naive_scan(motifs, sequence, reverse_complement)
+    assert ('EcoRI', 500, 506, 1) in hits
+    assert not any(hit[0] == 'EcoRI' and hit[3] == -1 for hit in localgb.MotifScanner(motifs).scan(b'GAATTC'))
+
+
+def test_motif_scanner_on_records():
+    record = RECORD.encode()
+    sequence = localgb.LazyRecord(RECORD).sequence
+    assert localgb.record_sequence(record).decode() == sequence
+    scanner = localgb.MotifScanner(['GATC', 'tcgA', 'WCG'])
+    assert scanner(record) == ('TEST0001.1', scanner.scan(sequence.encode()))
+    assert len(scanner(record)[1]) > 60
+    assert scanner(record)[1] == naive_scan({'GATC': 'GATC', 'tcgA': 'TCGA', 'WCG': 'WCG'}, sequence)
+    assert localgb.MotifScanner(['GGGGGGGGGGGGGGGG'])(record) is None
+    with pytest.raises(ValueError):
+        localgb.MotifScanner(['GAXTC'])
+
+
+def test_motif_search_over_files(mirror):
+    files = sorted(mirror)
+    scanner = localgb.MotifScanner({'EcoRI': 'GAATTC', 'HinfI': 'GANTC'})
+    results = []
+    localgb.do_search_generic(scanner, files, result_function=results.append, raw=True)
+    assert len(results) > 50
+    expected = [
+        scanner(record.encode())
+        for filename in files for record in mirror[filename]
+    ]
+    assert results == [result for result in expected if result is not None]
+
+    parallel_results = []
+    localgb.do_search_generic(scanner, files, workers=2, result_function=parallel_results.append, raw=True)
+    assert parallel_results == results
+
+    # with the index, the old versions of BM000005 and BM000045 are skipped
+    assert 'BM000005.1' in [result[0] for result in results]
+    localgb.build_index(files)
+    current_results = []
+    localgb.do_search_generic(
+        scanner, files, result_function=current_results.append, raw=True,
+        index=localgb.INDEX_FILENAME
+    )
+    assert current_results == [
+        result for result in results if result[0] not in ('BM000005.1', 'BM000045.1')
+    ]
@@ -0,0 +1,33 @@
+import os
+import time
+import resultcache
+
+
+def test_purge_leaves_entries_that_are_being_written(tmp_path):
+    genbank_filename = tmp_path / 'gbinv1.seq'
+    genbank_filename.write_text('LOCUS\n//\n')
+    cache = resultcache.ResultCache(str(tmp_path / 'cache'))
+    key = resultcache.make_key(str(genbank_filename), {'type': 'CDS'})
+
+    # a search is part way through writing an entry...
+    entry_file = cache.new_entry()
+    entry_file.write('>result\n')
+
+    # ...and one that was interrupted long ago left one behind
+    stale_file = cache.new_entry()
+    stale_file.close()
+    stale_time = time.time() - resultcache.STALE_ENTRY_AGE - 60
+    os.utime(stale_file.name, (stale_time, stale_time))
+
+    cache.purge()
+    assert not os.path.exists(stale_file.name)
+
+    cache.add(key, entry_file, str(genbank_filename), {'type': 'CDS'}, {'features': 1})
+    data_filename, counts = cache.get(key)
+    with open(data_filename) as data_file:
+        assert data_file.read() == '>result\n'
+    assert counts == {'features': 1}
+
+    assert cache.purge(str(genbank_filename)) == 1
+    assert cache.get(key) is None
+    cache.close()
@@ -0,0 +1,119 @@
+import json
+import pytest
+import bgzf
+import localgb
+import query
+from conftest import run_query
+
+FILES = ['gbinv1.seq', 'gbinv2.seq.gz', 'nc0101.flat.gz']
+
+# a mix of query.py queries, as batch query specs
+QUERIES = [
+    {'type': 'CDS', 'qualifier': 'product', 'terms': ['enolase'], 'action': 'fasta-features'},
+    {'type': 'CDS', 'qualifier': 'product', 'terms': 'Cytochrome Oxidase Subunit I',
+     'action': 'fasta-protein-features'},
+    {'type': 'rRNA', 'action': 'dump-genbank', 'taxid-file': 'taxids.txt'},
+    {'type': 'gene', 'qualifier': 'product', 'action': 'count-features'},
+    {'type': 'CDS', 'qualifier': 'product', 'terms': ['enolase', 'hypothetical protein'],
+     'action': 'dump-genbank', 'taxid-file': 'taxids.txt'},
+    {'type': 'misc_feature', 'action': 'fasta-features'},
+]
+
+
+def query_arguments(spec):
+    """
+    The query.py arguments for a batch query spec.
+    """
+    arguments = ['--type', spec['type'], '--' + spec['action']]
+    if 'qualifier' in spec:
+        arguments += ['--qualifier', spec['qualifier']]
+    if 'terms' in spec:
+        terms = spec['terms']
+        arguments += ['--terms'] + ([terms] if isinstance(terms, str) else terms)
+    if 'taxid-file' in spec:
+        arguments += ['--taxid-file', spec['taxid-file']]
+    return arguments
+
+
+@pytest.fixture
+def searches(mirror):
+    with open('taxids.txt', 'w') as taxid_file:
+        taxid_file.write('6447\n6448\n')
+    outputs = [run_query('--files', *FILES, *query_arguments(spec)) for spec in QUERIES]
+    # (counting only prints the counts)
+    assert all(output for spec, output in zip(QUERIES, outputs) if spec['action'] != 'count-features')
+    return outputs
+
+
+def test_batch_output_is_the_same_as_separate_queries(searches):
+    batch = [dict(spec, output='batch-{}'.format(i)) for i, spec in enumerate(QUERIES)]
+    with open('batch.json', 'w') as batch_file:
+        json.dump(batch, batch_file)
+    query.main(query.parser.parse_args(['--files', *FILES, '--batch', 'batch.json']))
+    for spec, expected in zip(batch, searches):
+        with open(spec['output'], 'rb') as output_file:
+            assert output_file.read() == expected
+
+
+def test_bad_batches_are_rejected(mirror):
+    for batch in (
+        {'type': 'CDS'},
+        [{'type': 'CDS', 'action': 'fasta-features'}],
+        [{'type': 'CDS', 'action': 'fasta-features', 'output': 'a', 'colour': 'red'}],
+        [{'type': 'CDS', 'action': 'fasta-features', 'output': 'a'},
+         {'type': 'gene', 'action': 'fasta-features', 'output': 'a'}],
+    ):
+        with open('batch.json', 'w') as batch_file:
+            json.dump(batch, batch_file)
+        with pytest.raises(SystemExit):
+            query.main(query.parser.parse_args(['--files', *FILES, '--batch', 'batch.json']))
+
+
+def run_batch(*args):
+    """
+    Run all of QUERIES as a batch with the given query.py arguments and
+    return what each wrote.
+    """
+    batch = [dict(spec, output='batch-{}'.format(i)) for i, spec in enumerate(QUERIES)]
+    with open('batch.json', 'w') as batch_file:
+        json.dump(batch, batch_file)
+    query.main(query.parser.parse_args(['--files', *FILES, '--batch', 'batch.json', *args]))
+    outputs = []
+    for spec in batch:
+        with open(spec['output'], 'rb') as output_file:
+            outputs.append(output_file.read())
+    return outputs
+
+
+@pytest.fixture
+def small_pieces(monkeypatch):
+    """
+    Make the searches with workers split the files into lots of small
+    pieces, so that putting the results back in order is tested.
+    """
+    # these are default arguments, so they're fixed when the module loads
+    monkeypatch.setattr(localgb.split_file, '__defaults__', (20000,))
+    defaults = list(localgb.SearchPipeline.__init__.__defaults__)
+    defaults[2] = 5000
+    monkeypatch.setattr(localgb.SearchPipeline.__init__, '__defaults__', tuple(defaults))
+    monkeypatch.setattr(localgb, 'SPANS_PER_TASK', 3)
+
+
+@pytest.mark.parametrize('options', [
+    ['--workers', '2'],
+    ['--workers', '3', '--pipeline'],
+    ['--workers', '2', '--pipeline', '--queue-size', '1'],
+])
+def test_parallel_output_is_the_same_as_serial(searches, small_pieces, options):
+    bgzf.convert('gbinv2.seq.gz')
+    assert len(localgb.split_file('gbinv2.seq.gz')) > 2
+    assert run_batch(*options) == searches
+
+
+def test_parallel_index_search_is_the_same_as_serial(mirror, small_pieces):
+    with open('taxids.txt', 'w') as taxid_file:
+        taxid_file.write('6447\n6448\n')
+    localgb.build_index(FILES, features=True, sequences=True)
+    expected = run_batch('--index', localgb.INDEX_FILENAME)
+    assert run_batch('--index', localgb.INDEX_FILENAME, '--workers', '2') == expected
+    assert run_batch('--index', localgb.INDEX_FILENAME, '--workers', '2', '--pipeline') == expected
@@ -0,0 +1,85 @@
+import random
+import pytest
+import localgb
+from conftest import run_query
+
+seqstore = pytest.importorskip('seqstore')
+
+
+def random_sequence(rng, length):
+    """
+    Mostly ACGT, with runs of N and other IUPAC codes of various lengths,
+    some of them next to each other.
+    """
+    sequence = []
+    while len(sequence) < length:
+        if rng.random() < 0.1:
+            sequence.extend(rng.choice('NRYKMSWBDHV') * rng.randint(1, 9))
+        else:
+            sequence.extend(rng.choice('ACGT') for i in range(rng.randint(1, 20)))
+    return ''.join(sequence[:length])
+
+
+@pytest.fixture
+def store(tmp_path):
+    rng = random.Random(1)
+    filename = str(tmp_path / 'store.seqs')
+    sequences = {}
+    entries = {}
+    writer = seqstore.SequenceStoreWriter(filename)
+    for length in list(range(14)) + [rng.randint(20, 2000) for i in range(30)]:
+        record_id = 'R{}.1'.format(len(sequences))
+        sequences[record_id] = random_sequence(rng, length)
+        entries[record_id] = writer.add(sequences[record_id])
+    sequences['ACGT'] = 'ACGT' * 100
+    entries['ACGT'] = writer.add(sequences['ACGT'])
+    writer.close()
+    store = seqstore.SequenceStore(filename, entries.get)
+    yield store, sequences
+    store.close()
+
+
+def test_extract_matches_slicing(store):
+    store, sequences = store
+    rng = random.Random(2)
+    for record_id, sequence in sequences.items():
+        assert record_id in store
+        assert store.extract(record_id, 0, len(sequence)) == sequence
+        for i in range(50):
+            start = rng.randint(-3, len(sequence) + 3)
+            end = rng.randint(start - 2, len(sequence) + 5)
+            assert store.extract(record_id, start, end) == sequence[max(start, 0):max(end, 0)]
+    assert 'R999.1' not in store
+
+
+def test_exception_runs():
+    assert seqstore.pack('ACGT' * 100)[1:] == (b'', 0)
+    # a run of N then a run of R straight after it are two exceptions
+    packed, exceptions, count = seqstore.pack('ACNNNRRTG')
+    assert count == 2
+    assert len(packed) == 3
+
+
+def test_empty_store(tmp_path):
+    filename = str(tmp_path / 'store.seqs')
+    seqstore.SequenceStoreWriter(filename).close()
+    store = seqstore.SequenceStore(filename, {}.get)
+    assert 'R1.1' not in store
+    store.close()
+
+
+def test_features_from_the_store_match_the_records(mirror):
+    files = ['gbinv1.seq', 'gbinv2.seq.gz']
+    localgb.build_index(files, features=True, sequences=True)
+    store = localgb.open_sequence_store()
+    for record in localgb.read_records('gbinv1.seq'):
+        if record:
+            lazy_record = localgb.LazyRecord(record)
+            assert store.extract(lazy_record.id, 0, len(lazy_record.sequence)) == lazy_record.sequence
+    store.close()
+    for search in (
+        ['--type', 'CDS', '--qualifier', 'product', '--terms', 'enolase', '--fasta-features'],
+        ['--type', 'rRNA', '--fasta-features'],
+    ):
+        expected = run_query('--files', *files, *search)
+        assert run_query('--files', *files, '--index', localgb.INDEX_FILENAME, *search) == expected
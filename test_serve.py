@@ -0,0 +1,35 @@
+import os
+import pytest
+
+pytest.importorskip('numpy')
+import localgb
+import taxonomy
+import serve
+
+
+def test_get_taxids_requests_use_the_server_taxonomy(tmp_path, monkeypatch, capsys):
+    server_directory = tmp_path / 'server'
+    client_directory = tmp_path / 'client'
+    server_directory.mkdir()
+    client_directory.mkdir()
+    monkeypatch.chdir(server_directory)
+    taxonomy.build([(1, 1, 'no rank'), (2, 1, 'genus'), (3, 2, 'species'), (4, 2, 'species')])
+    taxonomy.build_names([(3, 'Foo bar', 'scientific name'), (4, 'Foo baz', 'scientific name')])
+    taxonomy_directory = os.path.abspath(taxonomy.TAXONOMY_DIRECTORY)
+    genbank = localgb.LocalGenBank(files=[], index=False)
+    serve.warm_up(genbank, taxonomy_directory)
+
+    # the request runs in the client's directory, which has no taxonomy
+    for args, expected in [
+        (['--lca', '3', '4'], '2\n'),
+        (['--lookup', 'foo BAZ'], '4\n'),
+        (['--include', '2', '--output', 'taxids.txt'], None),
+    ]:
+        status = serve.run_request(genbank, taxonomy_directory, {
+            'command': 'get_taxids', 'args': args, 'cwd': str(client_directory)
+        })
+        assert status == 0
+        if expected is not None:
+            assert capsys.readouterr()[0] == expected
+    assert (client_directory / 'taxids.txt').read_text() == '3\n4\n'
+    assert not (client_directory / taxonomy.TAXONOMY_DIRECTORY).exists()
@@ -0,0 +1,339 @@
+import os
+import random
+import pytest
+
+np = pytest.importorskip('numpy')
+import taxonomy
+import get_taxids
+
+RANKS = taxonomy.MAIN_RANKS + ['no rank', 'clade']
+
+
+def write_nodes_dmp(filename, nodes):
+    with open(filename, 'w') as nodes_file:
+        for taxid, parent, rank in nodes:
+            nodes_file.write('{}\t|\t{}\t|\t{}\t|\t\t|\t0\t|\n'.format(taxid, parent, rank))
+
+
+def random_tree(rng, size):
+    """
+    Return a dict of taxid to (parent, rank) for a random tree with taxids
+    scattered over a bigger range, with a mix of long chains and bushes.
+    """
+    taxids = [taxonomy.ROOT_TAXID] + rng.sample(range(2, size * 4), size - 1)
+    nodes = {taxonomy.ROOT_TAXID: (taxonomy.ROOT_TAXID, 'no rank')}
+    for i, taxid in enumerate(taxids[1:], 1):
+        if rng.random() < 0.7:
+            parent = taxids[rng.randrange(max(i - 3, 0), i)]
+        else:
+            parent = taxids[rng.randrange(i)]
+        nodes[taxid] = (parent, rng.choice(RANKS))
+    return nodes
+
+
+def naive_lineage(nodes, taxid):
+    """
+    taxid and all its ancestors, from the bottom up.
+    """
+    lineage = [taxid]
+    while taxid != taxonomy.ROOT_TAXID:
+        taxid = nodes[taxid][0]
+        lineage.append(taxid)
+    return lineage
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    """
+    A random taxonomy built from a nodes.dmp in the current directory (the
+    order of its lines shuffled), and the dict of nodes it was built from.
+    """
+    monkeypatch.chdir(tmp_path)
+    nodes = random_tree(random.Random(1), 2000)
+    lines = [(taxid, parent, rank) for taxid, (parent, rank) in nodes.items()]
+    random.Random(2).shuffle(lines)
+    write_nodes_dmp(taxonomy.NODES_FILENAME, lines)
+    return taxonomy.load(), nodes
+
+
+def test_descendants_in_pre_order(tree):
+    tree, nodes = tree
+    assert len(tree) == len(nodes)
+    for taxid in list(nodes)[::20]:
+        descendants = [int(x) for x in tree.descendants(taxid)]
+        assert set(descendants) == set(
+            other for other in nodes if other != taxid and taxid in naive_lineage(nodes, other)
+        )
+        # every taxid comes after its parent
+        seen = set([taxid])
+        for descendant in descendants:
+            assert nodes[descendant][0] in seen
+            seen.add(descendant)
+    for taxid in list(nodes)[:50]:
+        assert (tree.get_parent(taxid), tree.get_rank(taxid)) == nodes[taxid]
+
+
+def test_is_descendant(tree):
+    tree, nodes = tree
+    missing = [0, -1, max(nodes) + 10, next(x for x in range(2, 10000) if x not in nodes)]
+    taxids = np.array(list(nodes) + missing)
+    for ancestor in list(nodes)[::50]:
+        expected = [
+            taxid in nodes and taxid != ancestor and ancestor in naive_lineage(nodes, taxid)
+            for taxid in taxids
+        ]
+        assert list(tree.is_descendant(taxids, ancestor)) == expected
+    with pytest.raises(KeyError):
+        tree.descendants(missing[3])
+    assert missing[3] not in tree
+
+
+def test_selection_matches_get_taxids(tree, capsys):
+    tree, nodes = tree
+    rng = random.Random(3)
+    bushy = [taxid for taxid in nodes if len(tree.descendants(taxid)) > 20]
+    include = rng.sample(bushy, 3)
+    exclude = [int(tree.descendants(include[0])[0]), rng.choice(bushy)]
+
+    def descendants(taxid):
+        return set(
+            other for other in nodes if other != taxid and taxid in naive_lineage(nodes, other)
+        )
+    expected = set()
+    for taxid in include:
+        expected |= descendants(taxid)
+    for taxid in exclude:
+        expected -= descendants(taxid)
+
+    get_taxids.main(get_taxids.parser.parse_args(
+        ['--include'] + [str(x) for x in include]
+        + ['--exclude'] + [str(x) for x in exclude]
+        + ['--output', 'taxids.txt']
+    ))
+    with open('taxids.txt') as taxids_file:
+        taxids = [int(line) for line in taxids_file]
+    assert len(taxids) == len(expected)
+    assert set(taxids) == expected
+
+
+def test_rebuilding_swaps_versions(tree):
+    tree, nodes = tree
+    assert os.path.islink(taxonomy.TAXONOMY_DIRECTORY)
+    first_version = os.path.realpath(taxonomy.TAXONOMY_DIRECTORY)
+
+    smaller = dict(list(nodes.items())[:100])
+    taxonomy.build(
+        ((taxid, parent, rank) for taxid, (parent, rank) in smaller.items())
+    )
+    second_version = os.path.realpath(taxonomy.TAXONOMY_DIRECTORY)
+    assert second_version != first_version
+    assert os.path.realpath(taxonomy.TAXONOMY_DIRECTORY + '.previous') == first_version
+    # the taxonomy that was already open still works
+    assert len(tree) == len(nodes)
+    assert len(tree.descendants(taxonomy.ROOT_TAXID)) == len(nodes) - 1
+    assert len(taxonomy.load()) == len(smaller)
+
+    taxonomy.build(
+        ((taxid, parent, rank) for taxid, (parent, rank) in smaller.items())
+    )
+    assert not os.path.exists(first_version)
+    assert os.path.realpath(taxonomy.TAXONOMY_DIRECTORY + '.previous') == second_version
+
+
+def naive_lca(nodes, taxids):
+    lineages = [naive_lineage(nodes, taxid) for taxid in taxids]
+    common = set(lineages[0]).intersection(*lineages[1:])
+    return next(taxid for taxid in lineages[0] if taxid in common)
+
+
+def test_lca_matches_naive_walk(tree):
+    tree, nodes = tree
+    rng = random.Random(4)
+    taxids = list(nodes)
+    pairs = [tuple(rng.sample(taxids, 2)) for i in range(500)]
+    pairs += [(taxid, taxid) for taxid in taxids[:10]]
+    pairs += [(taxonomy.ROOT_TAXID, taxid) for taxid in taxids[:10]]
+    # a taxid and one of its ancestors
+    pairs += [(taxid, rng.choice(naive_lineage(nodes, taxid))) for taxid in taxids[:100]]
+    pairs += [(b, a) for a, b in pairs[-100:]]
+    lcas = tree.lca([a for a, b in pairs], [b for a, b in pairs])
+    assert [int(x) for x in lcas] == [naive_lca(nodes, pair) for pair in pairs]
+    for a, b in pairs[:20]:
+        assert get_taxids.find_lca(a, b) == naive_lca(nodes, (a, b))
+    with pytest.raises(KeyError):
+        tree.lca([taxids[0]], [max(nodes) + 1])
+
+
+def test_lca_of_sets_matches_naive_walk(tree):
+    tree, nodes = tree
+    rng = random.Random(5)
+    taxids = list(nodes)
+    sets = [rng.sample(taxids, rng.randint(1, 6)) for i in range(300)]
+    # sets that are all in one subtree
+    for taxid in taxids[::40]:
+        descendants = [int(x) for x in tree.descendants(taxid)]
+        if descendants:
+            sets.append(rng.sample(descendants, min(len(descendants), 4)))
+    lcas = tree.lca_of_sets([np.array(taxid_set) for taxid_set in sets])
+    assert [int(x) for x in lcas] == [naive_lca(nodes, taxid_set) for taxid_set in sets]
+    assert len(tree.lca_of_sets([])) == 0
+    with pytest.raises(ValueError):
+        tree.lca_of_sets([[taxids[0]], []])
+
+
+def test_lineages(tree):
+    tree, nodes = tree
+    taxids = list(nodes)[::7]
+    ranks = ['species', 'genus', 'clade', 'family', 'no such rank']
+    lineages = tree.ranked_lineages(taxids, ranks)
+    for taxid, row in zip(taxids, lineages):
+        lineage = naive_lineage(nodes, taxid)
+        assert tree.lineage(taxid) == lineage[::-1]
+        assert get_taxids.get_all_parents(taxid) == lineage
+        expected = [
+            next((x for x in lineage if nodes[x][1] == rank), 0) for rank in ranks
+        ]
+        assert [int(x) for x in row] == expected
+
+
+def test_lca_file(tree, capsys):
+    tree, nodes = tree
+    taxids = list(nodes)
+    unknown = max(nodes) + 1
+    with open('sets.txt', 'w') as sets_file:
+        sets_file.write('{} {},{}\n\n{}\n{} {}\n'.format(
+            taxids[10], taxids[20], taxids[30], unknown, taxids[40], unknown
+        ))
+    get_taxids.main(get_taxids.parser.parse_args(['--lca-file', 'sets.txt']))
+    output, errors = capsys.readouterr()
+    assert output.split('\n') == [
+        str(naive_lca(nodes, taxids[10:31:10])), '0', '0', str(taxids[40]), ''
+    ]
+    assert str(unknown) in errors
+
+
+def test_find_lca_of_names(tree):
+    tree, nodes = tree
+    names = []
+    for taxid in nodes:
+        names.append((taxid, 'Taxon {}'.format(taxid), 'scientific name'))
+        names.append((taxid, 'synonym {}'.format(taxid), 'synonym'))
+    # a name shared with another taxon, as a common name
+    names.append((taxonomy.ROOT_TAXID, 'Taxon {}'.format(list(nodes)[10]), 'common name'))
+    taxonomy.build_names(names)
+    taxids = list(nodes)[10:50:7]
+    assert get_taxids.find_lca_multiple(
+        ['taxon {}'.format(taxid) for taxid in taxids]
+    ) == 'Taxon {}'.format(naive_lca(nodes, taxids))
+    with pytest.raises(KeyError):
+        get_taxids.find_lca_multiple(['Taxon 1', 'no such taxon'])
+
+
+def levenshtein(a, b):
+    row = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        previous, row[0] = row[0], i
+        for j, y in enumerate(b, 1):
+            previous, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, previous + (x != y))
+    return row[-1]
+
+
+@pytest.fixture
+def names(tmp_path, monkeypatch):
+    """
+    A name index built from a names.dmp full of similar names, and the list
+    of (taxid, name, name class) it was built from.
+    """
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(6)
+    syllables = ['ba', 'bac', 'ter', 'ia', 'um', 'Ho', 'mo', 'sa', 'pi', 'ens', 'Å', 'ö', ' ']
+    names = []
+    for taxid in range(1, 1500):
+        name = ''.join(rng.choice(syllables) for i in range(rng.randint(1, 6))).strip() or 'x'
+        names.append((taxid, name.capitalize(), 'scientific name'))
+        if rng.random() < 0.3:
+            names.append((taxid, name.upper(), rng.choice(['synonym', 'common name'])))
+    with open(taxonomy.NAMES_FILENAME, 'w', encoding='utf-8') as names_file:
+        for taxid, name, name_class in names:
+            names_file.write('{}\t|\t{}\t|\t\t|\t{}\t|\n'.format(taxid, name, name_class))
+    return taxonomy.load_names(), names
+
+
+def test_exact_and_prefix(names):
+    index, names = names
+    rng = random.Random(7)
+    for taxid, name, name_class in rng.sample(names, 100):
+        expected = sorted(
+            (other_taxid, other_name, other_class)
+            for other_taxid, other_name, other_class in names
+            if other_name.lower() == name.lower()
+        )
+        assert sorted(
+            (match.taxid, match.name, match.name_class) for match in index.exact(name.swapcase())
+        ) == expected
+        prefix = name[:rng.randint(1, len(name))]
+        expected = sorted(
+            (other_taxid, other_name, other_class)
+            for other_taxid, other_name, other_class in names
+            if other_name.lower().startswith(prefix.lower())
+        )
+        assert sorted(
+            (match.taxid, match.name, match.name_class)
+            for match in index.prefix(prefix, limit=len(names))
+        ) == expected
+        limited = index.prefix(prefix, limit=3)
+        assert len(limited) == min(3, len(expected))
+        assert [match.name.lower() for match in limited] == sorted(match.name.lower() for match in limited)
+    assert index.exact('no such name') == []
+
+
+def test_fuzzy_matches_brute_force(names):
+    index, names = names
+    rng = random.Random(8)
+    queries = [name for taxid, name, name_class in rng.sample(names, 15)]
+    # with typos, and made up
+    for query in queries[:10]:
+        position = rng.randrange(len(query))
+        queries.append(query[:position] + rng.choice('aöx') + query[position + 1:])
+        queries.append(query[:position] + query[position + 1:])
+    queries += ['', 'zzz', 'bacteriumx']
+    for query in queries:
+        scored = [
+            (levenshtein(query.lower(), name.lower()), taxid, name, name_class)
+            for taxid, name, name_class in names
+        ]
+        for max_distance in (0, 1, 2):
+            expected = sorted(match for match in scored if match[0] <= max_distance)
+            matches = index.fuzzy(query, max_distance, limit=len(names))
+            assert sorted(
+                (match.distance, match.taxid, match.name, match.name_class) for match in matches
+            ) == expected
+            # closest first, and the limit keeps the closest ones
+            distances = [match.distance for match in matches]
+            assert distances == sorted(distances)
+            assert [match.distance for match in index.fuzzy(query, max_distance, limit=5)] == distances[:5]
+
+
+def test_lookup_suggests_close_names(names, capsys):
+    index, names = names
+    name = names[0][1]
+    get_taxids.main(get_taxids.parser.parse_args(['--lookup', name + 'q']))
+    output = capsys.readouterr()[0]
+    assert "Couldn't find a taxid" in output
+    assert 'Did you mean: ' in output and name in output
+
+
+def test_names_sorted_in_runs_are_the_same(names, monkeypatch):
+    index, names = names
+    monkeypatch.setattr(taxonomy, 'NAME_RUN_SIZE', 37)
+    taxonomy.build_names(names, 'in_runs')
+    for filename in taxonomy.NAME_FILES + [name + '.npy' for name in taxonomy.NAME_ARRAYS]:
+        with open(os.path.join(taxonomy.TAXONOMY_DIRECTORY, filename), 'rb') as whole_file:
+            with open(os.path.join('in_runs', filename), 'rb') as runs_file:
+                assert runs_file.read() == whole_file.read()
+    # and nothing is left behind
+    assert sorted(os.listdir('in_runs')) == sorted(
+        taxonomy.NAME_FILES + [name + '.npy' for name in taxonomy.NAME_ARRAYS]
+    )
+    keys = [index.keys[i] for i in range(len(index.keys))]
+    assert keys == sorted(keys)
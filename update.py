@@ -1,4 +1,5 @@
 import logging
+import os
 import argparse
 from argparse import RawTextHelpFormatter
 from ftplib import FTP
@@ -50,8 +51,45 @@ TSA Transcriptome shotgun data
 parser.add_argument(
     "--force",
     action="store_true",
-    help="delete existing files and download the current release even if your\
-    copy is up to date"
+    help="delete existing files and download the current release (and taxonomy\
+    dump) even if your copy is up to date"
+)
+parser.add_argument(
+    "-y", "--yes",
+    action="store_true",
+    help="don't ask for confirmation before deleting or downloading files, for\
+    running from cron"
+)
+parser.add_argument(
+    "-c", "--connections",
+    type=int,
+    default=4,
+    help="number of files to download at once (default: 4)"
+)
+parser.add_argument(
+    "--host",
+    default=localgb.FTP_HOST,
+    help="FTP server to download from (default: {})".format(localgb.FTP_HOST)
+)
+parser.add_argument(
+    "--port",
+    type=int,
+    default=localgb.FTP_PORT,
+    help="FTP port (default: {})".format(localgb.FTP_PORT)
+)
+parser.add_argument(
+    "--bgzf",
+    action="store_true",
+    help="recompress the downloaded files in blocks (BGZF) with an index\
+    (.gzi), so that queries can jump straight to any record and split each file\
+    between workers. The files are still normal .gz files and are about the same\
+    size"
+)
+parser.add_argument(
+    "--index",
+    action="store_true",
+    help="after downloading, add any new files to the record and feature index\
+    ({}) so that query.py --index and fetch.py can use them".format(localgb.INDEX_FILENAME)
 )
 args = parser.parse_args()
 
@@ -64,9 +102,30 @@ elif args.verbosity > 0:
 
 
 
+localgb.FTP_HOST = args.host
+localgb.FTP_PORT = args.port
+
 if localgb.need_to_update_release() or args.force:
-    localgb.delete_old_files()
-    localgb.do_update_release(args.divisions)
+    # if the last run was interrupted part way through getting this release,
+    # keep what it got
+    if args.force or not localgb.release_download_in_progress():
+        localgb.delete_old_files(assume_yes=args.yes)
+    localgb.do_update_release(args.divisions, connections=args.connections, assume_yes=args.yes)
+
+localgb.get_daily_updates(connections=args.connections, assume_yes=args.yes)
+localgb.get_taxdump(force=args.force)
+
+genbank_files = sorted(
+    f for f in os.listdir('.') if f.endswith('.seq.gz') or f.endswith('.flat.gz')
+)
+
+if args.bgzf:
+    localgb.convert_to_bgzf(genbank_files)
 
-localgb.get_daily_updates()
-localgb.get_taxdump()
+if args.index:
+    # keep packing sequences if the store has been built before
+    localgb.build_index(
+        genbank_files,
+        features=True,
+        sequences=os.path.exists(localgb.sequence_store_filename(localgb.INDEX_FILENAME))
+    )